@@ -4,12 +4,21 @@ import json
 import unicodedata
 import re
 
+from collections import defaultdict
 from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
 
 
 MAX_MESSAGE_CHARS = 140
 SYSTEM_LABEL_FLAGGED = "Flagged"
 
+_django_encoder = DjangoJSONEncoder()
+
 
 def parse_csv(csv, as_ints=False):
     """
@@ -30,13 +39,34 @@ def str_to_bool(text):
     return text and text.lower() in ['true', 'y', 'yes', '1']
 
 
-def json_encode(data):
+def json_encode(data, primitives_only=False):
     """
-    Encodes the given primitives as JSON using Django's encoder which can handle dates
+    Encodes the given data as JSON. If the data only contains JSON primitives, e.g. dates have already been formatted
+    with format_json_datetime, then it's encoded with ujson if that's installed. Otherwise Django's encoder is used
+    which can handle dates.
     """
+    if primitives_only and ujson:
+        return ujson.dumps(data)
+
     return json.dumps(data, cls=DjangoJSONEncoder)
 
 
+def format_json_datetime(dt):
+    """
+    Formats a datetime as Django's JSON encoder would, so that it only needs to be formatted once
+    """
+    return _django_encoder.default(dt) if dt else None
+
+
+class PrimitivesJsonResponse(JsonResponse):
+    """
+    JSON response for data which only contains JSON primitives, which can use the fastest available encoder
+    """
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super(JsonResponse, self).__init__(content=json_encode(data, primitives_only=True), **kwargs)
+
+
 def safe_max(*args, **kwargs):
     """
     Regular max won't compare dates with NoneType and raises exception for no args
@@ -68,6 +98,58 @@ def match_keywords(text, keywords):
     return False
 
 
+class KeywordMatcher(object):
+    """
+    Matches text against the keywords of many items at once. All keywords are compiled into a single regular
+    expression so that text can be checked for every item in one pass.
+    """
+    def __init__(self, item_keywords):
+        """
+        Builds a matcher from an iterable of (item, keywords) pairs
+        """
+        self.items_by_keyword = defaultdict(set)
+        for item, keywords in item_keywords:
+            for keyword in keywords:
+                self.items_by_keyword[keyword.lower()].add(item)
+
+        # a regex alternation only reports one keyword per position, so we try longest keywords first and then also
+        # include any shorter keywords which are whole-word prefixes of the one matched, e.g. "little" for "little lamb"
+        keywords = sorted(self.items_by_keyword.keys(), key=len, reverse=True)
+
+        self.prefix_keywords = {}
+        for keyword in keywords:
+            self.prefix_keywords[keyword] = [k for k in keywords
+                                             if len(k) < len(keyword) and keyword.startswith(k)
+                                             and not self._is_word_char(keyword[len(k)])]
+
+        if keywords:
+            alternation = '|'.join([re.escape(k) for k in keywords])
+            self.regex = re.compile(r'\b(?=(%s)\b)' % alternation, flags=re.IGNORECASE)
+        else:
+            self.regex = None
+
+    @staticmethod
+    def _is_word_char(char):
+        return char.isalnum() or char == '_'
+
+    def match(self, text):
+        """
+        Gets the set of items with at least one keyword match in the given text
+        """
+        matches = set()
+        if not self.regex:
+            return matches
+
+        matched_keywords = set(m.group(1).lower() for m in self.regex.finditer(text))
+
+        for keyword in matched_keywords:
+            matches.update(self.items_by_keyword[keyword])
+            for prefix in self.prefix_keywords[keyword]:
+                matches.update(self.items_by_keyword[prefix])
+
+        return matches
+
+
 def truncate(text, length=100, suffix='...'):
     """
     Truncates the given text to be no longer than the given length
@@ -0,0 +1,48 @@
+from __future__ import absolute_import, unicode_literals
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from optparse import make_option
+from temba_client.types import Message as TembaMessage
+from casepro.cases import json_encode, ujson
+from casepro.cases.models import Label, Message
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', action='store', type='int', dest='repeat', default=5,
+                    help='Number of times to encode each page'),
+    )
+
+    help = 'Compares JSON encoding throughput for pages of 1,000 and 10,000 messages'
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        label_map = {"AIDS": Label(pk=1, name="AIDS"), "Pregnancy": Label(pk=2, name="Pregnancy")}
+        now = timezone.now()
+
+        for size in (1000, 10000):
+            messages = [TembaMessage.create(id=m, contact='C-%05d' % m, urn='tel:+250788%06d' % m, created_on=now,
+                                            text="Hello, is this where I can ask about AIDS?", labels=["AIDS"],
+                                            direction='I', archived=False) for m in range(size)]
+
+            page = {'results': [Message.as_json(m, label_map) for m in messages], 'has_more': True, 'total': size}
+
+            # how pages were encoded before dates were formatted ahead of encoding
+            unformatted = dict(page, results=[dict(r, time=now) for r in page['results']])
+
+            encoders = [("Django encoder, unformatted dates", lambda: json_encode(unformatted)),
+                        ("Django encoder", lambda: json_encode(page))]
+            if ujson:
+                encoders.append(("ujson", lambda: json_encode(page, primitives_only=True)))
+
+            for name, encode in encoders:
+                start = time.time()
+                for r in range(repeat):
+                    encode()
+                duration = (time.time() - start) / repeat
+
+                self.stdout.write("%d messages, %s: %.1f ms (%d messages/sec)"
+                                  % (size, name, duration * 1000, size / duration))
@@ -39,20 +39,9 @@ class Command(BaseCommand):
 
         self.stdout.write('Fetching unsolicited messages for org %s since %s...' % (org.name, since.strftime('%b %d, %Y %H:%M')))
 
-        client = org.get_temba_client()
+        # grab and process all un-processed unsolicited messages
+        counts = Message.process_all_unsolicited(org, direction='I', _types=['I'], statuses=['H'],
+                                                 archived=False, after=since, before=now)
 
-        num_messages = 0
-        num_labelled = 0
-
-        # grab all un-processed unsolicited messages
-        pager = client.pager()
-        while True:
-            messages = client.get_messages(direction='I', _types=['I'], statuses=['H'], archived=False,
-                                           after=since, before=now, pager=pager)
-            num_messages += len(messages)
-            num_labelled += Message.process_unsolicited(org, messages)
-
-            if not pager.has_more():
-                break
-
-        self.stdout.write("Processed %d new unsolicited messages and labelled %d" % (num_messages, num_labelled))
+        self.stdout.write("Processed %d new unsolicited messages and labelled %d (%d API calls, %d saved by buffering)"
+                          % (counts['messages'], counts['labelled'], counts['api_calls'], counts['api_calls_saved']))
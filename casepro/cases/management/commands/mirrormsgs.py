@@ -0,0 +1,44 @@
+from __future__ import absolute_import, unicode_literals
+
+from dash.orgs.models import Org
+from dateutil.relativedelta import relativedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from optparse import make_option
+from casepro.cases.models import Message, MessageSyncCursor
+
+
+class Command(BaseCommand):
+    args = "org_id [options]"
+    option_list = BaseCommand.option_list + (
+        make_option('--days', action='store', type='int', dest='days', default=0,
+                    help='Maximum age of messages to mirror in days'),
+        make_option('--weeks', action='store', type='int', dest='weeks', default=0,
+                    help='Maximum age of messages to mirror in weeks'),
+    )
+
+    help = 'Creates or updates local copies of the incoming messages in an org which have already been processed'
+
+    def handle(self, *args, **options):
+        org_id = int(args[0]) if args else None
+        if not org_id:
+            raise CommandError("Most provide valid org id")
+
+        try:
+            org = Org.objects.get(pk=org_id)
+        except Org.DoesNotExist:
+            raise CommandError("No such org with id %d" % org_id)
+
+        cursor = MessageSyncCursor.get_for_org(org)
+        if cursor.last_msg_on is None:
+            raise CommandError("Org %s has no processed messages to mirror" % org.name)
+
+        days, weeks = options['days'], options['weeks']
+        since = timezone.now() - relativedelta(days=days, weeks=weeks) if (days or weeks) else None
+
+        self.stdout.write('Fetching incoming messages for org %s processed before %s...'
+                          % (org.name, cursor.last_msg_on.strftime('%b %d, %Y %H:%M')))
+
+        num_mirrored = Message.mirror_all(org, after=since)
+
+        self.stdout.write("Mirrored %d incoming messages" % num_mirrored)
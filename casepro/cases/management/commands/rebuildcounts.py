@@ -0,0 +1,26 @@
+from __future__ import absolute_import, unicode_literals
+
+from dash.orgs.models import Org
+from django.core.management.base import BaseCommand, CommandError
+from casepro.cases.models import CaseCount
+
+
+class Command(BaseCommand):
+    args = "[org_id]"
+
+    help = 'Rebuilds case counts from scratch for one or all orgs'
+
+    def handle(self, *args, **options):
+        if args:
+            org_id = int(args[0])
+            try:
+                orgs = [Org.objects.get(pk=org_id)]
+            except Org.DoesNotExist:
+                raise CommandError("No such org with id %d" % org_id)
+        else:
+            orgs = Org.objects.filter(is_active=True)
+
+        for org in orgs:
+            CaseCount.rebuild(org)
+
+            self.stdout.write("Rebuilt case counts for org %s" % org.name)
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.contrib.postgres.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orgs', '0008_org_timezone'),
+        ('cases', '0017_outgoing_text'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Message',
+            fields=[
+                ('id', models.IntegerField(help_text='The RapidPro id of this message', serialize=False, primary_key=True)),
+                ('contact', models.CharField(help_text='The UUID of the contact', max_length=36)),
+                ('urn', models.CharField(max_length=255, null=True)),
+                ('text', models.TextField()),
+                ('labels', django.contrib.postgres.fields.ArrayField(help_text='Names of labels including system labels', base_field=models.CharField(max_length=64), size=None)),
+                ('type', models.CharField(max_length=1, null=True)),
+                ('direction', models.CharField(max_length=1)),
+                ('archived', models.BooleanField(default=False)),
+                ('broadcast', models.IntegerField(null=True)),
+                ('created_on', models.DateTimeField()),
+                ('org', models.ForeignKey(related_name='messages', verbose_name='Organization', to='orgs.Org')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='message',
+            index_together=set([('org', 'created_on')]),
+        ),
+    ]
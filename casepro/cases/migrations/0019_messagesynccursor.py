@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orgs', '0008_org_timezone'),
+        ('cases', '0018_message'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageSyncCursor',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('last_msg_id', models.IntegerField(help_text='The RapidPro id of the newest processed message', null=True)),
+                ('last_msg_on', models.DateTimeField(help_text='When the newest processed message was created', null=True)),
+                ('updated_on', models.DateTimeField(auto_now=True)),
+                ('org', models.OneToOneField(related_name='message_sync_cursor', verbose_name='Organization', to='orgs.Org')),
+            ],
+        ),
+    ]
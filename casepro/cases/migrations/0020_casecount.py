@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orgs', '0008_org_timezone'),
+        ('cases', '0019_messagesynccursor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CaseCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('item_type', models.CharField(max_length=1)),
+                ('item_id', models.IntegerField(help_text='The partner or label id, or zero for org counts')),
+                ('state', models.CharField(max_length=1)),
+                ('count', models.IntegerField(default=0)),
+                ('org', models.ForeignKey(related_name='case_counts', verbose_name='Organization', to='orgs.Org')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='casecount',
+            unique_together=set([('org', 'item_type', 'item_id', 'state')]),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Q, Count
+
+TYPE_ORG = 'O'
+TYPE_PARTNER = 'P'
+TYPE_LABEL = 'L'
+
+STATE_OPEN = 'O'
+STATE_CLOSED = 'C'
+
+
+def populate_case_counts(apps, schema_editor):
+    Org = apps.get_model('orgs', 'Org')
+    Partner = apps.get_model('cases', 'Partner')
+    Case = apps.get_model('cases', 'Case')
+    CaseCount = apps.get_model('cases', 'CaseCount')
+
+    for org in Org.objects.all():
+        cases = Case.objects.filter(org=org)
+        by_state = {STATE_OPEN: cases.filter(closed_on=None), STATE_CLOSED: cases.exclude(closed_on=None)}
+
+        counts = []
+        for state, state_cases in by_state.iteritems():
+            counts.append(CaseCount(org=org, item_type=TYPE_ORG, item_id=0, state=state, count=state_cases.count()))
+
+            for partner in Partner.objects.filter(org=org):
+                labels = partner.labels.filter(is_active=True)
+                visible = state_cases.filter(Q(labels__in=labels) | Q(assignee=partner)).distinct()
+                counts.append(CaseCount(org=org, item_type=TYPE_PARTNER, item_id=partner.pk, state=state,
+                                        count=visible.count()))
+
+            for label_id, count in state_cases.values_list('labels').annotate(count=Count('pk')):
+                if label_id is not None:
+                    counts.append(CaseCount(org=org, item_type=TYPE_LABEL, item_id=label_id, state=state,
+                                            count=count))
+
+        CaseCount.objects.filter(org=org).delete()
+        CaseCount.objects.bulk_create(counts)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0020_casecount'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_case_counts)
+    ]
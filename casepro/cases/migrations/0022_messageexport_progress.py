@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+def mark_existing_complete(apps, schema_editor):
+    MessageExport = apps.get_model('cases', 'MessageExport')
+
+    # exports made before progress tracking were finished if they have a file
+    MessageExport.objects.exclude(filename='').update(status='C', pages_complete=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0021_populate_case_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messageexport',
+            name='num_parts',
+            field=models.IntegerField(default=0, help_text='Number of part files written so far'),
+        ),
+        migrations.AddField(
+            model_name='messageexport',
+            name='pages_complete',
+            field=models.BooleanField(default=False, help_text='Whether all pages have been exported'),
+        ),
+        migrations.AddField(
+            model_name='messageexport',
+            name='pages_done',
+            field=models.IntegerField(default=0, help_text='Number of pages of messages exported so far'),
+        ),
+        migrations.AddField(
+            model_name='messageexport',
+            name='rows_done',
+            field=models.IntegerField(default=0, help_text='Number of messages exported so far'),
+        ),
+        migrations.AddField(
+            model_name='messageexport',
+            name='status',
+            field=models.CharField(default='P', max_length=1, choices=[('P', 'Pending'), ('E', 'Exporting'), ('C', 'Complete'), ('F', 'Failed')]),
+        ),
+        migrations.AddField(
+            model_name='messageexport',
+            name='total_rows',
+            field=models.IntegerField(help_text='Total number of messages to be exported, if known', null=True),
+        ),
+        migrations.AddField(
+            model_name='messageexport',
+            name='updated_on',
+            field=models.DateTimeField(default=django.utils.timezone.now, auto_now=True),
+            preserve_default=False,
+        ),
+        migrations.RunPython(mark_existing_complete),
+    ]
@@ -1,34 +1,118 @@
 from __future__ import absolute_import, unicode_literals
 
+import codecs
+import csv
+import hashlib
 import json
+import math
 import pytz
 import re
+import shutil
+import threading
+import time
 
+from collections import defaultdict
+from contextlib import contextmanager
 from dash.orgs.models import Org
 from dash.utils import random_string, chunks, intersection
 from datetime import timedelta
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.postgres.fields import ArrayField
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
 from django.core.files import File
 from django.core.files.storage import default_storage
 from django.core.files.temp import NamedTemporaryFile
 from django.core.urlresolvers import reverse
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction, IntegrityError
+from django.db.models import Q, F, Count, Prefetch
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from enum import IntEnum
 from redis_cache import get_redis_connection
-from temba_client.base import TembaNoSuchObjectError, TembaException
+from multiprocessing.pool import ThreadPool
+from requests import HTTPError
+from temba_client.base import TembaNoSuchObjectError, TembaException, TembaAPIError, TembaConnectionError
+from temba_client.types import Contact as TembaContact
+from temba_client.utils import format_iso8601, parse_iso8601
 from casepro.email import send_email
-from . import parse_csv, normalize, match_keywords, SYSTEM_LABEL_FLAGGED
+from casepro.orgs_ext import ORG_CACHE_TTL
+from . import parse_csv, json_encode, format_json_datetime, normalize, safe_max, KeywordMatcher, SYSTEM_LABEL_FLAGGED
+from .push import publish, EventType
+from .utils import datetime_to_microseconds, microseconds_to_datetime, prefetch, BoundedThreadPool, LRUCache, RateLimiter
 
 
 # only show unlabelled messages newer than 2 weeks
 DEFAULT_UNLABELLED_LIMIT_DAYS = 14
 
+LABEL_INDEX_CACHE_KEY = 'org:%d:label_index'
+LABEL_INDEX_VERSION_CACHE_KEY = 'org:%d:label_index_version'
+
+HOME_DATA_CACHE_KEY = 'org:%d:home_data:%s:%s'
+HOME_DATA_VERSION_CACHE_KEY = 'org:%d:home_data_version'
+
+CASE_TIMELINE_CACHE_KEY = 'case:%d:timeline'
+CASE_TIMELINE_CACHE_TTL = 60 * 60  # 1 hour
+CASE_TIMELINE_LOCK_TIMEOUT = 60
+
+# message search results are shared between users for a short time. Time bounds are widened to window boundaries so
+# that polls from different inboxes made within the same window can share results.
+MESSAGE_SEARCH_CACHE_KEY = 'org:%d:message_search:%s:%s'
+MESSAGE_SEARCH_VERSION_CACHE_KEY = 'org:%d:message_search_version'
+MESSAGE_SEARCH_CACHE_TTL = 30
+MESSAGE_SEARCH_CACHE_WINDOW = 10  # seconds
+MESSAGE_SEARCH_LOCK_TIMEOUT = 60
+
+# how many pages of unsolicited messages to fetch ahead of processing, and how many worker threads make the resulting
+# label and archive calls
+UNSOLICITED_PREFETCH_PAGES = 2
+UNSOLICITED_WRITE_WORKERS = 4
+UNSOLICITED_MAX_PENDING_WRITES = 8
+
+# how many pages of unsolicited messages to process between checkpoints, when writes are waited for and processed
+# messages are recorded
+UNSOLICITED_CHECKPOINT_PAGES = 10
+
+# page size when serving message searches from local copies
+LOCAL_MESSAGE_PAGE_SIZE = 50
+
+# contacts are fetched from RapidPro in batches by a pool of worker threads, subject to a rate limit, and failed fetches
+# are retried with exponential backoff. The number of workers and rate limit can be overridden in settings.
+CONTACT_FETCH_BATCH_SIZE = 25
+CONTACT_FETCH_WORKERS = 4
+CONTACT_FETCH_MAX_PER_SECOND = 10
+CONTACT_FETCH_MAX_RETRIES = 3
+CONTACT_FETCH_RETRY_DELAY = 1  # seconds, doubled after each retry
+
+CONTACT_CACHE_KEY = 'org:%d:contact:%s'
+CONTACT_CACHE_TTL = 5 * 60  # 5 minutes
+CONTACT_CACHE_STATS_KEY = 'org:%d:contact_cache_stats'
+
+# cases are opened under a lock for their contact, so that cases for different contacts can be opened concurrently
+CASE_CONTACT_LOCK_KEY = 'org:%d:contact:%s:case_lock'
+CASE_CONTACT_LOCK_TIMEOUT = 60
+
+# columns of message exports before any contact fields, and how many contacts to keep in memory whilst exporting
+MESSAGE_EXPORT_BASE_FIELDS = ["Time", "Message ID", "Flagged", "Labels", "Text", "Contact"]
+MESSAGE_EXPORT_CONTACT_CACHE_SIZE = 1000
+
+# how many pages of messages are exported by each chunk of an export
+MESSAGE_EXPORT_CHUNK_PAGES = 20
+
+# chunks are exported under a lock for their export, so that a redelivered task can't export the same chunk again
+MESSAGE_EXPORT_LOCK_KEY = 'message_export:%d:lock'
+MESSAGE_EXPORT_LOCK_TIMEOUT = 15 * 60
+
+# maximum number of messages that RapidPro will accept in a single label or archive call
+MESSAGE_WRITE_BATCH_SIZE = 100
+
+# maximum time in seconds that buffered label and archive calls are held before being made
+MESSAGE_WRITE_MAX_AGE = 30
+
+# label indexes by org id, re-used in this process for as long as their version is current
+_label_indexes = {}
+
 
 class AccessLevel(IntEnum):
     """
@@ -54,7 +138,11 @@ class Group(models.Model):
 
     @classmethod
     def create(cls, org, name, uuid):
-        return cls.objects.create(org=org, name=name, uuid=uuid)
+        group = cls.objects.create(org=org, name=name, uuid=uuid)
+
+        HomeData.invalidate(org)
+
+        return group
 
     @classmethod
     def get_all(cls, org):
@@ -92,6 +180,8 @@ class Group(models.Model):
             else:
                 cls.create(org, group_names[group_uuid], group_uuid)
 
+        HomeData.invalidate(org)
+
     def as_json(self):
         return {'id': self.pk, 'name': self.name, 'uuid': self.uuid}
 
@@ -101,8 +191,19 @@ class Group(models.Model):
 
 class MessageExport(models.Model):
     """
-    An export of messages
+    An export of messages. Exports are done in chunks of pages, each of which is written to a part file and recorded
+    as progress, so that an interrupted export can be resumed from its last completed chunk.
     """
+    STATUS_PENDING = 'P'
+    STATUS_EXPORTING = 'E'
+    STATUS_COMPLETE = 'C'
+    STATUS_FAILED = 'F'
+
+    STATUS_CHOICES = ((STATUS_PENDING, _("Pending")),
+                      (STATUS_EXPORTING, _("Exporting")),
+                      (STATUS_COMPLETE, _("Complete")),
+                      (STATUS_FAILED, _("Failed")))
+
     org = models.ForeignKey(Org, verbose_name=_("Organization"), related_name='exports')
 
     search = models.TextField()
@@ -113,103 +214,202 @@ class MessageExport(models.Model):
 
     created_on = models.DateTimeField(auto_now_add=True)
 
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=STATUS_PENDING)
+
+    pages_done = models.IntegerField(default=0, help_text=_("Number of pages of messages exported so far"))
+
+    rows_done = models.IntegerField(default=0, help_text=_("Number of messages exported so far"))
+
+    total_rows = models.IntegerField(null=True, help_text=_("Total number of messages to be exported, if known"))
+
+    num_parts = models.IntegerField(default=0, help_text=_("Number of part files written so far"))
+
+    pages_complete = models.BooleanField(default=False, help_text=_("Whether all pages have been exported"))
+
+    updated_on = models.DateTimeField(auto_now=True)
+
     @classmethod
     def create(cls, org, user, search):
+        # fix the end of the search so that pages don't shift as new messages arrive during the export
+        after, before = search['after'], search['before'] or timezone.now()
+        search = dict(search, after=format_iso8601(after) if after else None, before=format_iso8601(before))
+
         return MessageExport.objects.create(org=org, created_by=user, search=json.dumps(search))
 
     def get_search(self):
-        return json.loads(self.search)
+        search = json.loads(self.search)
+        search['after'] = parse_iso8601(search['after'])
+        search['before'] = parse_iso8601(search['before'])
+        return search
+
+    def is_finished(self):
+        return self.status == MessageExport.STATUS_COMPLETE
+
+    def export_chunk(self):
+        """
+        Exports the next chunk of pages of messages to a part file and records progress. Once all pages have been
+        exported, the part files are combined into the final export. Messages are written out as CSV rows as they
+        arrive, and contacts are kept in a bounded cache, so memory use doesn't grow with the size of the export.
+        Returns a dict of counts. If this fails, it can be re-run to resume from the last completed chunk.
+        """
+        self.status = MessageExport.STATUS_EXPORTING
+        self.save(update_fields=('status', 'updated_on'))
+
+        counts = self._export_pages() if not self.pages_complete else {}
+        if self.pages_complete:
+            self._combine_parts()
 
-    def do_export(self):
+        return counts
+
+    def fail(self):
         """
-        Does actual export. Called from a celery task as it may require a lot of API calls to grab all messages.
+        Marks this export as failed, and notifies the user
         """
-        from xlwt import Workbook, XFStyle
-        book = Workbook()
+        self.status = MessageExport.STATUS_FAILED
+        self.save(update_fields=('status', 'updated_on'))
+
+        subject = "Your messages export failed"
+        read_url = settings.SITE_HOST_PATTERN % self.org.subdomain + reverse('cases.messageexport_read', args=[self.pk])
 
-        date_style = XFStyle()
-        date_style.num_format_str = 'DD-MM-YYYY HH:MM:SS'
+        send_email(self.created_by.username, subject, 'cases/email/message_export_failed', dict(link=read_url))
 
-        base_fields = ["Time", "Message ID", "Flagged", "Labels", "Text", "Contact"]
+    def _export_pages(self):
         contact_fields = self.org.get_contact_fields()
-        all_fields = base_fields + contact_fields
-        label_map = {l.name: l for l in Label.get_all(self.org)}
+        label_map = LabelIndex.get(self.org).by_name
 
         client = self.org.get_temba_client()
         search = self.get_search()
+        fetcher = ContactFetcher(self.org)
+        contact_cache = ContactCache(self.org, fetcher)
+        contacts = LRUCache(MESSAGE_EXPORT_CONTACT_CACHE_SIZE)
+
+        def resolve_contacts(messages):
+            # get contacts which aren't already in memory, remembering ones which no longer exist in RapidPro so we
+            # don't keep asking for them
+            uuids = []
+            for msg in messages:
+                if msg.contact not in contacts and msg.contact not in uuids:
+                    uuids.append(msg.contact)
+
+            fetched = contact_cache.get_many(uuids)
+            for uuid in uuids:
+                contacts.put(uuid, fetched.get(uuid))
 
-        # fetch all messages to be exported
-        messages = Message.search(self.org, search, None)
+        temp = NamedTemporaryFile(delete=True)
+        writer = csv.writer(temp)
+        num_pages, num_rows = 0, 0
+        total_rows = self.total_rows
+        pages_complete = False
 
-        # extract all unique contacts in those messages
-        contact_uuids = set()
-        for msg in messages:
-            contact_uuids.add(msg.contact)
-
-        # fetch all contacts in batches of 25 and organize by UUID
-        contacts_by_uuid = {}
-        for uuid_chunk in chunks(list(contact_uuids), 25):
-            for contact in client.get_contacts(uuids=uuid_chunk):
-                contacts_by_uuid[contact.uuid] = contact
-
-        def add_sheet(num):
-            sheet = book.add_sheet(unicode(_("Messages %d" % num)))
-            for col in range(len(all_fields)):
-                field = all_fields[col]
-                sheet.write(0, col, unicode(field))
-            return sheet
-
-        # even if there are no messages - still add a sheet
-        if not messages:
-            add_sheet(1)
-        else:
-            sheet_number = 1
-            for msg_chunk in chunks(messages, 65535):
-                current_sheet = add_sheet(sheet_number)
+        try:
+            while num_pages < MESSAGE_EXPORT_CHUNK_PAGES:
+                pager = client.pager(start_page=self.pages_done + num_pages + 1)
+                messages = Message.search(self.org, search, pager)
+                num_pages += 1
+
+                if pager.total is not None:
+                    total_rows = pager.total
 
-                row = 1
-                for msg in msg_chunk:
-                    created_on = msg.created_on.astimezone(pytz.utc).replace(tzinfo=None)
+                resolve_contacts(messages)
+
+                for msg in messages:
+                    created_on = msg.created_on.astimezone(pytz.utc).strftime('%d-%m-%Y %H:%M:%S')
                     flagged = SYSTEM_LABEL_FLAGGED in msg.labels
                     labels = ', '.join([label_map[l_name].name for l_name in msg.labels if l_name in label_map])
-                    contact = contacts_by_uuid.get(msg.contact, None)  # contact may no longer exist in RapidPro
+                    contact = contacts.get(msg.contact)  # contact may no longer exist in RapidPro
+
+                    row = [created_on, msg.id, 'Yes' if flagged else 'No', labels, msg.text, msg.contact]
+                    row += [contact.fields.get(f, None) if contact else None for f in contact_fields]
 
-                    current_sheet.write(row, 0, created_on, date_style)
-                    current_sheet.write(row, 1, msg.id)
-                    current_sheet.write(row, 2, 'Yes' if flagged else 'No')
-                    current_sheet.write(row, 3, labels)
-                    current_sheet.write(row, 4, msg.text)
-                    current_sheet.write(row, 5, msg.contact)
+                    writer.writerow([self._encode(v) for v in row])
 
-                    for cf in range(len(contact_fields)):
-                        if contact:
-                            contact_field = contact_fields[cf]
-                            current_sheet.write(row, 6 + cf, contact.fields.get(contact_field, None))
-                        else:
-                            current_sheet.write(row, 6 + cf, None)
+                num_rows += len(messages)
 
-                    row += 1
+                if not messages or not pager.has_more():
+                    pages_complete = True
+                    break
+        finally:
+            fetcher.close()
 
-                sheet_number += 1
+        temp.flush()
+
+        # write the part file before recording progress, so that if we're interrupted the chunk is just redone
+        if num_rows:
+            self._save_file(self._get_part_filename(self.num_parts + 1), temp)
+            self.num_parts += 1
+
+        self.pages_done += num_pages
+        self.rows_done += num_rows
+        self.total_rows = total_rows
+        self.pages_complete = pages_complete
+        self.save(update_fields=('pages_done', 'rows_done', 'total_rows', 'num_parts', 'pages_complete', 'updated_on'))
+
+        return {'messages': num_rows,
+                'pages': num_pages,
+                'contact_cache_hits': contact_cache.num_hits,
+                'contact_cache_misses': contact_cache.num_misses,
+                'contact_calls': fetcher.num_calls,
+                'contact_retries': fetcher.num_retries,
+                'contact_time': fetcher.time_taken}
+
+    def _combine_parts(self):
+        """
+        Combines the part files into the final export file, and notifies the user that it's ready
+        """
+        contact_fields = self.org.get_contact_fields()
 
         temp = NamedTemporaryFile(delete=True)
-        book.save(temp)
+        temp.write(codecs.BOM_UTF8)  # so that Excel recognizes the encoding
+
+        writer = csv.writer(temp)
+        writer.writerow([self._encode(f) for f in MESSAGE_EXPORT_BASE_FIELDS + contact_fields])
+
+        for part in range(1, self.num_parts + 1):
+            with default_storage.open(self._get_part_filename(part), 'rb') as part_file:
+                shutil.copyfileobj(part_file, temp)
+
         temp.flush()
 
-        filename = 'orgs/%d/message_exports/%s.xls' % (self.org.id, random_string(20))
+        filename = 'orgs/%d/message_exports/%s.csv' % (self.org.id, random_string(20))
         default_storage.save(filename, File(temp))
 
         self.filename = filename
-        self.save(update_fields=('filename',))
+        self.status = MessageExport.STATUS_COMPLETE
+        self.save(update_fields=('filename', 'status', 'updated_on'))
+
+        for part in range(1, self.num_parts + 1):
+            default_storage.delete(self._get_part_filename(part))
 
         subject = "Your messages export is ready"
         download_url = settings.SITE_HOST_PATTERN % self.org.subdomain + reverse('cases.messageexport_read', args=[self.pk])
 
         send_email(self.created_by.username, subject, 'cases/email/message_export', dict(link=download_url))
 
-        # force a gc
-        import gc
-        gc.collect()
+    def _get_part_filename(self, part):
+        return 'orgs/%d/message_exports/%d/part-%d.csv' % (self.org.id, self.pk, part)
+
+    @staticmethod
+    def _save_file(filename, temp):
+        # part files may have been left behind by an interrupted chunk, and we don't want the storage to rename ours
+        if default_storage.exists(filename):
+            default_storage.delete(filename)
+
+        default_storage.save(filename, File(temp))
+
+    @staticmethod
+    def _encode(value):
+        if value is None:
+            return b''
+        return unicode(value).encode('utf-8')
+
+    def as_json(self):
+        return {'id': self.pk,
+                'status': unicode(self.get_status_display()),
+                'complete': self.status == MessageExport.STATUS_COMPLETE,
+                'failed': self.status == MessageExport.STATUS_FAILED,
+                'pages_done': self.pages_done,
+                'rows_done': self.rows_done,
+                'total_rows': self.total_rows}
 
 
 class Partner(models.Model):
@@ -227,7 +427,11 @@ class Partner(models.Model):
 
     @classmethod
     def create(cls, org, name, logo):
-        return cls.objects.create(org=org, name=name, logo=logo)
+        partner = cls.objects.create(org=org, name=name, logo=logo)
+
+        HomeData.invalidate(org)
+
+        return partner
 
     @classmethod
     def get_all(cls, org):
@@ -252,6 +456,8 @@ class Partner(models.Model):
         self.is_active = False
         self.save(update_fields=('is_active',))
 
+        HomeData.invalidate(self.org)
+
     def as_json(self):
         return {'id': self.pk, 'name': self.name}
 
@@ -290,6 +496,9 @@ class Label(models.Model):
                                    keywords=','.join(keywords))
         label.partners.add(*partners)
 
+        LabelIndex.invalidate(org)
+        HomeData.invalidate(org)
+
         return label
 
     @classmethod
@@ -311,6 +520,13 @@ class Label(models.Model):
         partner = user.get_partner()
         return partner.get_labels() if partner else cls.objects.none()
 
+    @classmethod
+    def get_keyword_matcher(cls, org):
+        """
+        Gets a keyword matcher for all active labels in the given org
+        """
+        return LabelIndex.get(org).matcher
+
     def update_name(self, name):
         # try to update remote label
         try:
@@ -329,10 +545,23 @@ class Label(models.Model):
     def get_partners(self):
         return self.partners.filter(is_active=True)
 
+    def save(self, *args, **kwargs):
+        super(Label, self).save(*args, **kwargs)
+
+        # index includes names and keywords so any saved change could affect it. Changes to partners are saved
+        # separately and still need to invalidate it themselves.
+        LabelIndex.invalidate(self.org)
+
     def release(self):
         self.is_active = False
         self.save(update_fields=('is_active',))
 
+        HomeData.invalidate(self.org)
+
+        # partners can no longer see cases through this label
+        if self.get_partners().exists():
+            CaseCount.rebuild_in_background(self.org)
+
     def as_json(self):
         return {'id': self.pk, 'name': self.name, 'count': getattr(self, 'count', None)}
 
@@ -344,6 +573,148 @@ class Label(models.Model):
         return self.name
 
 
+class LabelIndex(object):
+    """
+    Cached index of an org's active labels with their keywords and partner visibility. It's stored in Redis so that
+    it's shared between processes, and kept in memory for as long as its version stamp in Redis doesn't change.
+    """
+    def __init__(self, org, version, items):
+        self.org = org
+        self.version = version
+        self.labels = []
+        self.partner_ids = {}
+
+        for item in items:
+            label = Label(pk=item['id'], org=org, uuid=item['uuid'], name=item['name'], keywords=item['keywords'])
+            self.labels.append(label)
+            self.partner_ids[label.pk] = set(item['partners'])
+
+        self.by_name = {l.name: l for l in self.labels}
+
+        self._matcher = None
+
+    @classmethod
+    def get(cls, org):
+        """
+        Gets the label index for the given org, only rebuilding it from the database if it has been invalidated
+        """
+        version = cache.get(LABEL_INDEX_VERSION_CACHE_KEY % org.pk)
+
+        local = _label_indexes.get(org.pk)
+        if version and local and local.version == version:
+            return local
+
+        cached = cache.get(LABEL_INDEX_CACHE_KEY % org.pk) if version else None
+        cached = json.loads(cached) if cached else None
+
+        if cached and cached['version'] == version:
+            index = cls(org, version, cached['labels'])
+        else:
+            if not version:
+                version = random_string(16)
+                cache.set(LABEL_INDEX_VERSION_CACHE_KEY % org.pk, version, ORG_CACHE_TTL)
+
+            index = cls.build(org, version)
+
+        _label_indexes[org.pk] = index
+        return index
+
+    @classmethod
+    def build(cls, org, version):
+        labels = Label.get_all(org).prefetch_related('partners').order_by('name')
+
+        items = [{'id': l.pk,
+                  'uuid': l.uuid,
+                  'name': l.name,
+                  'keywords': l.keywords,
+                  'partners': [p.pk for p in l.partners.all()]} for l in labels]
+
+        cache.set(LABEL_INDEX_CACHE_KEY % org.pk, json.dumps({'version': version, 'labels': items}), ORG_CACHE_TTL)
+
+        return cls(org, version, items)
+
+    @classmethod
+    def invalidate(cls, org):
+        """
+        Invalidates the label index for the given org. Should be called whenever an org's labels are changed.
+        """
+        cache.set(LABEL_INDEX_VERSION_CACHE_KEY % org.pk, random_string(16), ORG_CACHE_TTL)
+
+    def get_all(self, user=None):
+        """
+        Gets the labels visible to the given user, ordered by name
+        """
+        if not user or user.can_administer(self.org):
+            return self.labels
+
+        partner = user.get_partner()
+        if not partner:
+            return []
+
+        return [l for l in self.labels if partner.pk in self.partner_ids[l.pk]]
+
+    @property
+    def matcher(self):
+        if not self._matcher:
+            self._matcher = KeywordMatcher([(l, l.get_keywords()) for l in self.labels])
+        return self._matcher
+
+
+class HomeData(object):
+    """
+    Cached data used to bootstrap the home views, i.e. the partners, labels and groups visible to an administrator or
+    to each partner. Its version is changed whenever any of an org's partners, labels or groups are changed.
+    """
+    @classmethod
+    def get_version(cls, org):
+        version = cache.get(HOME_DATA_VERSION_CACHE_KEY % org.pk)
+        if not version:
+            version = random_string(16)
+            cache.set(HOME_DATA_VERSION_CACHE_KEY % org.pk, version, ORG_CACHE_TTL)
+        return version
+
+    @classmethod
+    def get_json(cls, org, user):
+        """
+        Gets the home data for the given user encoded as JSON
+        """
+        version = cls.get_version(org)
+        partner = user.get_partner()
+
+        if user.can_administer(org):
+            scope = 'admin'
+        else:
+            scope = 'partner-%d' % partner.pk if partner else 'none'
+
+        key = HOME_DATA_CACHE_KEY % (org.pk, version, scope)
+        shared_json = cache.get(key)
+
+        if shared_json is None:
+            labels = LabelIndex.get(org).get_all(user)
+            partners = Partner.get_all(org).order_by('name')
+            groups = Group.get_all(org).order_by('name')
+
+            shared_json = json_encode({
+                'partners': [p.as_json() for p in partners],
+                'labels': [l.as_json() for l in labels],
+                'groups': [g.as_json() for g in groups],
+            })
+            cache.set(key, shared_json, ORG_CACHE_TTL)
+
+        user_json = json_encode({'id': user.pk, 'partner': partner.as_json() if partner else None})
+
+        # splice in the user rather than decoding and re-encoding the shared data
+        return '{"user": %s, %s' % (user_json, shared_json[1:])
+
+    @classmethod
+    def invalidate(cls, org):
+        """
+        Invalidates the home data for the given org. Should be called whenever an org's partners, labels or groups are
+        changed.
+        """
+        cache.set(HOME_DATA_VERSION_CACHE_KEY % org.pk, random_string(16), ORG_CACHE_TTL)
+
+
 class Contact(models.Model):
     """
     Maintains some state for a contact whilst they are in a case
@@ -364,10 +735,14 @@ class Contact(models.Model):
 
     def prepare_for_case(self):
         """
-        Prepares this contact to be put in a case
+        Prepares this contact to be put in a case. Can be repeated if it fails part way through.
         """
-        # suspend contact from groups while case is open
-        self.suspend_groups()
+        # suspend contact from groups while case is open. If a previous attempt recorded the groups to suspend but
+        # failed part way through removing the contact from them, finish that.
+        if self.suspended_groups:
+            self.remove_from_suspended_groups()
+        else:
+            self.suspend_groups()
 
         # expire any active flow runs they have
         self.expire_flows()
@@ -379,20 +754,26 @@ class Contact(models.Model):
         if self.suspended_groups:
             raise ValueError("Can't suspend from groups as contact is already suspended from groups")
 
-        # get current groups from RapidPro
-        temba_contact = self.fetch()
+        # get current groups from RapidPro, rather than the contact cache which may be out of date
+        temba_contact = ContactFetcher(self.org).fetch(self.uuid)
         temba_groups = temba_contact.groups if temba_contact else []
 
         suspend_groups = self.org.get_suspend_groups()
-        remove_groups = intersection(temba_groups, suspend_groups)
 
-        # remove contact from groups
+        # record groups before removing contact from them, so they can still be restored if that fails part way
+        self.suspended_groups = intersection(temba_groups, suspend_groups)
+        self.save(update_fields=('suspended_groups',))
+
+        self.remove_from_suspended_groups()
+
+    def remove_from_suspended_groups(self):
+        # remove contact from groups, which is a no-op for any they've already been removed from
         client = self.org.get_temba_client()
-        for remove_group in remove_groups:
-            client.remove_contacts([self.uuid], group_uuid=remove_group)
+        for suspended_group in self.suspended_groups:
+            client.remove_contacts([self.uuid], group_uuid=suspended_group)
 
-        self.suspended_groups = remove_groups
-        self.save(update_fields=('suspended_groups',))
+        if self.suspended_groups:
+            ContactCache.invalidate(self.org, [self.uuid])
 
     def restore_groups(self):
         # add contact back into suspended groups
@@ -400,6 +781,9 @@ class Contact(models.Model):
         for suspended_group in self.suspended_groups:
             client.add_contacts([self.uuid], group_uuid=suspended_group)
 
+        if self.suspended_groups:
+            ContactCache.invalidate(self.org, [self.uuid])
+
         self.suspended_groups = []
         self.save(update_fields=('suspended_groups',))
 
@@ -407,29 +791,33 @@ class Contact(models.Model):
         client = self.org.get_temba_client()
         client.expire_contacts([self.uuid])
 
+        ContactCache.invalidate(self.org, [self.uuid])
+
     def archive_messages(self):
         client = self.org.get_temba_client()
-        labels = [l.name for l in Label.get_all(self.org)]
+        labels = [l.name for l in LabelIndex.get(self.org).labels]
         messages = client.get_messages(contacts=[self.uuid], labels=labels,
                                        direction='I', statuses=['H'], _types=['I'], archived=False)
         if messages:
-            client.archive_messages(messages=[m.id for m in messages])
+            message_ids = [m.id for m in messages]
+            client.archive_messages(messages=message_ids)
+
+            # keep local copies and cached searches in line with RapidPro
+            Message.update_local(self.org, message_ids, archived=True)
+            MessageSearchCache.invalidate(self.org)
 
-    def fetch(self):
+    def fetch(self, fetcher=None):
         """
-        Fetches this contact from RapidPro
+        Fetches this contact from RapidPro, or the contact cache. Don't use this for anything written back to RapidPro.
         """
-        try:
-            return self.org.get_temba_client().get_contact(self.uuid)
-        except TembaNoSuchObjectError:
-            return None  # always a chance that the contact has been deleted in RapidPro
+        return ContactCache(self.org, fetcher).get(self.uuid)
 
-    def as_json(self, fetch_fields=False):
+    def as_json(self, fetch_fields=False, fetcher=None):
         """
         Prepares a contact for JSON serialization
         """
         if fetch_fields:
-            temba_contact = self.fetch()
+            temba_contact = self.fetch(fetcher)
             temba_fields = temba_contact.fields if temba_contact else {}
 
             allowed_keys = self.org.get_contact_fields()
@@ -440,16 +828,202 @@ class Contact(models.Model):
         return {'uuid': self.uuid, 'fields': fields}
 
 
+class ContactFetcher(object):
+    """
+    Fetches contacts from RapidPro. Batches of contacts are fetched concurrently by a pool of worker threads, calls
+    are rate limited, and failed calls are retried with exponential backoff. Keeps track of the number of calls made
+    and the time spent making them.
+    """
+    def __init__(self, org, num_workers=None, max_per_second=None, max_retries=CONTACT_FETCH_MAX_RETRIES):
+        self.client = org.get_temba_client()
+        self.num_workers = num_workers or getattr(settings, 'CONTACT_FETCH_WORKERS', CONTACT_FETCH_WORKERS)
+        self.limiter = RateLimiter(max_per_second or getattr(settings, 'CONTACT_FETCH_MAX_PER_SECOND',
+                                                             CONTACT_FETCH_MAX_PER_SECOND))
+        self.max_retries = max_retries
+        self.pool = None
+
+        self.stats_lock = threading.Lock()
+        self.num_calls = 0
+        self.num_retries = 0
+        self.time_taken = 0.0
+
+    def fetch(self, uuid):
+        """
+        Fetches a single contact, returning None if it no longer exists
+        """
+        started = time.time()
+        try:
+            return self._call(self.client.get_contact, uuid)
+        except TembaNoSuchObjectError:
+            return None  # always a chance that the contact has been deleted in RapidPro
+        finally:
+            self.time_taken += time.time() - started
+
+    def fetch_many(self, uuids):
+        """
+        Fetches the given contacts, returning a dict of contacts by UUID. Contacts which no longer exist are omitted.
+        """
+        started = time.time()
+
+        def fetch_batch(batch):
+            return self._call(self.client.get_contacts, uuids=batch)
+
+        batches = list(chunks(uuids, CONTACT_FETCH_BATCH_SIZE))
+        if len(batches) > 1 and self.num_workers > 1:
+            if not self.pool:
+                self.pool = ThreadPool(self.num_workers)
+            results = self.pool.map(fetch_batch, batches)
+        else:
+            results = [fetch_batch(batch) for batch in batches]
+
+        self.time_taken += time.time() - started
+
+        return {contact.uuid: contact for result in results for contact in result}
+
+    def close(self):
+        """
+        Shuts down the worker threads if any were started
+        """
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def _call(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.limiter.wait()
+            self._increment_stat('num_calls')
+            try:
+                return func(*args, **kwargs)
+            except TembaException as ex:
+                if attempt >= self.max_retries or not is_retryable_error(ex):
+                    raise
+
+            self._increment_stat('num_retries')
+            time.sleep(CONTACT_FETCH_RETRY_DELAY * 2 ** attempt)
+            attempt += 1
+
+    def _increment_stat(self, name):
+        with self.stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+def is_retryable_error(ex):
+    """
+    Connection errors and server errors from RapidPro are worth retrying, but other API errors won't go away
+    """
+    if isinstance(ex, TembaConnectionError):
+        return True
+    if isinstance(ex, TembaAPIError) and isinstance(ex.caused_by, HTTPError) and ex.caused_by.response is not None:
+        status = ex.caused_by.response.status_code
+        return status >= 500 or status == 429
+    return False
+
+
+class ContactCache(object):
+    """
+    Read-through cache of the names, groups and fields of contacts in RapidPro. Cached contacts expire after a short
+    time, and are invalidated when we change their groups or expire their flow runs. Contacts which no longer exist
+    are cached too so that we don't keep asking for them. Hits and misses are counted for each org.
+    """
+    def __init__(self, org, fetcher=None):
+        self.org = org
+        self.fetcher = fetcher
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def get(self, uuid):
+        """
+        Gets a single contact, returning None if it no longer exists
+        """
+        return self.get_many([uuid]).get(uuid)
+
+    def get_many(self, uuids):
+        """
+        Gets the given contacts, returning a dict of contacts by UUID. Contacts which no longer exist are omitted.
+        """
+        cached = cache.get_many([self._get_key(uuid) for uuid in uuids])
+
+        contacts = {}
+        missing = []
+        for uuid in uuids:
+            value = cached.get(self._get_key(uuid))
+            if value is None:
+                missing.append(uuid)
+            elif value:
+                contacts[uuid] = TembaContact.create(**value)
+
+        if missing:
+            fetched = self._fetch(missing)
+
+            # cache a false value for contacts which no longer exist
+            cache.set_many({self._get_key(uuid): self._serialize(fetched.get(uuid)) for uuid in missing},
+                           timeout=CONTACT_CACHE_TTL)
+
+            contacts.update(fetched)
+
+        self.num_hits += len(uuids) - len(missing)
+        self.num_misses += len(missing)
+        self._record_stats(len(uuids) - len(missing), len(missing))
+
+        return contacts
+
+    def _fetch(self, uuids):
+        fetcher = self.fetcher or ContactFetcher(self.org)
+        try:
+            if len(uuids) == 1:
+                contact = fetcher.fetch(uuids[0])
+                return {contact.uuid: contact} if contact else {}
+            else:
+                return fetcher.fetch_many(uuids)
+        finally:
+            if not self.fetcher:
+                fetcher.close()
+
+    def _get_key(self, uuid):
+        return CONTACT_CACHE_KEY % (self.org.pk, uuid)
+
+    def _record_stats(self, num_hits, num_misses):
+        if not (num_hits or num_misses):
+            return
+
+        pipe = get_redis_connection().pipeline()
+        pipe.hincrby(CONTACT_CACHE_STATS_KEY % self.org.pk, 'hits', num_hits)
+        pipe.hincrby(CONTACT_CACHE_STATS_KEY % self.org.pk, 'misses', num_misses)
+        pipe.execute()
+
+    @staticmethod
+    def _serialize(contact):
+        if not contact:
+            return False
+        return {'uuid': contact.uuid, 'name': contact.name, 'groups': contact.groups, 'fields': contact.fields}
+
+    @classmethod
+    def invalidate(cls, org, uuids):
+        cache.delete_many([CONTACT_CACHE_KEY % (org.pk, uuid) for uuid in uuids])
+
+    @classmethod
+    def get_stats(cls, org):
+        """
+        Gets the total numbers of cache hits and misses for the given org
+        """
+        stats = get_redis_connection().hgetall(CONTACT_CACHE_STATS_KEY % org.pk)
+        return {'hits': int(stats.get(b'hits', 0)), 'misses': int(stats.get(b'misses', 0))}
+
+
 class case_action(object):
     """
-    Helper decorator for case action methods that should check the user is allowed to update the case
+    Helper decorator for case action methods that should check the user is allowed to update the case. The user's
+    CaseAccess can be passed as an access keyword argument, e.g. from CaseAccess.for_request, to avoid loading it again.
     """
     def __init__(self, require_update=True):
         self.require_update = require_update
 
     def __call__(self, func):
         def wrapped(case, user, *args, **kwargs):
-            access = case.access_level(user)
+            case_access = kwargs.pop('access', None) or CaseAccess(case.org, user)
+            access = case_access.get_level(case)
             if (access == AccessLevel.update) or (not self.require_update and access == AccessLevel.read):
                 func(case, user, *args, **kwargs)
             else:
@@ -515,13 +1089,60 @@ class Case(models.Model):
         qs = cls.get_for_contact(org, contact_uuid)
         return qs.filter(opened_on__lt=dt).filter(Q(closed_on=None) | Q(closed_on__gt=dt)).first()
 
+    @classmethod
+    def get_open_for_messages(cls, org, messages):
+        """
+        Gets the cases which were open for the contacts of the given messages at the times they were sent. Uses a
+        single query for all messages and returns a map of message ids to cases.
+        """
+        if not messages:
+            return {}
+
+        contact_uuids = set([m.contact for m in messages])
+        earliest = min([m.created_on for m in messages])
+        latest = max([m.created_on for m in messages])
+
+        # fetch all cases for these contacts which could have been open at any time between these messages
+        cases = cls.objects.filter(org=org, contact__uuid__in=contact_uuids, opened_on__lt=latest)
+        cases = cases.filter(Q(closed_on=None) | Q(closed_on__gt=earliest)).select_related('contact').order_by('pk')
+
+        cases_by_contact = defaultdict(list)
+        for case in cases:
+            cases_by_contact[case.contact.uuid].append(case)
+
+        open_cases = {}
+        for msg in messages:
+            for case in cases_by_contact[msg.contact]:
+                if case.opened_on < msg.created_on and (case.closed_on is None or case.closed_on > msg.created_on):
+                    open_cases[msg.id] = case
+                    break
+
+        return open_cases
+
     def get_labels(self):
         return self.labels.filter(is_active=True)
 
+    @classmethod
+    def prefetch_for_json(cls, queryset):
+        """
+        Prefetches the contacts, assignees and active labels of the given cases so that they can be serialized as JSON
+        with a fixed number of queries
+        """
+        active_labels = Prefetch('labels', queryset=Label.objects.filter(is_active=True), to_attr='active_labels')
+
+        return queryset.select_related('contact', 'assignee').prefetch_related(active_labels)
+
     @classmethod
     def get_or_open(cls, org, user, labels, message, summary, assignee, update_contact=True):
+        """
+        Gets the open case for the contact of the given message, or the case for that message, or opens a new case.
+        Only checks and case creation are done under the contact's lock, and the contact is prepared in RapidPro by a
+        task once the new case has been committed.
+        """
+        from .tasks import prepare_contact_for_case
+
         r = get_redis_connection()
-        with r.lock('org:%d:cases_lock' % org.pk):
+        with r.lock(CASE_CONTACT_LOCK_KEY % (org.pk, message.contact), timeout=CASE_CONTACT_LOCK_TIMEOUT):
             # check for open case with this contact
             existing_open = cls.get_open_for_contact_on(org, message.contact, timezone.now())
             if existing_open:
@@ -536,16 +1157,19 @@ class Case(models.Model):
 
             contact = Contact.get_or_create(org, message.contact)
 
-            if update_contact:
-                # suspend from groups, expire flows and archive messages
-                contact.prepare_for_case()
+            with transaction.atomic():
+                case = cls.objects.create(org=org, assignee=assignee, contact=contact,
+                                          summary=summary, message_id=message.id, message_on=message.created_on)
+                case.is_new = True
 
-            case = cls.objects.create(org=org, assignee=assignee, contact=contact,
-                                      summary=summary, message_id=message.id, message_on=message.created_on)
-            case.is_new = True
-            case.labels.add(*labels)
+                with case.updating_counts(opening=True):
+                    case.labels.add(*labels)
 
-            CaseAction.create(case, user, CaseAction.OPEN, assignee=assignee)
+                CaseAction.create(case, user, CaseAction.OPEN, assignee=assignee)
+
+        if update_contact:
+            # suspend from groups, expire flows and archive messages
+            prepare_contact_for_case.delay(contact.pk)
 
         return case
 
@@ -562,47 +1186,100 @@ class Case(models.Model):
 
     @case_action()
     def close(self, user, note=None):
-        self.contact.restore_groups()
+        # lock contact so that a task preparing them for this case can't suspend them from groups after we've restored
+        # them. Once we've closed the case, the row lock held until commit makes that task wait to see it closed.
+        r = get_redis_connection()
+        with r.lock(CASE_CONTACT_LOCK_KEY % (self.org_id, self.contact.uuid), timeout=CASE_CONTACT_LOCK_TIMEOUT):
+            self.contact.restore_groups()
 
-        close_action = CaseAction.create(self, user, CaseAction.CLOSE, note=note)
+            with self.updating_counts():
+                close_action = CaseAction.create(self, user, CaseAction.CLOSE, note=note)
 
-        self.closed_on = close_action.created_on
-        self.save(update_fields=('closed_on',))
+                self.closed_on = close_action.created_on
+                self.save(update_fields=('closed_on',))
 
     @case_action()
     def reopen(self, user, note=None, update_contact=True):
-        self.closed_on = None
-        self.save(update_fields=('closed_on',))
+        from .tasks import prepare_contact_for_case
 
-        CaseAction.create(self, user, CaseAction.REOPEN, note=note)
+        with self.updating_counts():
+            self.closed_on = None
+            self.save(update_fields=('closed_on',))
+
+            CaseAction.create(self, user, CaseAction.REOPEN, note=note)
 
         if update_contact:
             # suspend from groups, expire flows and archive messages
-            self.contact.prepare_for_case()
+            prepare_contact_for_case.delay(self.contact.pk)
 
     @case_action()
     def reassign(self, user, partner, note=None):
-        self.assignee = partner
-        self.save(update_fields=('assignee',))
+        with self.updating_counts():
+            self.assignee = partner
+            self.save(update_fields=('assignee',))
 
-        CaseAction.create(self, user, CaseAction.REASSIGN, assignee=partner, note=note)
+            CaseAction.create(self, user, CaseAction.REASSIGN, assignee=partner, note=note)
 
     @case_action()
     def label(self, user, label):
-        self.labels.add(label)
+        with self.updating_counts():
+            self.labels.add(label)
 
-        CaseAction.create(self, user, CaseAction.LABEL, label=label)
+            CaseAction.create(self, user, CaseAction.LABEL, label=label)
 
     @case_action()
     def unlabel(self, user, label):
-        self.labels.remove(label)
+        with self.updating_counts():
+            self.labels.remove(label)
+
+            CaseAction.create(self, user, CaseAction.UNLABEL, label=label)
+
+    @contextmanager
+    def updating_counts(self, opening=False):
+        """
+        Context manager for changes to this case which may affect case counts. The change and the resulting updates to
+        the counts are made in a single transaction.
+        """
+        with transaction.atomic():
+            # lock this case so that the old keys can't be changed by someone else before we've updated the counts
+            old_keys = set() if opening else Case.objects.select_for_update().get(pk=self.pk).get_count_keys()
+            yield
+            CaseCount.record_change(self.org, old_keys, self.get_count_keys())
+
+    def get_count_keys(self):
+        """
+        Gets the (item type, item id, state) keys of all case counts which include this case
+        """
+        state = CaseCount.STATE_CLOSED if self.is_closed else CaseCount.STATE_OPEN
+        labels = list(self.labels.all())
+
+        keys = {(CaseCount.TYPE_ORG, 0, state)}
+        keys.update([(CaseCount.TYPE_PARTNER, partner_id, state) for partner_id in self.get_partner_ids(labels)])
+        keys.update([(CaseCount.TYPE_LABEL, label.pk, state) for label in labels])
+        return keys
+
+    def get_partner_ids(self, labels=None):
+        """
+        Gets the ids of the partners who can see this case, i.e. its assignee and the partners of its active labels
+        """
+        if labels is None:
+            labels = list(self.labels.all())
 
-        CaseAction.create(self, user, CaseAction.UNLABEL, label=label)
+        partner_ids = {self.assignee_id}
+        partner_ids.update(Partner.objects.filter(labels__in=[l for l in labels if l.is_active])
+                                          .values_list('pk', flat=True))
+        return partner_ids
+
+    def publish_change(self):
+        """
+        Notifies clients of the org's administrators and the partners who can see this case that it has changed
+        """
+        publish(self.org, EventType.case, {'id': self.pk}, self.get_partner_ids())
 
     def reply_event(self, msg):
         CaseEvent.create_reply(self, msg)
 
-    def update_labels(self, user, labels):
+    def update_labels(self, user, labels, access=None):
         """
         Updates all this cases's labels to the given set, creating label and unlabel actions as necessary
         """
@@ -611,52 +1288,218 @@ class Case(models.Model):
         add_labels = [l for l in labels if l not in current_labels]
         rem_labels = [l for l in current_labels if l not in labels]
 
+        access = access or CaseAccess(self.org, user)
+
         for label in add_labels:
-            self.label(user, label)
+            self.label(user, label, access=access)
         for label in rem_labels:
-            self.unlabel(user, label)
+            self.unlabel(user, label, access=access)
 
     def access_level(self, user):
         """
-        A user can view a case if one of these conditions is met:
-            1) they are an administrator for the case org
-            2) their partner org is assigned to the case
-            3) their partner org can view a label assigned to the case
-
-        They can additionally update the case if 1) or 2) is true
+        Gets the access level of the given user for this case. Use CaseAccess directly when checking many cases.
         """
-        if user.can_administer(self.org) or user.profile.partner == self.assignee:
-            return AccessLevel.update
-        elif user.profile.partner and intersection(self.get_labels(), user.profile.partner.get_labels()):
-            return AccessLevel.read
-        else:
-            return AccessLevel.none
+        return CaseAccess(self.org, user).get_level(self)
 
     @property
     def is_closed(self):
         return self.closed_on is not None
 
     def as_json(self, fetch_contact=False):
-        return {'id': self.pk,
-                'contact': self.contact.as_json(fetch_contact),
-                'assignee': self.assignee.as_json(),
-                'labels': [l.as_json() for l in self.get_labels()],
-                'summary': self.summary,
-                'opened_on': self.opened_on,
-                'is_closed': self.is_closed}
+        labels = self.active_labels if hasattr(self, 'active_labels') else self.get_labels()
+
+        result = {'id': self.pk,
+                  'contact': self.contact.as_json(fetch_contact),
+                  'assignee': self.assignee.as_json(),
+                  'labels': [l.as_json() for l in labels],
+                  'summary': self.summary,
+                  'opened_on': format_json_datetime(self.opened_on),
+                  'is_closed': self.is_closed}
+
+        # include the user's access level if cases have been annotated with CaseAccess.annotate
+        if hasattr(self, 'access'):
+            result['access'] = self.access.name
+
+        return result
 
     def __unicode__(self):
         return '#%d' % self.pk
 
 
-class CaseAction(models.Model):
+class CaseCount(models.Model):
     """
-    An action performed on a case
+    A maintained count of open or closed cases for an org, or for a partner or label in that org. A partner's counts
+    are of the cases it can see, i.e. those assigned to it or with one of its labels.
     """
-    OPEN = 'O'
-    UPDATE_SUMMARY = 'S'
-    ADD_NOTE = 'N'
-    REASSIGN = 'A'
+    TYPE_ORG = 'O'
+    TYPE_PARTNER = 'P'
+    TYPE_LABEL = 'L'
+
+    STATE_OPEN = 'O'
+    STATE_CLOSED = 'C'
+
+    org = models.ForeignKey(Org, verbose_name=_("Organization"), related_name='case_counts')
+
+    item_type = models.CharField(max_length=1)
+
+    item_id = models.IntegerField(help_text=_("The partner or label id, or zero for org counts"))
+
+    state = models.CharField(max_length=1)
+
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('org', 'item_type', 'item_id', 'state')
+
+    @classmethod
+    def get_open_count(cls, org, user):
+        return cls._get_for_user(org, user, cls.STATE_OPEN)
+
+    @classmethod
+    def get_closed_count(cls, org, user):
+        return cls._get_for_user(org, user, cls.STATE_CLOSED)
+
+    @classmethod
+    def _get_for_user(cls, org, user, state):
+        if user.can_administer(org):
+            item_type, item_id = cls.TYPE_ORG, 0
+        else:
+            partner = user.get_partner()
+            if not partner:
+                return 0
+            item_type, item_id = cls.TYPE_PARTNER, partner.pk
+
+        counts = cls.objects.filter(org=org, item_type=item_type, item_id=item_id, state=state)
+        return counts.values_list('count', flat=True).first() or 0
+
+    @classmethod
+    def record_change(cls, org, old_keys, new_keys):
+        """
+        Updates counts for a case which was included in the counts with the old keys and is now included in the counts
+        with the new keys
+        """
+        for key in old_keys - new_keys:
+            cls._increment(org, key, -1)
+        for key in new_keys - old_keys:
+            cls._increment(org, key, 1)
+
+    @classmethod
+    def _increment(cls, org, key, delta):
+        item_type, item_id, state = key
+        counts = cls.objects.filter(org=org, item_type=item_type, item_id=item_id, state=state)
+
+        if not counts.update(count=F('count') + delta):
+            try:
+                with transaction.atomic():
+                    cls.objects.create(org=org, item_type=item_type, item_id=item_id, state=state, count=delta)
+            except IntegrityError:
+                # count was created by someone else in the meantime
+                counts.update(count=F('count') + delta)
+
+    @classmethod
+    def rebuild(cls, org):
+        """
+        Rebuilds all counts for the given org from scratch
+        """
+        with transaction.atomic():
+            # lock existing counts so that changes to cases made while we're counting wait to update the new counts
+            list(cls.objects.select_for_update().filter(org=org).values_list('pk', flat=True))
+
+            cases = Case.objects.filter(org=org)
+            by_state = {cls.STATE_OPEN: cases.filter(closed_on=None), cls.STATE_CLOSED: cases.exclude(closed_on=None)}
+
+            counts = []
+            for state, state_cases in by_state.iteritems():
+                counts.append(cls(org=org, item_type=cls.TYPE_ORG, item_id=0, state=state, count=state_cases.count()))
+
+                for partner in Partner.objects.filter(org=org):
+                    visible = state_cases.filter(Q(labels__in=partner.get_labels()) | Q(assignee=partner)).distinct()
+                    counts.append(cls(org=org, item_type=cls.TYPE_PARTNER, item_id=partner.pk, state=state,
+                                      count=visible.count()))
+
+                for label_id, count in state_cases.values_list('labels').annotate(count=Count('pk')):
+                    if label_id is not None:
+                        counts.append(cls(org=org, item_type=cls.TYPE_LABEL, item_id=label_id, state=state,
+                                          count=count))
+
+            cls.objects.filter(org=org).delete()
+            cls.objects.bulk_create(counts)
+
+    @classmethod
+    def rebuild_in_background(cls, org):
+        """
+        Rebuilds all counts for the given org in a task, once the current transaction has been committed
+        """
+        from .tasks import rebuild_case_counts
+        rebuild_case_counts.delay(org.pk)
+
+
+class CaseAccess(object):
+    """
+    The access a user has to the cases of an org, i.e. whether they are an administrator, their partner and which
+    labels that partner can see. This is loaded once so that access levels for any number of cases can then be worked
+    out without further queries.
+    """
+    def __init__(self, org, user):
+        self.is_admin = user.can_administer(org)
+
+        partner = user.get_partner()
+        self.partner_id = partner.pk if partner else None
+        if partner and not self.is_admin:
+            self.label_ids = set(partner.get_labels().values_list('pk', flat=True))
+        else:
+            self.label_ids = set()
+
+    @classmethod
+    def for_request(cls, request):
+        """
+        Gets the access for the current user and org of the given request, loading it only once per request
+        """
+        if not hasattr(request, '_case_access'):
+            request._case_access = cls(request.org, request.user)
+        return request._case_access
+
+    def get_level(self, case):
+        """
+        A user can view a case if one of these conditions is met:
+            1) they are an administrator for the case org
+            2) their partner org is assigned to the case
+            3) their partner org can view a label assigned to the case
+
+        They can additionally update the case if 1) or 2) is true
+        """
+        if self.is_admin or (self.partner_id and case.assignee_id == self.partner_id):
+            return AccessLevel.update
+        elif self.partner_id and self.label_ids & self._get_label_ids(case):
+            return AccessLevel.read
+        else:
+            return AccessLevel.none
+
+    def annotate(self, cases):
+        """
+        Annotates each of the given cases with this user's access level as an access attribute. Cases should have
+        their active labels prefetched with Case.prefetch_for_json.
+        """
+        cases = list(cases)
+        for case in cases:
+            case.access = self.get_level(case)
+        return cases
+
+    @staticmethod
+    def _get_label_ids(case):
+        if hasattr(case, 'active_labels'):
+            return {l.pk for l in case.active_labels}
+        return set(case.get_labels().values_list('pk', flat=True))
+
+
+class CaseAction(models.Model):
+    """
+    An action performed on a case
+    """
+    OPEN = 'O'
+    UPDATE_SUMMARY = 'S'
+    ADD_NOTE = 'N'
+    REASSIGN = 'A'
     LABEL = 'L'
     UNLABEL = 'U'
     CLOSE = 'C'
@@ -686,14 +1529,16 @@ class CaseAction(models.Model):
 
     @classmethod
     def create(cls, case, user, action, assignee=None, label=None, note=None):
-        return CaseAction.objects.create(case=case, action=action,
-                                         created_by=user, assignee=assignee, label=label, note=note)
+        obj = CaseAction.objects.create(case=case, action=action,
+                                        created_by=user, assignee=assignee, label=label, note=note)
+        case.publish_change()
+        return obj
 
     def as_json(self):
         return {'id': self.pk,
                 'action': self.action,
                 'created_by': {'id': self.created_by.pk, 'name': self.created_by.get_full_name()},
-                'created_on': self.created_on,
+                'created_on': format_json_datetime(self.created_on),
                 'assignee': self.assignee.as_json() if self.assignee else None,
                 'label': self.label.as_json() if self.label else None,
                 'note': self.note}
@@ -717,22 +1562,253 @@ class CaseEvent(models.Model):
     def create_reply(cls, case, msg):
         cls.objects.create(case=case, event=cls.REPLY, created_on=msg.created_on)
 
+    @classmethod
+    def bulk_create_replies(cls, case_msgs):
+        """
+        Creates reply events for the given (case, message) pairs using a single insert
+        """
+        cls.objects.bulk_create([cls(case=case, event=cls.REPLY, created_on=msg.created_on) for case, msg in case_msgs])
+
+        CaseTimeline.invalidate(set(case.pk for case, msg in case_msgs))
+
     def as_json(self):
         return {'id': self.pk,
                 'event': self.event,
-                'created_on': self.created_on}
+                'created_on': format_json_datetime(self.created_on)}
+
+
+class CaseTimeline(object):
+    """
+    Cached timeline of a case's messages and actions, merged and serialized. Each update only fetches what has been
+    added since the last seen reply event, outgoing message and action, and only fetches messages from RapidPro if
+    there are new reply events or outgoing messages.
+    """
+    def __init__(self, case, version, label_version, state, items):
+        self.case = case
+        self.version = version
+        self.label_version = label_version
+        self.state = state  # last seen ids of events, outgoing messages and actions, and ids of the messages shown
+        self.items = items  # list of [microsecond timestamp, serialized item] pairs
+
+    @classmethod
+    def get(cls, case):
+        """
+        Gets the timeline for the given case, updated with anything added since it was cached
+        """
+        r = get_redis_connection()
+        with r.lock('case:%d:timeline_lock' % case.pk, timeout=CASE_TIMELINE_LOCK_TIMEOUT):
+            label_index = LabelIndex.get(case.org)
+
+            cached = cache.get(CASE_TIMELINE_CACHE_KEY % case.pk)
+            cached = json.loads(cached) if cached else None
+
+            # cached items include label names, so can't be used if labels have changed
+            if cached and cached['label_version'] == label_index.version:
+                timeline = cls(case, cached['version'], cached['label_version'], cached['state'], cached['items'])
+            else:
+                timeline = cls(case, random_string(16), label_index.version, None, [])
+
+            if timeline.update(label_index.by_name):
+                cache.set(CASE_TIMELINE_CACHE_KEY % case.pk, json.dumps({'version': timeline.version,
+                                                                         'label_version': timeline.label_version,
+                                                                         'state': timeline.state,
+                                                                         'items': timeline.items}),
+                          CASE_TIMELINE_CACHE_TTL)
+
+        return timeline
+
+    @classmethod
+    def invalidate(cls, case_ids):
+        """
+        Invalidates the cached timelines of the given cases
+        """
+        cache.delete_many([CASE_TIMELINE_CACHE_KEY % case_id for case_id in case_ids])
+
+    @classmethod
+    def invalidate_for_messages(cls, org, message_ids):
+        """
+        Invalidates the cached timelines of any cases with the contacts of the given messages
+        """
+        contacts = Message.objects.filter(org=org, pk__in=message_ids).values_list('contact', flat=True)
+        cls.invalidate(Case.objects.filter(org=org, contact__uuid__in=contacts).values_list('pk', flat=True))
+
+    def update(self, label_map):
+        """
+        Adds any items which have been added since the last update, returning whether the timeline has changed
+        """
+        case = self.case
+        is_first = self.state is None
+        state = self.state or dict(event_id=0, outgoing_id=0, action_id=0, message_ids=[], broadcast_ids=[])
+
+        new_events = list(case.events.filter(pk__gt=state['event_id']).order_by('pk'))
+        new_outgoing = case.outgoing_messages.filter(pk__gt=state['outgoing_id']).order_by('pk')
+        new_outgoing = list(new_outgoing.select_related('case__contact', 'created_by'))
+        new_actions = case.actions.filter(pk__gt=state['action_id']).select_related('assignee', 'created_by')
+        new_actions = list(new_actions.order_by('pk'))
+
+        if not is_first and not (new_events or new_outgoing or new_actions):
+            return False
+
+        items = []
+
+        # check on our side to see if there are new messages before hitting the RapidPro API, and if there are, fetch
+        # from the earliest of them as reply events are created with the time of the message rather than now
+        if is_first or new_events or new_outgoing:
+            if is_first:
+                after = case.message_on
+            else:
+                after = min([e.created_on for e in new_events] + [o.created_on for o in new_outgoing])
+
+            remote = case.org.get_temba_client().get_messages(contacts=[case.contact.uuid], after=after,
+                                                              before=case.closed_on)
+
+            seen_ids = set(state['message_ids'])
+            seen_broadcast_ids = set(state['broadcast_ids'])
+            local_by_broadcast = {o.broadcast_id: o for o in new_outgoing}
+
+            # merge remotely fetched and new local outgoing messages
+            for m in remote:
+                local = local_by_broadcast.pop(m.broadcast, None)
+                if m.id in seen_ids or (m.broadcast and m.broadcast in seen_broadcast_ids):
+                    continue
+                if local:
+                    m.sender = local.created_by
+
+                items.append({'time': m.created_on, 'type': 'M', 'item': Message.as_json(m, label_map)})
+                seen_ids.add(m.id)
+
+            # outgoing messages which RapidPro hasn't returned yet are shown from our own records
+            for m in local_by_broadcast.values():
+                items.append({'time': m.created_on, 'type': 'M', 'item': m.as_json()})
+                seen_broadcast_ids.add(m.broadcast_id)
+
+            state['message_ids'] = sorted(seen_ids)
+            state['broadcast_ids'] = sorted(seen_broadcast_ids)
+
+        items += [{'time': a.created_on, 'type': 'A', 'item': a.as_json()} for a in new_actions]
+
+        items = sorted(items, key=lambda item: item['time'])
+
+        self.items += [[datetime_to_microseconds(item['time']), json.loads(json_encode(item))] for item in items]
+
+        state['event_id'] = new_events[-1].pk if new_events else state['event_id']
+        state['outgoing_id'] = new_outgoing[-1].pk if new_outgoing else state['outgoing_id']
+        state['action_id'] = new_actions[-1].pk if new_actions else state['action_id']
+        self.state = state
+        return True
 
+    def get_cursor(self):
+        """
+        Gets a cursor which a client can use to fetch only the items added after those it has
+        """
+        return '%s:%d' % (self.version, len(self.items))
+
+    def get_items(self, cursor=None):
+        """
+        Gets the serialized items in this timeline after the given cursor, and whether they replace rather than follow
+        the items the client has, i.e. the timeline has been rebuilt since the cursor was given out
+        """
+        version, _, count = (cursor or '').partition(':')
 
-class Message(object):
+        if version == self.version and count.isdigit():
+            return [item for time, item in self.items[int(count):]], False
+        else:
+            return [item for time, item in self.items], True
+
+
+class Message(models.Model):
     """
-    A pseudo-model for messages which are always fetched from RapidPro.
+    A local copy of an incoming message in RapidPro. Messages are mirrored by the labelling task so that searches can
+    be served from the database. All changes are still made in RapidPro and then applied to the local copies.
     """
+    id = models.IntegerField(primary_key=True, help_text=_("The RapidPro id of this message"))
+
+    org = models.ForeignKey(Org, verbose_name=_("Organization"), related_name='messages')
+
+    contact = models.CharField(max_length=36, help_text=_("The UUID of the contact"))
+
+    urn = models.CharField(max_length=255, null=True)
+
+    text = models.TextField()
+
+    labels = ArrayField(models.CharField(max_length=64), help_text=_("Names of labels including system labels"))
+
+    type = models.CharField(max_length=1, null=True)
+
+    direction = models.CharField(max_length=1)
+
+    archived = models.BooleanField(default=False)
+
+    broadcast = models.IntegerField(null=True)
+
+    created_on = models.DateTimeField()
+
+    class Meta:
+        index_together = ('org', 'created_on')
+
+    @classmethod
+    def mirror(cls, org, messages, added_labels=None, archived_ids=()):
+        """
+        Creates or updates local copies of the given messages fetched from RapidPro, including any labels we've just
+        added to them and whether we've just archived them
+        """
+        if not messages:
+            return
+
+        added_labels = added_labels or {}
+        existing_ids = set(cls.objects.filter(pk__in=[m.id for m in messages]).values_list('pk', flat=True))
+        new_messages = []
+
+        for msg in messages:
+            labels = set(msg.labels or []) | set(added_labels.get(msg.id, []))
+
+            local = cls(id=msg.id, org=org, contact=msg.contact, urn=msg.urn, text=msg.text or '',
+                        labels=sorted(labels), type=msg.type, direction=msg.direction or 'I',
+                        archived=bool(msg.archived) or msg.id in archived_ids, broadcast=msg.broadcast,
+                        created_on=msg.created_on)
+
+            if msg.id in existing_ids:
+                local.save()
+            else:
+                new_messages.append(local)
+
+        cls.objects.bulk_create(new_messages)
+
+    @classmethod
+    def get_processed_ids(cls, org, messages):
+        """
+        Gets the ids of those of the given messages which have already been processed, i.e. have local copies
+        """
+        return set(cls.objects.filter(org=org, pk__in=[m.id for m in messages]).values_list('pk', flat=True))
+
+    @classmethod
+    def update_local(cls, org, message_ids, add_label=None, remove_label=None, archived=None):
+        """
+        Applies a change we've made in RapidPro to any local copies of the given messages, and invalidates the cached
+        timelines which show them
+        """
+        for msg in cls.objects.filter(org=org, pk__in=message_ids):
+            labels = set(msg.labels)
+            if add_label:
+                labels.add(add_label)
+            if remove_label:
+                labels.discard(remove_label)
+
+            msg.labels = sorted(labels)
+            if archived is not None:
+                msg.archived = archived
+
+            msg.save(update_fields=('labels', 'archived'))
+
+        CaseTimeline.invalidate_for_messages(org, message_ids)
+
     @staticmethod
     def bulk_flag(org, user, message_ids):
         if message_ids:
             client = org.get_temba_client()
             client.label_messages(message_ids, label=SYSTEM_LABEL_FLAGGED)
 
+            Message.update_local(org, message_ids, add_label=SYSTEM_LABEL_FLAGGED)
             MessageAction.create(org, user, message_ids, MessageAction.FLAG)
 
     @staticmethod
@@ -741,6 +1817,7 @@ class Message(object):
             client = org.get_temba_client()
             client.unlabel_messages(message_ids, label=SYSTEM_LABEL_FLAGGED)
 
+            Message.update_local(org, message_ids, remove_label=SYSTEM_LABEL_FLAGGED)
             MessageAction.create(org, user, message_ids, MessageAction.UNFLAG)
 
     @staticmethod
@@ -749,6 +1826,7 @@ class Message(object):
             client = org.get_temba_client()
             client.label_messages(message_ids, label_uuid=label.uuid)
 
+            Message.update_local(org, message_ids, add_label=label.name)
             MessageAction.create(org, user, message_ids, MessageAction.LABEL, label)
 
     @staticmethod
@@ -757,6 +1835,7 @@ class Message(object):
             client = org.get_temba_client()
             client.unlabel_messages(message_ids, label_uuid=label.uuid)
 
+            Message.update_local(org, message_ids, remove_label=label.name)
             MessageAction.create(org, user, message_ids, MessageAction.UNLABEL, label)
 
     @staticmethod
@@ -765,6 +1844,7 @@ class Message(object):
             client = org.get_temba_client()
             client.archive_messages(message_ids)
 
+            Message.update_local(org, message_ids, archived=True)
             MessageAction.create(org, user, message_ids, MessageAction.ARCHIVE)
 
     @staticmethod
@@ -773,6 +1853,7 @@ class Message(object):
             client = org.get_temba_client()
             client.unarchive_messages(message_ids)
 
+            Message.update_local(org, message_ids, archived=False)
             MessageAction.create(org, user, message_ids, MessageAction.RESTORE)
 
     @classmethod
@@ -806,7 +1887,7 @@ class Message(object):
     @staticmethod
     def search(org, search, pager):
         """
-        Search for labelled messages in RapidPro
+        Search for labelled messages, either in our local copies or in RapidPro
         """
         if not search['labels']:  # no access to un-labelled messages
             return []
@@ -826,6 +1907,9 @@ class Message(object):
             limit_days = getattr(settings, 'UNLABELLED_LIMIT_DAYS', DEFAULT_UNLABELLED_LIMIT_DAYS)
             search['after'] = timezone.now() - timedelta(days=limit_days)
 
+        if Message.is_local_search(search):
+            return Message.search_local(org, search, pager)
+
         client = org.get_temba_client()
         messages = client.get_messages(pager=pager, text=search['text'], labels=search['labels'],
                                        contacts=search['contacts'], groups=search['groups'],
@@ -838,48 +1922,222 @@ class Message(object):
         return messages
 
     @staticmethod
-    def process_unsolicited(org, messages):
+    def is_local_search(search):
+        """
+        Whether the given search can be served from local copies of messages. Contact groups aren't mirrored so
+        searches filtering on those always go to RapidPro.
+        """
+        return getattr(settings, 'LOCAL_MESSAGE_SEARCH', False) and not search['groups']
+
+    @staticmethod
+    def search_local(org, search, pager):
+        """
+        Search for labelled messages in our local copies, using the same label syntax as RapidPro where labels with a
+        + prefix are required, labels with a - prefix are excluded, and at least one of the other labels must match
+        """
+        qs = Message.objects.filter(org=org, direction='I')
+
+        any_labels = [l for l in search['labels'] if not l.startswith('+') and not l.startswith('-')]
+        all_labels = [l[1:] for l in search['labels'] if l.startswith('+')]
+        not_labels = [l[1:] for l in search['labels'] if l.startswith('-')]
+
+        if any_labels:
+            qs = qs.filter(labels__overlap=any_labels)
+        if all_labels:
+            qs = qs.filter(labels__contains=all_labels)
+        if not_labels:
+            qs = qs.exclude(labels__overlap=not_labels)
+
+        if search['contacts']:
+            qs = qs.filter(contact__in=search['contacts'])
+        if search['text']:
+            qs = qs.filter(text__icontains=search['text'])
+        if search['types']:
+            qs = qs.filter(type__in=search['types'])
+        if search['archived'] is not None:
+            qs = qs.filter(archived=search['archived'])
+        if search['after']:
+            qs = qs.filter(created_on__gt=search['after'])
+        if search['before']:
+            qs = qs.filter(created_on__lt=search['before'])
+
+        qs = qs.order_by('-created_on', '-pk')
+
+        if not pager:
+            return list(qs)
+
+        # page results and update the pager just as RapidPro would, except that the total is only counted for the
+        # first page, and only if it doesn't fit on that page
+        offset = (pager.start_page - 1) * LOCAL_MESSAGE_PAGE_SIZE
+        messages = list(qs[offset:offset + LOCAL_MESSAGE_PAGE_SIZE + 1])
+        has_more = len(messages) > LOCAL_MESSAGE_PAGE_SIZE
+        messages = messages[:LOCAL_MESSAGE_PAGE_SIZE]
+
+        if pager.start_page == 1:
+            total = qs.count() if has_more else len(messages)
+        else:
+            total = None
+
+        pager.update({'count': total, 'next': 'page=%d' % (pager.start_page + 1) if has_more else None})
+
+        return messages
+
+    @staticmethod
+    def mirror_all(org, **fetch_kwargs):
         """
-        Processes unsolicited messages, labelling and creating case events as appropriate
+        Fetches all pages of incoming messages matching the given fetch parameters and creates or updates local copies
+        of them with their current labels and archived state. Only messages which the labelling task has already
+        processed are mirrored, as having a local copy marks a message as processed. Returns the number mirrored.
         """
-        labels = list(Label.get_all(org))
-        label_keywords = {l: l.get_keywords() for l in labels}
-        label_matches = {l: [] for l in labels}  # message ids that match each label
+        client = org.get_temba_client()
+        cursor = MessageSyncCursor.get_for_org(org)
+        pager = client.pager()
+
+        if cursor.last_msg_on is None:
+            return 0
+
+        def fetch_pages():
+            while True:
+                yield client.get_messages(pager=pager, direction='I', before=cursor.last_msg_on, **fetch_kwargs)
+
+                if not pager.has_more():
+                    break
+
+        num_mirrored = 0
+        for messages in prefetch(fetch_pages(), UNSOLICITED_PREFETCH_PAGES):
+            messages = [m for m in messages if cursor.is_processed(m)]
+
+            Message.mirror(org, messages)
+            num_mirrored += len(messages)
 
-        case_replies = []
+        return num_mirrored
 
+    @staticmethod
+    def process_all_unsolicited(org, cursor=None, **fetch_kwargs):
+        """
+        Fetches and processes all pages of unsolicited messages matching the given fetch parameters, oldest page
+        first. The next pages are fetched in a background thread whilst the current page is processed, and the
+        resulting label and archive calls are buffered across pages and made by a small pool of worker threads. Every
+        few pages the buffer is checkpointed, i.e. written, recorded and emptied, so memory use doesn't grow with the
+        backlog. If a sync cursor is provided then messages at or before it are skipped, and it's advanced at each
+        checkpoint. Returns a dict of counts.
+        """
         client = org.get_temba_client()
+        matcher = Label.get_keyword_matcher(org)
+
+        def fetch_pages():
+            # RapidPro returns messages newest first, so fetch the first page to find out how many pages there are,
+            # and then fetch them from the last page back. Archiving processed messages then only shifts the
+            # remaining messages towards pages still to be fetched.
+            pager = client.pager()
+            first_page = client.get_messages(pager=pager, **fetch_kwargs)
+
+            if not pager.has_more():
+                yield first_page
+                return
+
+            num_pages = int(math.ceil(float(pager.total) / len(first_page)))
+
+            for page_num in range(num_pages, 0, -1):
+                yield client.get_messages(pager=client.pager(start_page=page_num), **fetch_kwargs)
+
+        pool = BoundedThreadPool(UNSOLICITED_WRITE_WORKERS, UNSOLICITED_MAX_PENDING_WRITES)
+        buffer = MessageWriteBuffer(org, pool)
+        num_messages = 0
+        num_skipped = 0
+        num_labelled = 0
+        newest = None  # (created_on, id) of the newest message processed since the last checkpoint
+
+        def checkpoint():
+            # only record messages as processed and advance the cursor once messages have actually been labelled
+            # and archived, so that they're processed again if that fails
+            buffer.checkpoint()
+
+            if cursor and newest:
+                cursor.advance(newest)
+
+        try:
+            for page_num, messages in enumerate(prefetch(fetch_pages(), UNSOLICITED_PREFETCH_PAGES), start=1):
+                messages = sorted(messages, key=lambda m: (m.created_on, m.id))
+
+                if cursor:
+                    new_messages = [m for m in messages if not cursor.is_processed(m)]
+                    num_skipped += len(messages) - len(new_messages)
+                    messages = new_messages
+
+                num_messages += len(messages)
+                num_labelled += Message.process_unsolicited(org, messages, matcher, buffer)
+
+                if messages:
+                    newest = safe_max(newest, (messages[-1].created_on, messages[-1].id))
+
+                if page_num % UNSOLICITED_CHECKPOINT_PAGES == 0:
+                    checkpoint()
+
+            checkpoint()
+        finally:
+            pool.join()
+
+        return {'messages': num_messages,
+                'skipped': num_skipped,
+                'labelled': num_labelled,
+                'api_calls': buffer.num_calls,
+                'api_calls_saved': buffer.num_unbuffered_calls - buffer.num_calls}
+
+    @staticmethod
+    def process_unsolicited(org, messages, matcher=None, buffer=None):
+        """
+        Processes unsolicited messages, labelling and creating case events as appropriate. Messages which already have
+        local copies have already been processed and are ignored. If a write buffer is provided then label and archive
+        calls are added to that rather than made immediately.
+        """
+        if not matcher:
+            matcher = Label.get_keyword_matcher(org)
+
+        flush_now = buffer is None
+        if flush_now:
+            buffer = MessageWriteBuffer(org)
+
+        # messages which have local copies, or will have once the buffer is written, have already been processed
+        processed_ids = Message.get_processed_ids(org, messages) | buffer.processed_ids
+        messages = [msg for msg in messages if msg.id not in processed_ids]
+        if not messages:
+            return 0
+
+        label_matches = defaultdict(list)  # messages that match each label
+
+        case_replies = []  # (case, message) pairs for messages from contacts with open cases
+
         labelled, unlabelled = [], []
 
+        open_cases = Case.get_open_for_messages(org, messages)
+
         for msg in messages:
-            open_case = Case.get_open_for_contact_on(org, msg.contact, msg.created_on)
+            open_case = open_cases.get(msg.id)
 
             if open_case:
-                open_case.reply_event(msg)
-                case_replies.append(msg)
+                case_replies.append((open_case, msg))
             else:
                 # only apply labels if there isn't a currently open case for this contact
-                norm_text = normalize(msg.text)
+                matched_labels = matcher.match(normalize(msg.text))
+                if matched_labels:
+                    labelled.append(msg)
 
-                for label in labels:
-                    if match_keywords(norm_text, label_keywords[label]):
-                        labelled.append(msg)
-                        label_matches[label].append(msg)
+                for label in matched_labels:
+                    label_matches[label].append(msg)
 
-        # add labels to matching messages
+        # local copies of these messages are kept as they will be once labelled and archived
+        added_labels = defaultdict(list)
         for label, matched_msgs in label_matches.iteritems():
-            if matched_msgs:
-                client.label_messages(messages=matched_msgs, label_uuid=label.uuid)
+            for msg in matched_msgs:
+                added_labels[msg.id].append(label.name)
 
-        # archive messages which are case replies
-        if case_replies:
-            client.archive_messages(messages=case_replies)
+        # add labels to matching messages and archive messages which are case replies
+        buffer.add(label_matches, [msg for case, msg in case_replies], labelled, unlabelled)
+        buffer.add_processed(messages, added_labels, case_replies)
 
-        # record the last labelled/unlabelled message times for this org
-        if labelled:
-            org.record_message_time(labelled[0].created_on, labelled=True)
-        if unlabelled:
-            org.record_message_time(unlabelled[0].created_on, labelled=False)
+        if flush_now:
+            buffer.checkpoint()
 
         return len(labelled)
 
@@ -897,7 +2155,7 @@ class Message(object):
                 'text': msg.text,
                 'contact': msg.contact,
                 'urn': msg.urn,
-                'time': msg.created_on,
+                'time': format_json_datetime(msg.created_on),
                 'labels': labels,
                 'flagged': flagged,
                 'direction': msg.direction,
@@ -905,6 +2163,286 @@ class Message(object):
                 'sender': msg.sender.as_json() if getattr(msg, 'sender', None) else None}
 
 
+class MessageSearchCache(object):
+    """
+    Short-lived cache of message search results which is shared between users, so that many inboxes polling the same
+    view only need one call to RapidPro. Concurrent identical searches wait for the first one to finish rather than
+    making their own calls. All of an org's cached searches are invalidated when the labelling task records new
+    messages or when messages are modified.
+    """
+    @classmethod
+    def search(cls, org, search, page):
+        """
+        Searches for messages, returning a dict of the messages, whether there are more pages and the total count
+        """
+        window = getattr(settings, 'MESSAGE_SEARCH_CACHE_WINDOW', MESSAGE_SEARCH_CACHE_WINDOW)
+        wide_search = dict(search,
+                           after=cls._round_time(search['after'], window, up=False),
+                           before=cls._round_time(search['before'], window, up=True))
+
+        key = cls._get_key(org, wide_search, page)
+        result = cache.get(key)
+
+        if result is None:
+            r = get_redis_connection()
+            with r.lock(key + ':lock', timeout=MESSAGE_SEARCH_LOCK_TIMEOUT):
+                # an identical search may have completed whilst we were waiting for the lock
+                result = cache.get(key)
+                if result is None:
+                    result = cls._search(org, wide_search, page)
+                    cache.set(key, result, MESSAGE_SEARCH_CACHE_TTL)
+
+        # filter out messages which are outside of the original time bounds
+        if wide_search['after'] != search['after'] or wide_search['before'] != search['before']:
+            messages = [m for m in result['messages']
+                        if (not search['after'] or m.created_on >= search['after'])
+                        and (not search['before'] or m.created_on <= search['before'])]
+            result = dict(result, messages=messages, total=len(messages) if not page else result['total'])
+
+        return result
+
+    @classmethod
+    def _search(cls, org, search, page):
+        pager = org.get_temba_client().pager(start_page=page) if page else None
+        messages = Message.search(org, dict(search), pager)
+
+        if pager:
+            return {'messages': messages, 'has_more': pager.has_more(), 'total': pager.total}
+        else:
+            return {'messages': messages, 'has_more': None, 'total': len(messages)}
+
+    @classmethod
+    def _get_key(cls, org, search, page):
+        normalized = {}
+        for field, value in search.iteritems():
+            if isinstance(value, list):
+                value = sorted(value)
+            elif hasattr(value, 'astimezone'):
+                value = format_iso8601(value)
+            normalized[field] = value
+
+        search_hash = hashlib.md5(json.dumps({'search': normalized, 'page': page}, sort_keys=True)).hexdigest()
+
+        return MESSAGE_SEARCH_CACHE_KEY % (org.pk, cls.get_version(org), search_hash)
+
+    @staticmethod
+    def _round_time(dt, window, up):
+        if not dt or not window:
+            return dt
+
+        window_micros = window * 1000000
+        micros = datetime_to_microseconds(dt)
+        rounded = micros - micros % window_micros
+        if up and rounded != micros:
+            rounded += window_micros
+
+        return microseconds_to_datetime(rounded)
+
+    @classmethod
+    def get_version(cls, org):
+        version = cache.get(MESSAGE_SEARCH_VERSION_CACHE_KEY % org.pk)
+        if not version:
+            version = random_string(16)
+            cache.set(MESSAGE_SEARCH_VERSION_CACHE_KEY % org.pk, version, ORG_CACHE_TTL)
+        return version
+
+    @classmethod
+    def invalidate(cls, org):
+        """
+        Invalidates all cached message searches for the given org
+        """
+        cache.set(MESSAGE_SEARCH_VERSION_CACHE_KEY % org.pk, random_string(16), ORG_CACHE_TTL)
+
+
+class MessageWriteBuffer(object):
+    """
+    Buffers label and archive calls to RapidPro across pages of processed messages so that they can be made in as few
+    calls as possible. Full batches are written as soon as they're ready, and everything is written when the buffer
+    is flushed or gets older than its maximum age.
+    """
+    def __init__(self, org, pool=None, batch_size=MESSAGE_WRITE_BATCH_SIZE, max_age=MESSAGE_WRITE_MAX_AGE):
+        self.org = org
+        self.pool = pool
+        self.batch_size = batch_size
+        self.max_age = max_age
+
+        self.label_ids = defaultdict(list)  # label UUIDs to message ids
+        self.archive_ids = []
+        self.started_on = None
+
+        self.new_label_ids = set()  # ids of labels which have new messages
+
+        self.processed = []  # pages of processed messages, with their added labels and case replies
+        self.processed_ids = set()
+
+        self.last_labelled_time = None
+        self.last_unlabelled_time = None
+
+        self.num_calls = 0
+        self.num_unbuffered_calls = 0  # calls that would have been made without buffering
+
+    def add(self, label_matches, archive, labelled, unlabelled):
+        """
+        Adds a page of label matches, messages to archive, and labelled and unlabelled messages
+        """
+        for label, messages in label_matches.iteritems():
+            self.label_ids[label.uuid] += [m.id for m in messages]
+            self.new_label_ids.add(label.pk)
+            self.num_unbuffered_calls += 1
+
+        if archive:
+            self.archive_ids += [m.id for m in archive]
+            self.num_unbuffered_calls += 1
+
+        self.last_labelled_time = safe_max(self.last_labelled_time, *[m.created_on for m in labelled])
+        self.last_unlabelled_time = safe_max(self.last_unlabelled_time, *[m.created_on for m in unlabelled])
+
+        if self.started_on is None:
+            self.started_on = time.time()
+
+        if time.time() - self.started_on >= self.max_age:
+            self.flush()
+        else:
+            self._write(full_batches_only=True)
+
+    def add_processed(self, messages, added_labels, case_replies):
+        """
+        Adds a page of processed messages, with the names of the labels added to each and the (case, message) pairs
+        for those which are case replies
+        """
+        self.processed.append((messages, added_labels, case_replies))
+        self.processed_ids.update([m.id for m in messages])
+
+    def flush(self):
+        """
+        Writes everything in the buffer
+        """
+        self._write(full_batches_only=False)
+        self.started_on = None
+
+    def checkpoint(self):
+        """
+        Writes everything in the buffer and waits for the writes to complete, and then records the processed messages
+        and message times, leaving the buffer empty
+        """
+        self.flush()
+
+        if self.pool:
+            self.pool.drain()
+
+        self.record_processed()
+        self.record_message_times()
+
+    def record_processed(self):
+        """
+        Records processed messages by keeping local copies of them and creating reply events for case replies. Should
+        only be called once all writes have completed, as messages with local copies aren't processed again.
+        """
+        replied_cases = {}
+
+        for messages, added_labels, case_replies in self.processed:
+            if case_replies:
+                CaseEvent.bulk_create_replies(case_replies)
+                replied_cases.update({case.pk: case for case, msg in case_replies})
+
+            Message.mirror(self.org, messages, added_labels, archived_ids={msg.id for case, msg in case_replies})
+
+        for case in replied_cases.itervalues():
+            case.publish_change()
+
+        # these messages now have local copies so don't need to be remembered here
+        self.processed = []
+        self.processed_ids = set()
+
+    def record_message_times(self):
+        """
+        Records the last labelled/unlabelled message times for the org, and notifies clients of the org's
+        administrators and the partners of the labels with new messages. Should only be called once all writes have
+        completed.
+        """
+        if self.last_labelled_time:
+            self.org.record_message_time(self.last_labelled_time, labelled=True)
+        if self.last_unlabelled_time:
+            self.org.record_message_time(self.last_unlabelled_time, labelled=False)
+
+        if self.last_labelled_time or self.last_unlabelled_time:
+            MessageSearchCache.invalidate(self.org)
+
+            label_partner_ids = LabelIndex.get(self.org).partner_ids
+            partner_ids = set()
+            for label_id in self.new_label_ids:
+                partner_ids.update(label_partner_ids.get(label_id, ()))
+
+            publish(self.org, EventType.messages, {'labels': sorted(self.new_label_ids)}, partner_ids)
+
+        self.last_labelled_time = None
+        self.last_unlabelled_time = None
+        self.new_label_ids = set()
+
+    def _write(self, full_batches_only):
+        for label_uuid in self.label_ids.keys():
+            self.label_ids[label_uuid] = self._write_batches(self.label_ids[label_uuid], full_batches_only,
+                                                             'label_messages', label_uuid=label_uuid)
+            if not self.label_ids[label_uuid]:
+                del self.label_ids[label_uuid]
+
+        self.archive_ids = self._write_batches(self.archive_ids, full_batches_only, 'archive_messages')
+
+    def _write_batches(self, message_ids, full_batches_only, method, **kwargs):
+        """
+        Writes the given message ids in batches, returning any left over
+        """
+        while len(message_ids) >= self.batch_size or (message_ids and not full_batches_only):
+            batch, message_ids = message_ids[:self.batch_size], message_ids[self.batch_size:]
+
+            self.num_calls += 1
+            if self.pool:
+                self.pool.submit(self._call, method, messages=batch, **kwargs)
+            else:
+                self._call(method, messages=batch, **kwargs)
+
+        return message_ids
+
+    def _call(self, method, **kwargs):
+        client = self.org.get_temba_client()
+        getattr(client, method)(**kwargs)
+
+
+class MessageSyncCursor(models.Model):
+    """
+    The position of the labelling task in an org's stream of incoming messages, i.e. the newest message it has
+    processed. This is kept in the database rather than the cache so that it survives the cache being cleared.
+    """
+    org = models.OneToOneField(Org, verbose_name=_("Organization"), related_name='message_sync_cursor')
+
+    last_msg_id = models.IntegerField(null=True, help_text=_("The RapidPro id of the newest processed message"))
+
+    last_msg_on = models.DateTimeField(null=True, help_text=_("When the newest processed message was created"))
+
+    updated_on = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def get_for_org(cls, org):
+        return cls.objects.get_or_create(org=org)[0]
+
+    def is_processed(self, msg):
+        """
+        Whether the given message is at or before this cursor and so has already been processed
+        """
+        if self.last_msg_on is None:
+            return False
+
+        return (msg.created_on, msg.id) <= (self.last_msg_on, self.last_msg_id)
+
+    def advance(self, newest):
+        """
+        Moves this cursor forward to the given (created_on, id) of the newest processed message
+        """
+        if (self.last_msg_on is None or newest > (self.last_msg_on, self.last_msg_id)):
+            self.last_msg_on, self.last_msg_id = newest
+            self.save(update_fields=('last_msg_id', 'last_msg_on', 'updated_on'))
+
+
 class MessageAction(models.Model):
     """
     An action performed on a set of messages
@@ -947,7 +2485,7 @@ class MessageAction(models.Model):
         return {'id': self.pk,
                 'action': self.action,
                 'created_by': self.created_by.as_json(),
-                'created_on': self.created_on,
+                'created_on': format_json_datetime(self.created_on),
                 'label': self.label.as_json() if self.label else None}
 
 
@@ -987,20 +2525,24 @@ class Outgoing(models.Model):
         # TODO update RapidPro api to expose more accurate recipient_count
         recipient_count = len(broadcast.urns) + len(broadcast.contacts)
 
-        return cls.objects.create(org=org,
-                                  broadcast_id=broadcast.id,
-                                  recipient_count=recipient_count,
-                                  activity=activity, case=case,
-                                  text=text,
-                                  created_by=user,
-                                  created_on=broadcast.created_on)
+        outgoing = cls.objects.create(org=org,
+                                      broadcast_id=broadcast.id,
+                                      recipient_count=recipient_count,
+                                      activity=activity, case=case,
+                                      text=text,
+                                      created_by=user,
+                                      created_on=broadcast.created_on)
+        if case:
+            case.publish_change()
+
+        return outgoing
 
     def as_json(self):
         return {'id': self.pk,
                 'text': self.text,
                 'contact': self.case.contact.pk,
                 'urn': None,
-                'time': self.created_on,
+                'time': format_json_datetime(self.created_on),
                 'labels': [],
                 'flagged': False,
                 'direction': 'O',
@@ -0,0 +1,155 @@
+from __future__ import absolute_import, unicode_literals
+
+import json
+import time
+
+from django.conf import settings
+from django.db import connection
+from enum import Enum
+from redis_cache import get_redis_connection
+
+
+# events are published to a channel for the org's administrators, and to a channel for each partner who can see the
+# changed item
+ORG_EVENTS_CHANNEL = 'org:%d:events'
+PARTNER_EVENTS_CHANNEL = 'org:%d:partner:%d:events'
+
+# how long in seconds an event stream is held open before the client is made to reconnect, and how long a stream can
+# be idle before a keep-alive comment is sent. These can be overridden with the EVENT_STREAM_MAX_AGE and
+# EVENT_STREAM_KEEPALIVE settings.
+EVENT_STREAM_MAX_AGE = 5 * 60
+EVENT_STREAM_KEEPALIVE = 20
+
+EVENT_STREAM_RETRY = 5000  # milliseconds a client waits before reconnecting
+
+# the longest in seconds that a request for new items can be held open waiting for a change. This can be overridden
+# with the LONG_POLL_MAX_WAIT setting.
+LONG_POLL_MAX_WAIT = 30
+
+
+class EventType(Enum):
+    case = 1  # a case was opened, changed or replied to
+    messages = 2  # new messages were labelled or added to the inbox
+
+
+def publish(org, event_type, data, partner_ids=()):
+    """
+    Publishes an event to the given org's administrators and partners. This is done by a task so that the event isn't
+    published until the current transaction has been committed, and clients never fetch before changes are visible.
+    """
+    from .tasks import publish_event
+
+    publish_event.delay(org.pk, event_type.name, data, sorted(p for p in partner_ids if p))
+
+
+def send_event(org_id, event_type, data, partner_ids):
+    """
+    Sends an event to the org channel and the given partner channels
+    """
+    message = json.dumps({'type': event_type, 'data': data})
+
+    pipe = get_redis_connection().pipeline()
+    pipe.publish(ORG_EVENTS_CHANNEL % org_id, message)
+    for partner_id in partner_ids:
+        pipe.publish(PARTNER_EVENTS_CHANNEL % (org_id, partner_id), message)
+    pipe.execute()
+
+
+def get_events_channel(org, user):
+    """
+    Gets the channel which the given user receives events on, or None if they don't receive any
+    """
+    if user.can_administer(org):
+        return ORG_EVENTS_CHANNEL % org.pk
+
+    partner = user.get_partner()
+    return PARTNER_EVENTS_CHANNEL % (org.pk, partner.pk) if partner else None
+
+
+class EventWaiter(object):
+    """
+    Context manager which subscribes to a user's events so that a request can wait for a change. Subscribe before
+    checking for new items so that a change made between the check and the wait isn't missed.
+    """
+    def __init__(self, org, user, event_type):
+        self.channel = get_events_channel(org, user)
+        self.event_type = event_type
+        self.pubsub = None
+
+    def __enter__(self):
+        if self.channel:
+            self.pubsub = get_redis_connection().pubsub(ignore_subscribe_messages=True)
+            self.pubsub.subscribe(self.channel)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.pubsub:
+            self.pubsub.close()
+
+    def wait(self, timeout):
+        """
+        Waits up to the given number of seconds for an event, returning whether one was received
+        """
+        if not self.pubsub:
+            return False
+
+        release_connection()
+
+        deadline = time.time() + timeout
+        remaining = timeout
+        while remaining > 0:
+            message = self.pubsub.get_message(timeout=remaining)
+            if message and json.loads(message['data'])['type'] == self.event_type.name:
+                return True
+
+            remaining = deadline - time.time()
+
+        return False
+
+
+def release_connection():
+    """
+    Closes the database connection before waiting, unless it's in a transaction. A new connection is opened if the
+    request queries the database again.
+    """
+    if not connection.in_atomic_block:
+        connection.close()
+
+
+def get_wait(request):
+    """
+    Gets the number of seconds that a request for new items can wait for a change, from its wait param
+    """
+    try:
+        wait = int(request.GET.get('wait', 0))
+    except ValueError:
+        return 0
+
+    return max(0, min(wait, getattr(settings, 'LONG_POLL_MAX_WAIT', LONG_POLL_MAX_WAIT)))
+
+
+def stream_events(channel):
+    """
+    Generates server-sent events for each event published to the given channel. The stream ends once it reaches its
+    maximum age, and clients then reconnect.
+    """
+    max_age = getattr(settings, 'EVENT_STREAM_MAX_AGE', EVENT_STREAM_MAX_AGE)
+    keepalive = getattr(settings, 'EVENT_STREAM_KEEPALIVE', EVENT_STREAM_KEEPALIVE)
+
+    # the stream doesn't need the database so don't hold a connection for as long as it's open
+    release_connection()
+
+    pubsub = get_redis_connection().pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(channel)
+    try:
+        yield 'retry: %d\n\n' % EVENT_STREAM_RETRY
+
+        started = time.time()
+        while time.time() - started < max_age:
+            message = pubsub.get_message(timeout=keepalive)
+            if message:
+                yield 'data: %s\n\n' % message['data']
+            else:
+                yield ': keepalive\n\n'
+    finally:
+        pubsub.close()
@@ -1,73 +1,203 @@
 from __future__ import absolute_import, unicode_literals
 
+import time
+
 from celery.utils.log import get_task_logger
 from dash.orgs.models import Org
 from datetime import timedelta
 from dash.utils import datetime_to_ms, ms_to_datetime
+from django.db import transaction
 from django.utils import timezone
 from djcelery_transactions import task
+from redis.exceptions import LockError
 from redis_cache import get_redis_connection
+from temba_client.base import TembaException
 from casepro.orgs_ext import TaskType
 
 logger = get_task_logger(__name__)
 
+# how long a single org's labelling task may run before its lock expires and the task is killed
+ORG_LABELLING_TIMEOUT = 300
+
+# how many times preparing a contact for a new case is retried if RapidPro is unavailable, with exponential backoff
+CONTACT_PREPARE_MAX_RETRIES = 5
+CONTACT_PREPARE_RETRY_DELAY = 30  # seconds, doubled after each retry
+
+# how many times a chunk of a message export is retried if RapidPro is unavailable, with exponential backoff
+MESSAGE_EXPORT_MAX_RETRIES = 5
+MESSAGE_EXPORT_RETRY_DELAY = 60  # seconds, doubled after each retry
+
 
 @task
 def process_new_unsolicited():
     """
-    Processes new unsolicited messages for all orgs in RapidPro
+    Dispatches a task to process new unsolicited messages for each active org in RapidPro
     """
-    r = get_redis_connection()
-
-    # only do this if we aren't already running so we don't get backed up
-    key = 'process_new_unsolicited'
-    if not r.get(key):
-        with r.lock(key, timeout=600):
-            for org in Org.objects.filter(is_active=True):
-                process_new_org_unsolicited(org)
+    for org in Org.objects.filter(is_active=True):
+        process_new_org_unsolicited.delay(org.pk)
 
 
-def process_new_org_unsolicited(org):
+@task(soft_time_limit=ORG_LABELLING_TIMEOUT - 30, time_limit=ORG_LABELLING_TIMEOUT)
+def process_new_org_unsolicited(org_id):
     """
     Processes new unsolicited messages for an org in RapidPro
     """
-    from .models import Message
+    r = get_redis_connection()
+
+    # only do this if we aren't already running for this org so we don't get backed up
+    key = 'org:%d:process_new_unsolicited' % org_id
+    if not r.get(key):
+        with r.lock(key, timeout=ORG_LABELLING_TIMEOUT):
+            org = Org.objects.get(pk=org_id)
+            _process_new_org_unsolicited(org)
+    else:
+        logger.info("Skipping labelling for org #%d as it's still running from a previous dispatch" % org_id)
+
 
-    client = org.get_temba_client()
+def _process_new_org_unsolicited(org):
+    from .models import Message, MessageSyncCursor
 
-    # when was this task last run?
-    last_result = org.get_task_result(TaskType.label_messages)
-    if last_result:
-        last_time = ms_to_datetime(last_result['time'])
+    cursor = MessageSyncCursor.get_for_org(org)
+
+    # fetch from the newest message we've processed, or if we've never processed any, from when this task last ran
+    if cursor.last_msg_on:
+        last_time = cursor.last_msg_on
     else:
-        # if first time (or Redis bombed...) then we'll fetch back to 3 hours ago
-        last_time = timezone.now() - timedelta(hours=3)
+        last_result = org.get_task_result(TaskType.label_messages)
+        if last_result:
+            last_time = ms_to_datetime(last_result['time'])
+        else:
+            # if first time then we'll fetch back to 3 hours ago
+            last_time = timezone.now() - timedelta(hours=3)
 
     this_time = timezone.now()
+    started = time.time()
 
-    num_messages = 0
-    num_labelled = 0
-
-    # grab all un-processed unsolicited messages
-    pager = client.pager()
-    while True:
-        messages = client.get_messages(direction='I', _types=['I'], archived=False,
-                                       after=last_time, before=this_time, pager=pager)
-        num_messages += len(messages)
-        num_labelled += Message.process_unsolicited(org, messages)
+    # grab and process all un-processed unsolicited messages
+    counts = Message.process_all_unsolicited(org, cursor, direction='I', _types=['I'], archived=False,
+                                             after=last_time, before=this_time)
 
-        if not pager.has_more():
-            break
+    duration = time.time() - started
 
-    print "Processed %d new unsolicited messages and labelled %d" % (num_messages, num_labelled)
+    logger.info("Processed %d new unsolicited messages (skipped %d already processed) and labelled %d for org #%d in "
+                "%.3f seconds (%d API calls, %d saved by buffering)"
+                % (counts['messages'], counts['skipped'], counts['labelled'], org.pk, duration,
+                   counts['api_calls'], counts['api_calls_saved']))
 
     org.set_task_result(TaskType.label_messages, {'time': datetime_to_ms(this_time),
-                                                  'counts': {'messages': num_messages, 'labelled': num_labelled}})
+                                                  'duration': duration,
+                                                  'counts': counts})
 
 
-@task
-def message_export(export_id):
-    from .models import MessageExport
+@task(bind=True, max_retries=CONTACT_PREPARE_MAX_RETRIES)
+def prepare_contact_for_case(self, contact_id):
+    """
+    Prepares a contact in RapidPro for a newly opened case, i.e. suspends them from groups, expires their flow runs
+    and archives their messages
+    """
+    from .models import Case, Contact, is_retryable_error, CASE_CONTACT_LOCK_KEY, CASE_CONTACT_LOCK_TIMEOUT
+
+    contact = Contact.objects.select_related('org').get(pk=contact_id)
+
+    # hold the contact's lock so that a case can't be closed, restoring the contact's groups, while we prepare them
+    r = get_redis_connection()
+    with r.lock(CASE_CONTACT_LOCK_KEY % (contact.org_id, contact.uuid), timeout=CASE_CONTACT_LOCK_TIMEOUT):
+        # case may have been closed already, in which case contact shouldn't be suspended from groups. Locking open
+        # cases waits for a close which hasn't been committed yet.
+        with transaction.atomic():
+            has_open_case = Case.objects.select_for_update().filter(contact=contact, closed_on=None).exists()
+
+        if not has_open_case:
+            logger.info("Not preparing contact #%d as they no longer have an open case" % contact_id)
+            return
+
+        try:
+            contact.prepare_for_case()
+        except TembaException as ex:
+            if not is_retryable_error(ex):
+                raise
+
+            retries = self.request.retries
+            logger.warning("Unable to prepare contact #%d for case (attempt %d), will retry"
+                           % (contact_id, retries + 1))
+            raise self.retry(exc=ex, countdown=CONTACT_PREPARE_RETRY_DELAY * 2 ** retries)
+
+
+@task(bind=True, acks_late=True, max_retries=MESSAGE_EXPORT_MAX_RETRIES)
+def message_export(self, export_id):
+    """
+    Exports the next chunk of a message export, and queues another task for the following chunk until the export is
+    complete. As progress is recorded after each chunk, an interrupted export resumes when this is re-run, and chunks
+    which fail because RapidPro is unavailable are retried. Other failures, or running out of retries, fail the export.
+    """
+    from .models import MessageExport, is_retryable_error, MESSAGE_EXPORT_LOCK_KEY, MESSAGE_EXPORT_LOCK_TIMEOUT
 
     export = MessageExport.objects.get(pk=export_id)
-    export.do_export()
+
+    # a redelivered task mustn't export the same chunk as a worker which is still exporting it
+    lock = get_redis_connection().lock(MESSAGE_EXPORT_LOCK_KEY % export_id, timeout=MESSAGE_EXPORT_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        logger.info("Skipping export #%d as it's already being exported by another task" % export_id)
+        return
+
+    retry_ex = None
+    try:
+        # another task may have exported a chunk whilst we were getting the lock
+        export.refresh_from_db()
+        if export.is_finished():
+            return
+
+        started = time.time()
+        counts = export.export_chunk()
+        duration = time.time() - started
+    except TembaException as ex:
+        if not is_retryable_error(ex) or self.request.retries >= self.max_retries:
+            export.fail()
+            raise
+        retry_ex = ex
+    except Exception:
+        export.fail()
+        raise
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            # our lock expired during the chunk, which isn't a failure of the chunk itself
+            logger.warning("Lock for export #%d expired before its chunk was exported" % export_id)
+
+    if retry_ex:
+        retries = self.request.retries
+        logger.warning("Unable to export chunk of export #%d (attempt %d), will retry" % (export_id, retries + 1))
+        raise self.retry(exc=retry_ex, countdown=MESSAGE_EXPORT_RETRY_DELAY * 2 ** retries)
+
+    if counts:
+        logger.info("Exported %d messages in %d pages for export #%d in %.3f seconds (%d contacts from cache, %.3f "
+                    "seconds resolving %d contacts in %d API calls, %d retries)"
+                    % (counts['messages'], counts['pages'], export.pk, duration, counts['contact_cache_hits'],
+                       counts['contact_time'], counts['contact_cache_misses'], counts['contact_calls'],
+                       counts['contact_retries']))
+
+    if export.is_finished():
+        logger.info("Completed export #%d of %d messages for org #%d" % (export.pk, export.rows_done, export.org_id))
+    else:
+        message_export.delay(export_id)
+
+
+@task
+def rebuild_case_counts(org_id):
+    """
+    Rebuilds all case counts for the given org
+    """
+    from .models import CaseCount
+
+    CaseCount.rebuild(Org.objects.get(pk=org_id))
+
+
+@task
+def publish_event(org_id, event_type, data, partner_ids):
+    """
+    Publishes an event to the push channels of an org and the given partners
+    """
+    from .push import send_event
+
+    send_event(org_id, event_type, data, partner_ids)
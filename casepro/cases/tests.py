@@ -1,31 +1,44 @@
 # coding=utf-8
 from __future__ import absolute_import, unicode_literals
 
+import codecs
+import json
 import pytz
+import threading
 
 from datetime import date, datetime
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
-from django.core.urlresolvers import reverse
-from django.test.utils import override_settings
+from django.core.files.storage import default_storage
+from django.core.urlresolvers import reverse, resolve
+from django.db import connection
+from django.test.utils import override_settings, CaptureQueriesContext
 from django.utils import timezone
-from mock import patch, call
-from temba_client.base import TembaPager
+from mock import patch, call, ANY, Mock
+from redis_cache import get_redis_connection
+from requests import HTTPError
+from temba_client.base import TembaPager, TembaNoSuchObjectError, TembaConnectionError, TembaAPIError
 from temba_client.types import Contact as TembaContact, Group as TembaGroup, Label as TembaLabel, Message as TembaMessage
 from temba_client.types import Broadcast as TembaBroadcast
 from temba_client.utils import format_iso8601, parse_iso8601
 from casepro.orgs_ext import TaskType
 from casepro.profiles import ROLE_ANALYST, ROLE_MANAGER
 from casepro.test import BaseCasesTest
-from . import safe_max, normalize, match_keywords, truncate, str_to_bool
+from . import safe_max, normalize, match_keywords, truncate, str_to_bool, json_encode, format_json_datetime
+from . import KeywordMatcher, SYSTEM_LABEL_FLAGGED
 from .context_processors import contact_ext_url, sentry_dsn
-from .models import AccessLevel, Case, CaseAction, CaseEvent, Contact, Group, Label, Message, MessageAction
-from .models import MessageExport, Partner, Outgoing
-from .tasks import process_new_unsolicited
-from .utils import datetime_to_microseconds, microseconds_to_datetime
+from .models import AccessLevel, Case, CaseAccess, CaseAction, CaseCount, CaseEvent, Contact, ContactCache
+from .models import ContactFetcher, Group, Label, Message, MessageAction, Outgoing
+from .models import LabelIndex, MessageExport, MessageSearchCache, MessageSyncCursor, MessageWriteBuffer, Partner
+from .push import send_event, EventType, EventWaiter
+from .tasks import process_new_unsolicited, message_export
+from .utils import datetime_to_microseconds, microseconds_to_datetime, prefetch, BoundedThreadPool, LRUCache
+from .utils import RateLimiter
 
 
 class CaseTest(BaseCasesTest):
+    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory')
     @patch('dash.orgs.models.TembaClient.get_messages')
     @patch('dash.orgs.models.TembaClient.archive_messages')
     @patch('dash.orgs.models.TembaClient.get_contact')
@@ -212,6 +225,40 @@ class CaseTest(BaseCasesTest):
         self.assertFalse(case3.is_new)
         self.assertEqual(case, case3)
 
+    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory')
+    @patch('dash.orgs.models.TembaClient.get_messages')
+    @patch('dash.orgs.models.TembaClient.get_contact')
+    @patch('dash.orgs.models.TembaClient.remove_contacts')
+    @patch('dash.orgs.models.TembaClient.expire_contacts')
+    def test_prepare_contact_retries(self, mock_expire_contacts, mock_remove_contacts, mock_get_contact,
+                                     mock_get_messages):
+        self.unicef.set_suspend_groups(['G-021'])
+        mock_get_contact.return_value = TembaContact.create(uuid='C-001', groups=['G-021', 'G-023'])
+        mock_get_messages.return_value = []
+        mock_remove_contacts.side_effect = [TembaConnectionError(), None, None]
+        mock_expire_contacts.side_effect = [TembaConnectionError(), None]
+
+        d1 = datetime(2014, 1, 2, 6, 0, tzinfo=timezone.utc)
+        msg = TembaMessage.create(id=123, contact='C-001', created_on=d1, text="Hello")
+        Case.get_or_open(self.unicef, self.user1, [self.aids], msg, "Summary", self.moh)
+
+        # preparing the contact is retried after failing to connect, finishing removing them from the groups which
+        # the first attempt recorded, rather than fetching their groups again
+        self.assertEqual(mock_expire_contacts.call_count, 2)
+        self.assertEqual(mock_get_contact.call_count, 1)
+        mock_remove_contacts.assert_has_calls([call(['C-001'], group_uuid='G-021')] * 3)
+        self.assertEqual(Contact.objects.get(uuid='C-001').suspended_groups, ['G-021'])
+
+        # API errors which won't go away aren't retried
+        mock_remove_contacts.side_effect = None
+        mock_expire_contacts.reset_mock()
+        mock_expire_contacts.side_effect = TembaAPIError(HTTPError(response=Mock(status_code=404)))
+
+        msg = TembaMessage.create(id=234, contact='C-002', created_on=d1, text="Hello")
+        self.assertRaises(TembaAPIError, Case.get_or_open, self.unicef, self.user1, [self.aids], msg, "Summary",
+                          self.moh)
+        self.assertEqual(mock_expire_contacts.call_count, 1)
+
     def test_get_all(self):
         d1 = datetime(2014, 1, 2, 6, 0, tzinfo=timezone.utc)
         msg1 = TembaMessage.create(id=123, contact='C-001', created_on=d1, text="Hello 1")
@@ -250,6 +297,105 @@ class CaseTest(BaseCasesTest):
         self.assertEqual(set(Case.get_closed(self.unicef)), {case2})
         self.assertEqual(set(Case.get_closed(self.unicef, user=self.user1, label=self.pregnancy)), {case2})
 
+    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory')
+    def test_counts(self):
+        d1 = datetime(2014, 1, 2, 6, 0, tzinfo=timezone.utc)
+        msg1 = TembaMessage.create(id=123, contact='C-001', created_on=d1, text="Hello 1")
+        case1 = Case.get_or_open(self.unicef, self.user1, [self.aids], msg1, "Summary", self.moh,
+                                 update_contact=False)
+        msg2 = TembaMessage.create(id=234, contact='C-002', created_on=d1, text="Hello 2")
+        case2 = Case.get_or_open(self.unicef, self.user1, [self.pregnancy], msg2, "Summary", self.moh,
+                                 update_contact=False)
+
+        def assert_counts(user, open_count, closed_count):
+            self.assertEqual(CaseCount.get_open_count(self.unicef, user), open_count)
+            self.assertEqual(CaseCount.get_closed_count(self.unicef, user), closed_count)
+            self.assertEqual(Case.get_open(self.unicef, user).count(), open_count)
+            self.assertEqual(Case.get_closed(self.unicef, user).count(), closed_count)
+
+        assert_counts(self.admin, 2, 0)
+        assert_counts(self.user1, 2, 0)
+        assert_counts(self.user3, 1, 0)  # WHO can only see case #1 by its label
+
+        case2.reassign(self.admin, self.who)
+        assert_counts(self.user1, 2, 0)  # MOH can still see case #2 by its label
+        assert_counts(self.user3, 2, 0)
+
+        case2.unlabel(self.admin, self.pregnancy)
+        assert_counts(self.user1, 1, 0)
+        assert_counts(self.user3, 2, 0)
+
+        case1.close(self.admin)
+        assert_counts(self.admin, 1, 1)
+        assert_counts(self.user1, 0, 1)
+        assert_counts(self.user3, 1, 1)
+
+        case2.label(self.admin, self.pregnancy)
+        case1.reopen(self.admin, update_contact=False)
+        assert_counts(self.admin, 2, 0)
+        assert_counts(self.user1, 2, 0)
+
+        self.assertEqual(CaseCount.objects.get(org=self.unicef, item_type=CaseCount.TYPE_LABEL,
+                                               item_id=self.pregnancy.pk, state=CaseCount.STATE_OPEN).count, 1)
+
+        # rebuilding from scratch should give the same counts
+        def non_zero_counts():
+            counts = CaseCount.objects.filter(org=self.unicef).exclude(count=0)
+            return set(counts.values_list('item_type', 'item_id', 'state', 'count'))
+
+        counts = non_zero_counts()
+        CaseCount.rebuild(self.unicef)
+        self.assertEqual(non_zero_counts(), counts)
+
+        # partners no longer see cases through a released label
+        self.aids.release()
+        assert_counts(self.user3, 1, 0)
+
+    def test_access(self):
+        d1 = datetime(2014, 1, 2, 6, 0, tzinfo=timezone.utc)
+        msg1 = TembaMessage.create(id=123, contact='C-001', created_on=d1, text="Hello 1")
+        case1 = Case.get_or_open(self.unicef, self.user1, [self.aids], msg1, "Summary", self.moh,
+                                 update_contact=False)
+        msg2 = TembaMessage.create(id=234, contact='C-002', created_on=d1, text="Hello 2")
+        case2 = Case.get_or_open(self.unicef, self.user1, [self.pregnancy], msg2, "Summary", self.moh,
+                                 update_contact=False)
+
+        admin_access = CaseAccess(self.unicef, self.admin)
+        moh_access = CaseAccess(self.unicef, self.user1)
+        who_access = CaseAccess(self.unicef, self.user3)
+        klab_access = CaseAccess(self.unicef, self.user4)
+
+        self.assertEqual(admin_access.get_level(case1), AccessLevel.update)
+        self.assertEqual(moh_access.get_level(case1), AccessLevel.update)
+        self.assertEqual(who_access.get_level(case1), AccessLevel.read)  # by AIDS label
+        self.assertEqual(who_access.get_level(case2), AccessLevel.none)
+        self.assertEqual(klab_access.get_level(case1), AccessLevel.none)
+
+        # annotating prefetched cases needs no further queries
+        cases = Case.prefetch_for_json(Case.objects.filter(org=self.unicef).order_by('pk'))
+        cases = list(cases)
+        with self.assertNumQueries(0):
+            cases = who_access.annotate(cases)
+
+        self.assertEqual([c.access for c in cases], [AccessLevel.read, AccessLevel.none])
+
+    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory')
+    @patch('casepro.cases.push.send_event')
+    def test_publish_change(self, mock_send_event):
+        d1 = datetime(2014, 1, 2, 6, 0, tzinfo=timezone.utc)
+        msg = TembaMessage.create(id=123, contact='C-001', created_on=d1, text="Hello")
+        case = Case.get_or_open(self.unicef, self.user1, [self.pregnancy], msg, "Summary", self.who,
+                                update_contact=False)
+
+        # opening is published to the assignee and the partners of the case's labels
+        mock_send_event.assert_called_once_with(self.unicef.pk, 'case', {'id': case.pk},
+                                                sorted([self.moh.pk, self.who.pk]))
+        mock_send_event.reset_mock()
+
+        case.reassign(self.user3, self.moh)
+
+        mock_send_event.assert_called_once_with(self.unicef.pk, 'case', {'id': case.pk}, [self.moh.pk])
+
     def test_get_open_for_contact_on(self):
         d0 = datetime(2014, 1, 5, 0, 0, tzinfo=timezone.utc)
         d1 = datetime(2014, 1, 10, 0, 0, tzinfo=timezone.utc)
@@ -285,6 +431,19 @@ class CaseTest(BaseCasesTest):
         open_case = Case.get_open_for_contact_on(self.unicef, 'C-001', datetime(2014, 1, 16, 0, 0, tzinfo=timezone.utc))
         self.assertEqual(open_case, case2)
 
+        # check same lookups for a batch of messages
+        msg1 = TembaMessage.create(id=301, contact='C-001', created_on=datetime(2014, 1, 4, 0, 0, tzinfo=timezone.utc))
+        msg2 = TembaMessage.create(id=302, contact='C-001', created_on=datetime(2014, 1, 7, 0, 0, tzinfo=timezone.utc))
+        msg3 = TembaMessage.create(id=303, contact='C-001', created_on=datetime(2014, 1, 13, 0, 0, tzinfo=timezone.utc))
+        msg4 = TembaMessage.create(id=304, contact='C-001', created_on=datetime(2014, 1, 16, 0, 0, tzinfo=timezone.utc))
+        msg5 = TembaMessage.create(id=305, contact='C-002', created_on=datetime(2014, 1, 16, 0, 0, tzinfo=timezone.utc))
+
+        with self.assertNumQueries(1):
+            open_cases = Case.get_open_for_messages(self.unicef, [msg1, msg2, msg3, msg4, msg5])
+
+        self.assertEqual(open_cases, {302: case1, 304: case2})
+        self.assertEqual(Case.get_open_for_messages(self.unicef, []), {})
+
 
 class CaseCRUDLTest(BaseCasesTest):
     @patch('dash.orgs.models.TembaClient.get_message')
@@ -338,6 +497,20 @@ class CaseCRUDLTest(BaseCasesTest):
         self.assertEqual(case2.assignee, self.moh)
         self.assertEqual(set(case2.labels.all()), {self.aids})
 
+        # opening a case for another message from the same contact gives the same case
+        msg3 = TembaMessage.create(id=103, contact='C-002', created_on=timezone.now(), text="Hello again",
+                                   direction='I', labels=['AIDS'])
+        mock_get_message.return_value = msg3
+
+        response = self.url_post('unicef', url, {'message': 103, 'summary': "Summary"})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.json['is_new'])
+        self.assertEqual(response.json['case']['id'], case2.pk)
+        self.assertEqual(Case.objects.filter(contact__uuid='C-002').count(), 1)
+
+        # view isn't run in a transaction, so a new case is committed before the contact's lock is released
+        self.assertEqual(resolve(url).func._non_atomic_requests, {'default'})
+
     @patch('dash.orgs.models.TembaClient.get_contact')
     @patch('dash.orgs.models.TembaClient.get_messages')
     def test_read(self, mock_get_messages, mock_get_contact):
@@ -356,9 +529,128 @@ class CaseCRUDLTest(BaseCasesTest):
         response = self.url_get('unicef', url)
         self.assertEqual(response.status_code, 200)
 
+    def test_search(self):
+        d1 = datetime(2014, 1, 2, 6, 0, tzinfo=timezone.utc)
+        d2 = datetime(2014, 1, 2, 7, 0, tzinfo=timezone.utc)
+
+        # open 30 cases, half at each time so that some share the same opened on time
+        cases = []
+        for c in range(30):
+            msg = TembaMessage.create(id=100 + c, contact='C-%03d' % c, created_on=d1, text="Hello")
+            labels = [self.aids] if c % 2 else [self.pregnancy]
+            with patch.object(timezone, 'now', return_value=d1 if c < 15 else d2):
+                cases.append(Case.get_or_open(self.unicef, self.user1, labels, msg, "Summary", self.moh,
+                                              update_contact=False))
+
+        url = reverse('cases.case_search')
+
+        self.login(self.admin)
+
+        # page by number
+        response = self.url_get('unicef', '%s?view=open' % url)
+        self.assertEqual(len(response.json['results']), 25)
+        self.assertTrue(response.json['has_more'])
+        self.assertEqual(response.json['total'], 30)
+        self.assertEqual(response.json['results'][0]['access'], 'update')
+
+        # page by cursor
+        response = self.url_get('unicef', '%s?view=open&cursor=' % url)
+        self.assertEqual(len(response.json['results']), 25)
+        self.assertTrue(response.json['has_more'])
+        self.assertEqual(response.json['total'], 30)  # from case counts
+        first_page = [c['id'] for c in response.json['results']]
+
+        response = self.url_get('unicef', '%s?view=open&cursor=%s' % (url, response.json['cursor']))
+        self.assertEqual(len(response.json['results']), 5)
+        self.assertFalse(response.json['has_more'])
+        self.assertIsNone(response.json['cursor'])
+        second_page = [c['id'] for c in response.json['results']]
+
+        # cases are ordered newest first, and by id where opened at the same time
+        self.assertEqual(first_page + second_page, [c.pk for c in reversed(cases)])
+
+        # total isn't counted for filtered searches unless it's requested
+        response = self.url_get('unicef', '%s?view=open&label=%d&cursor=' % (url, self.aids.pk))
+        self.assertEqual(len(response.json['results']), 15)
+        self.assertIsNone(response.json['total'])
+
+        response = self.url_get('unicef', '%s?view=open&label=%d&cursor=&total=1' % (url, self.aids.pk))
+        self.assertEqual(response.json['total'], 15)
+
+        # partners who only see cases through their labels can't update them
+        self.login(self.user3)
+        response = self.url_get('unicef', '%s?view=open&label=%d&cursor=' % (url, self.aids.pk))
+        self.assertEqual({c['access'] for c in response.json['results']}, {'read'})
+        self.login(self.admin)
+
+        # invalid cursor
+        response = self.url_get('unicef', '%s?view=open&cursor=xyz' % url)
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(LONG_POLL_MAX_WAIT=10)
+    @patch('casepro.cases.push.EventWaiter.wait')
+    def test_search_wait(self, mock_wait):
+        d1 = datetime(2014, 1, 2, 6, 0, tzinfo=timezone.utc)
+        d2 = datetime(2014, 1, 2, 7, 0, tzinfo=timezone.utc)
+        msg = TembaMessage.create(id=101, contact='C-001', created_on=d1, text="Hello")
+        with patch.object(timezone, 'now', return_value=d2):
+            case = Case.get_or_open(self.unicef, self.user1, [self.aids], msg, "Summary", self.moh,
+                                    update_contact=False)
+
+        url = reverse('cases.case_search')
+
+        self.login(self.user1)
+
+        # if there are new cases, they're returned without waiting
+        response = self.url_get('unicef', '%s?view=open&after=%s&wait=30' % (url, format_iso8601(d1)))
+        self.assertEqual([c['id'] for c in response.json['results']], [case.pk])
+        self.assertFalse(mock_wait.called)
+
+        # if not, request waits for a change up to the maximum wait
+        mock_wait.return_value = False
+        response = self.url_get('unicef', '%s?view=open&after=%s&wait=30' % (url, format_iso8601(d2)))
+        self.assertEqual(response.json['results'], [])
+        mock_wait.assert_called_once_with(10)
+
+    def test_search_query_count(self):
+        url = reverse('cases.case_search')
+        d1 = datetime(2014, 1, 2, 6, 0, tzinfo=timezone.utc)
+
+        def open_cases(start, num):
+            for c in range(start, start + num):
+                msg = TembaMessage.create(id=100 + c, contact='C-%03d' % c, created_on=d1, text="Hello")
+                Case.get_or_open(self.unicef, self.user1, [self.aids, self.pregnancy], msg, "Summary", self.moh,
+                                 update_contact=False)
+
+        def search_query_count(params):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.url_get('unicef', '%s?%s' % (url, params))
+            self.assertEqual(response.status_code, 200)
+            return len(response.json['results']), len(queries)
+
+        self.login(self.user1)
+
+        open_cases(0, 2)
+        search_query_count('view=open')  # warm up any caches
+
+        num_results, few_queries = search_query_count('view=open')
+        self.assertEqual(num_results, 2)
+        num_results, few_cursor_queries = search_query_count('view=open&cursor=')
+        self.assertEqual(num_results, 2)
+
+        open_cases(2, 23)
+        num_results, many_queries = search_query_count('view=open')
+        self.assertEqual(num_results, 25)
+        self.assertEqual(many_queries, few_queries)
+
+        num_results, many_cursor_queries = search_query_count('view=open&cursor=')
+        self.assertEqual(num_results, 25)
+        self.assertEqual(many_cursor_queries, few_cursor_queries)
+
     @patch('dash.orgs.models.TembaClient.get_messages')
     @patch('dash.orgs.models.TembaClient.create_broadcast')
-    def test_timeline(self, mock_create_broadcast, mock_get_messages):
+    @patch('dash.orgs.models.TembaClient.label_messages')
+    def test_timeline(self, mock_label_messages, mock_create_broadcast, mock_get_messages):
         d1 = datetime(2014, 1, 1, 13, 0, tzinfo=timezone.utc)
         d2 = datetime(2014, 1, 2, 13, 0, tzinfo=timezone.utc)
 
@@ -376,9 +668,9 @@ class CaseCRUDLTest(BaseCasesTest):
         # log in as non-administrator
         self.login(self.user1)
 
-        # request all of a timeline up to now
-        response = self.url_get('unicef', '%s?after=' % timeline_url)
-        t0 = microseconds_to_datetime(response.json['max_time'])
+        # request all of a timeline
+        response = self.url_get('unicef', '%s?cursor=' % timeline_url)
+        cursor = response.json['cursor']
 
         self.assertEqual(len(response.json['results']), 2)
         self.assertEqual(response.json['results'][0]['type'], 'M')
@@ -387,26 +679,26 @@ class CaseCRUDLTest(BaseCasesTest):
         self.assertEqual(response.json['results'][0]['item']['direction'], 'I')
         self.assertEqual(response.json['results'][1]['type'], 'A')
         self.assertEqual(response.json['results'][1]['item']['action'], 'O')
+        self.assertTrue(response.json['reset'])
 
-        mock_get_messages.assert_called_once_with(contacts=['C-001'], after=d2, before=t0)
+        mock_get_messages.assert_called_once_with(contacts=['C-001'], after=d2, before=None)
         mock_get_messages.reset_mock()
 
         # page looks for new timeline activity
-
-        response = self.url_get('unicef', '%s?after=%s' % (timeline_url, datetime_to_microseconds(t0)))
-        t1 = microseconds_to_datetime(response.json['max_time'])
+        response = self.url_get('unicef', '%s?cursor=%s' % (timeline_url, cursor))
+        cursor = response.json['cursor']
         self.assertEqual(len(response.json['results']), 0)
+        self.assertFalse(response.json['reset'])
 
         # shouldn't hit the RapidPro API
         self.assertEqual(mock_get_messages.call_count, 0)
-        mock_get_messages.reset_mock()
 
         # another user adds a note
         case.add_note(self.user2, "Looks interesting")
 
         # page again looks for new timeline activity
-        response = self.url_get('unicef', '%s?after=%s' % (timeline_url, datetime_to_microseconds(t1)))
-        t2 = microseconds_to_datetime(response.json['max_time'])
+        response = self.url_get('unicef', '%s?cursor=%s' % (timeline_url, cursor))
+        cursor = response.json['cursor']
 
         self.assertEqual(len(response.json['results']), 1)
         self.assertEqual(response.json['results'][0]['type'], 'A')
@@ -414,7 +706,10 @@ class CaseCRUDLTest(BaseCasesTest):
 
         # still no reason to hit the RapidPro API
         self.assertEqual(mock_get_messages.call_count, 0)
-        mock_get_messages.reset_mock()
+
+        # contact sends a reply which will be processed after the next page refresh
+        d4 = timezone.now()
+        msg4 = TembaMessage.create(id=104, contact='C-001', created_on=d4, text="OK thanks", labels=[], direction='I')
 
         # user sends an outgoing message
         d3 = timezone.now()
@@ -427,8 +722,8 @@ class CaseCRUDLTest(BaseCasesTest):
         mock_get_messages.return_value = [msg3]
 
         # page again looks for new timeline activity
-        response = self.url_get('unicef', '%s?after=%s' % (timeline_url, datetime_to_microseconds(t2)))
-        t3 = microseconds_to_datetime(response.json['max_time'])
+        response = self.url_get('unicef', '%s?cursor=%s' % (timeline_url, cursor))
+        cursor = response.json['cursor']
 
         self.assertEqual(len(response.json['results']), 1)
         self.assertEqual(response.json['results'][0]['type'], 'M')
@@ -436,37 +731,74 @@ class CaseCRUDLTest(BaseCasesTest):
         self.assertEqual(response.json['results'][0]['item']['direction'], 'O')
 
         # this time we will have hit the RapidPro API because we know there's a new outgoing message
-        mock_get_messages.assert_called_once_with(contacts=['C-001'], after=t2, before=t3)
+        mock_get_messages.assert_called_once_with(contacts=['C-001'], after=d3, before=None)
         mock_get_messages.reset_mock()
 
-        # contact sends a reply
-        d4 = timezone.now()
-        msg4 = TembaMessage.create(id=104, contact='C-001', created_on=d4, text="OK thanks", labels=[], direction='I')
+        # reply is processed, and has an earlier time than the last page refresh
         case.reply_event(msg4)
-        mock_get_messages.return_value = [msg4]
+        mock_get_messages.return_value = [msg4, msg3]
 
         # page again looks for new timeline activity
-        response = self.url_get('unicef', '%s?after=%s' % (timeline_url, datetime_to_microseconds(t3)))
-        t4 = microseconds_to_datetime(response.json['max_time'])
+        response = self.url_get('unicef', '%s?cursor=%s' % (timeline_url, cursor))
+        cursor = response.json['cursor']
 
         self.assertEqual(len(response.json['results']), 1)
         self.assertEqual(response.json['results'][0]['type'], 'M')
         self.assertEqual(response.json['results'][0]['item']['text'], "OK thanks")
         self.assertEqual(response.json['results'][0]['item']['direction'], 'I')
+        self.assertFalse(response.json['reset'])
 
-        # again we will have hit the RapidPro API - this time we know there's a new incoming message
-        mock_get_messages.assert_called_once_with(contacts=['C-001'], after=t3, before=t4)
+        # again we will have hit the RapidPro API - this time from the time of the new incoming message
+        mock_get_messages.assert_called_once_with(contacts=['C-001'], after=d4, before=None)
         mock_get_messages.reset_mock()
 
         # page again looks for new timeline activity
-        response = self.url_get('unicef', '%s?after=%s' % (timeline_url, datetime_to_microseconds(t4)))
-        t5 = microseconds_to_datetime(response.json['max_time'])
-
+        response = self.url_get('unicef', '%s?cursor=%s' % (timeline_url, cursor))
         self.assertEqual(len(response.json['results']), 0)
 
         # back to having no reason to hit the RapidPro API
         self.assertEqual(mock_get_messages.call_count, 0)
 
+        # page is reloaded and requests the whole timeline, which is served from the cache
+        response = self.url_get('unicef', '%s?cursor=' % timeline_url)
+
+        self.assertEqual([r['type'] for r in response.json['results']], ['M', 'A', 'A', 'M', 'M'])
+        self.assertEqual(response.json['results'][3]['item']['text'], "It's bad")
+        self.assertEqual(response.json['results'][4]['item']['text'], "OK thanks")
+        self.assertEqual(mock_get_messages.call_count, 0)
+
+        # unless labels have changed since the timeline was cached
+        LabelIndex.invalidate(self.unicef)
+        mock_get_messages.return_value = [msg2, msg3, msg4]
+
+        response = self.url_get('unicef', '%s?cursor=%s' % (timeline_url, cursor))
+        cursor = response.json['cursor']
+        self.assertEqual(len(response.json['results']), 5)
+        self.assertTrue(response.json['reset'])
+        self.assertEqual(mock_get_messages.call_count, 1)
+        mock_get_messages.reset_mock()
+
+        # or one of its messages has been flagged
+        msg2.labels = [self.aids.name]
+        Message.mirror(self.unicef, [msg2])
+        Message.bulk_flag(self.unicef, self.user1, [102])
+        msg2.labels = [self.aids.name, SYSTEM_LABEL_FLAGGED]
+
+        response = self.url_get('unicef', '%s?cursor=%s' % (timeline_url, cursor))
+        cursor = response.json['cursor']
+        self.assertEqual(len(response.json['results']), 5)
+        self.assertTrue(response.json['reset'])
+        self.assertTrue(response.json['results'][0]['item']['flagged'])
+        self.assertEqual(mock_get_messages.call_count, 1)
+        mock_get_messages.reset_mock()
+
+        # or a reply has been recorded by the labelling task
+        CaseEvent.bulk_create_replies([(case, msg4)])
+
+        response = self.url_get('unicef', '%s?cursor=%s' % (timeline_url, cursor))
+        self.assertTrue(response.json['reset'])
+        self.assertEqual(mock_get_messages.call_count, 1)
+
 
 class ContactTest(BaseCasesTest):
     @patch('dash.orgs.models.TembaClient.get_contact')
@@ -482,6 +814,143 @@ class ContactTest(BaseCasesTest):
         # with field fetching
         self.assertEqual(contact.as_json(fetch_fields=True), {'uuid': 'C-001', 'fields': {'age': 32, 'gender': "M"}})
 
+        # contact is now cached
+        self.assertEqual(contact.as_json(fetch_fields=True), {'uuid': 'C-001', 'fields': {'age': 32, 'gender': "M"}})
+        self.assertEqual(mock_get_contact.call_count, 1)
+
+        # contact no longer exists in RapidPro
+        ContactCache.invalidate(self.unicef, ['C-001'])
+        mock_get_contact.side_effect = TembaNoSuchObjectError()
+        self.assertEqual(contact.as_json(fetch_fields=True), {'uuid': 'C-001', 'fields': {'age': None, 'gender': None}})
+
+    @patch('dash.orgs.models.TembaClient.get_messages')
+    @patch('dash.orgs.models.TembaClient.archive_messages')
+    def test_archive_messages(self, mock_archive_messages, mock_get_messages):
+        d1 = datetime(2014, 1, 2, 6, 0, tzinfo=timezone.utc)
+        msg1 = TembaMessage.create(id=101, contact='C-001', created_on=d1, text="What is aids?", labels=['AIDS'])
+        msg2 = TembaMessage.create(id=102, contact='C-001', created_on=d1, text="Hello", labels=['AIDS'])
+        Message.mirror(self.unicef, [msg1, msg2])
+        mock_get_messages.return_value = [msg1, msg2]
+
+        MessageSearchCache.invalidate(self.unicef)
+        search_version = cache.get('org:%d:message_search_version' % self.unicef.pk)
+
+        contact = Contact.get_or_create(self.unicef, 'C-001')
+        contact.archive_messages()
+
+        mock_archive_messages.assert_called_once_with(messages=[101, 102])
+
+        # local copies are archived and cached searches invalidated
+        self.assertTrue(Message.objects.get(pk=101).archived)
+        self.assertTrue(Message.objects.get(pk=102).archived)
+        self.assertNotEqual(cache.get('org:%d:message_search_version' % self.unicef.pk), search_version)
+
+    @patch('dash.orgs.models.TembaClient.get_contact')
+    @patch('dash.orgs.models.TembaClient.remove_contacts')
+    def test_suspend_groups(self, mock_remove_contacts, mock_get_contact):
+        self.unicef.set_suspend_groups(['G-021', 'G-022'])
+        contact = Contact.get_or_create(self.unicef, 'C-001')
+
+        # contact is cached before they're added to another group
+        mock_get_contact.return_value = TembaContact.create(uuid='C-001', groups=['G-021'], fields={})
+        contact.fetch()
+        mock_get_contact.return_value = TembaContact.create(uuid='C-001', groups=['G-021', 'G-022'], fields={})
+
+        # groups are fetched fresh from RapidPro rather than from the cache
+        contact.suspend_groups()
+        self.assertEqual(mock_get_contact.call_count, 2)
+        self.assertEqual(Contact.objects.get(pk=contact.pk).suspended_groups, ['G-021', 'G-022'])
+        mock_remove_contacts.assert_has_calls([call(['C-001'], group_uuid='G-021'),
+                                               call(['C-001'], group_uuid='G-022')])
+
+
+class ContactCacheTest(BaseCasesTest):
+    @patch('dash.orgs.models.TembaClient.expire_contacts')
+    @patch('dash.orgs.models.TembaClient.get_contact')
+    @patch('dash.orgs.models.TembaClient.get_contacts')
+    def test_get_many(self, mock_get_contacts, mock_get_contact, mock_expire_contacts):
+        mock_get_contacts.side_effect = lambda uuids: [
+            TembaContact.create(uuid=uuid, name="Bob", groups=['G-001'], fields={'age': 32})
+            for uuid in uuids if uuid != 'C-003'
+        ]
+        mock_get_contact.return_value = TembaContact.create(uuid='C-001', name="Bob", groups=[], fields={'age': 33})
+
+        stats_before = ContactCache.get_stats(self.unicef)
+
+        contact_cache = ContactCache(self.unicef)
+        contacts = contact_cache.get_many(['C-001', 'C-002', 'C-003'])
+
+        self.assertEqual(set(contacts.keys()), {'C-001', 'C-002'})
+        self.assertEqual(contacts['C-001'].groups, ['G-001'])
+        self.assertEqual(contacts['C-001'].fields, {'age': 32})
+        mock_get_contacts.assert_called_once_with(uuids=['C-001', 'C-002', 'C-003'])
+
+        # all contacts are now cached, including the one that doesn't exist
+        contacts = contact_cache.get_many(['C-003', 'C-002', 'C-001'])
+        self.assertEqual(set(contacts.keys()), {'C-001', 'C-002'})
+        self.assertEqual(contacts['C-002'].name, "Bob")
+        self.assertEqual(mock_get_contacts.call_count, 1)
+        self.assertEqual((contact_cache.num_hits, contact_cache.num_misses), (3, 3))
+
+        # expiring a contact's flow runs invalidates it
+        Contact.get_or_create(self.unicef, 'C-001').expire_flows()
+
+        self.assertEqual(contact_cache.get('C-001').fields, {'age': 33})
+        self.assertEqual(contact_cache.get('C-002').fields, {'age': 32})
+        self.assertIsNone(contact_cache.get('C-003'))
+        mock_get_contact.assert_called_once_with('C-001')
+
+        stats_after = ContactCache.get_stats(self.unicef)
+        self.assertEqual(stats_after['hits'] - stats_before['hits'], 5)
+        self.assertEqual(stats_after['misses'] - stats_before['misses'], 4)
+
+
+class ContactFetcherTest(BaseCasesTest):
+    @patch('casepro.cases.utils.RateLimiter.wait')
+    @patch('casepro.cases.models.time.sleep')
+    @patch('dash.orgs.models.TembaClient.get_contacts')
+    def test_fetch_many(self, mock_get_contacts, mock_sleep, mock_wait):
+        failures = {'C-000': 1}
+
+        def get_contacts(uuids):
+            if failures.get(uuids[0]):
+                failures[uuids[0]] -= 1
+                raise TembaConnectionError()
+            return [TembaContact.create(uuid=uuid) for uuid in uuids if uuid != 'C-010']
+
+        mock_get_contacts.side_effect = get_contacts
+
+        uuids = ['C-%03d' % i for i in range(60)]
+        fetcher = ContactFetcher(self.unicef, num_workers=2)
+        try:
+            contacts = fetcher.fetch_many(uuids)
+        finally:
+            fetcher.close()
+
+        # contacts are fetched in batches of 25, and the failed first batch is retried after a delay
+        self.assertEqual(set(contacts.keys()), set(uuids) - {'C-010'})
+        self.assertEqual(mock_get_contacts.call_count, 4)
+        self.assertEqual(fetcher.num_calls, 4)
+        self.assertEqual(fetcher.num_retries, 1)
+        mock_sleep.assert_called_once_with(1)
+
+        self.assertEqual(fetcher.fetch_many([]), {})
+
+        # fetches which keep failing eventually raise the error
+        mock_get_contacts.side_effect = TembaConnectionError()
+        fetcher = ContactFetcher(self.unicef, max_retries=2)
+        self.assertRaises(TembaConnectionError, fetcher.fetch_many, ['C-001'])
+        self.assertEqual(fetcher.num_calls, 3)
+        mock_sleep.assert_has_calls([call(1), call(2)])
+
+        # server errors are retried but other API errors aren't
+        mock_get_contacts.side_effect = [TembaAPIError(HTTPError(response=Mock(status_code=503))),
+                                         TembaAPIError(HTTPError(response=Mock(status_code=404)))]
+        fetcher = ContactFetcher(self.unicef)
+        self.assertRaises(TembaAPIError, fetcher.fetch_many, ['C-001'])
+        self.assertEqual(fetcher.num_calls, 2)
+        self.assertEqual(fetcher.num_retries, 1)
+
 
 class GroupTest(BaseCasesTest):
     def test_create(self):
@@ -561,6 +1030,63 @@ class HomeViewsTest(BaseCasesTest):
         # should not provide external contact links
         self.assertNotContains(response, "http://localhost:8001/contact/read/{}/")
 
+    @override_settings(EVENT_STREAM_KEEPALIVE=1)
+    def test_events(self):
+        url = reverse('cases.events')
+
+        response = self.url_get('unicef', url)
+        self.assertLoginRedirect(response, 'unicef', url)
+
+        # log in as a WHO user who only receives events for their partner
+        self.login(self.user3)
+
+        response = self.url_get('unicef', url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+
+        stream = iter(response.streaming_content)
+        self.assertEqual(next(stream), 'retry: 5000\n\n')
+
+        send_event(self.unicef.pk, 'case', {'id': 123}, [self.moh.pk])
+        send_event(self.unicef.pk, 'case', {'id': 234}, [self.moh.pk, self.who.pk])
+
+        # events are sent as they're published, with keep-alive comments in between
+        data = next(c for c in stream if c.startswith('data: '))
+        self.assertEqual(json.loads(data[6:]), {'type': 'case', 'data': {'id': 234}})
+        response.close()
+
+    @patch('dash.orgs.models.TembaClient.get_labels')
+    def test_home_data(self, mock_get_labels):
+        mock_get_labels.return_value = []
+
+        url = reverse('cases.inbox')
+
+        def get_data():
+            return json.loads(self.url_get('unicef', url).context['context_data_json'])
+
+        self.login(self.user3)
+
+        data = get_data()
+        self.assertEqual(data['user'], {'id': self.user3.pk, 'partner': {'id': self.who.pk, 'name': "WHO"}})
+        self.assertEqual([p['name'] for p in data['partners']], ["MOH", "WHO"])
+        self.assertEqual([l['name'] for l in data['labels']], ["AIDS"])  # only labels visible to WHO
+        self.assertEqual([g['name'] for g in data['groups']], ["Females", "Males"])
+
+        # data is cached so is the same on the next load
+        self.assertEqual(get_data(), data)
+
+        # until a new partner changes it
+        self.create_partner(self.unicef, "UNHCR")
+
+        self.assertEqual([p['name'] for p in get_data()['partners']], ["MOH", "UNHCR", "WHO"])
+
+        # administrators see all labels
+        self.login(self.admin)
+
+        data = get_data()
+        self.assertEqual(data['user'], {'id': self.admin.pk, 'partner': None})
+        self.assertEqual([l['name'] for l in data['labels']], ["AIDS", "Pregnancy"])
+
 
 class InitTest(BaseCasesTest):
     def test_safe_max(self):
@@ -584,6 +1110,28 @@ class InitTest(BaseCasesTest):
         self.assertTrue(match_keywords(text, ['big', 'little']))  # one match, one mis-match
         self.assertTrue(match_keywords(text, ['little lamb']))  # spaces ok
 
+    def test_json_encode(self):
+        d1 = datetime(2014, 1, 2, 3, 4, 5, 678901, tzinfo=timezone.utc)
+        self.assertEqual(json_encode({'time': d1}), '{"time": "2014-01-02T03:04:05.678Z"}')
+
+        # formatting dates ahead of encoding gives the same result
+        self.assertEqual(format_json_datetime(d1), "2014-01-02T03:04:05.678Z")
+        self.assertEqual(format_json_datetime(None), None)
+
+        data = {'time': format_json_datetime(d1), 'text': "Café", 'labels': [{'id': 1}], 'flagged': False}
+        self.assertEqual(json.loads(json_encode(data, primitives_only=True)), json.loads(json_encode(data)))
+
+    def test_keyword_matcher(self):
+        matcher = KeywordMatcher([('A', ['little', 'little lamb']), ('B', ['lamb']), ('C', ['sheep', 'lambburger']),
+                                  ('D', ['mary']), ('E', ['big', 'little'])])
+
+        self.assertEqual(matcher.match("Mary had a little lamb"), {'A', 'B', 'D', 'E'})  # overlapping keywords ok
+        self.assertEqual(matcher.match("lamb"), {'B'})
+        self.assertEqual(matcher.match("lambs"), set())  # complete word matches only
+        self.assertEqual(matcher.match(""), set())
+
+        self.assertEqual(KeywordMatcher([]).match("Mary had a little lamb"), set())
+
     def test_truncate(self):
         self.assertEqual(truncate("Hello World", 8), "Hello...")
         self.assertEqual(truncate("Hello World", 8, suffix="_"), "Hello W_")
@@ -638,6 +1186,26 @@ class LabelTest(BaseCasesTest):
         self.aids.release()
         self.assertFalse(self.aids.is_active)
 
+    def test_get_keyword_matcher(self):
+        matcher = Label.get_keyword_matcher(self.unicef)
+        self.assertEqual(matcher.match("is hiv the same as aids?"), {self.aids})
+        self.assertEqual(matcher.match("i'm pregnant, do i have hiv?"), {self.aids, self.pregnancy})
+
+        # matcher is re-used if labels haven't changed
+        self.assertIs(Label.get_keyword_matcher(self.unicef), matcher)
+
+        # but not if keywords change
+        self.pregnancy.keywords = 'pregnant,pregnancy,maternity'
+        self.pregnancy.save()
+
+        matcher = Label.get_keyword_matcher(self.unicef)
+        self.assertEqual(matcher.match("maternity leave"), {self.pregnancy})
+
+        # or if a label is released
+        self.aids.release()
+
+        self.assertEqual(Label.get_keyword_matcher(self.unicef).match("hiv"), set())
+
     def test_is_valid_keyword(self):
         self.assertTrue(Label.is_valid_keyword('kit'))
         self.assertTrue(Label.is_valid_keyword('kit-kat'))
@@ -651,6 +1219,39 @@ class LabelTest(BaseCasesTest):
         self.assertFalse(Label.is_valid_keyword('kat-'))  # can't end with a dash
 
 
+class LabelIndexTest(BaseCasesTest):
+    def test_get(self):
+        index = LabelIndex.get(self.unicef)
+        self.assertEqual([l.name for l in index.labels], ["AIDS", "Pregnancy"])
+        self.assertEqual([l.uuid for l in index.labels], ['L-001', 'L-002'])
+        self.assertEqual(set(index.by_name.keys()), {"AIDS", "Pregnancy"})
+
+        self.assertEqual([l.pk for l in index.get_all()], [self.aids.pk, self.pregnancy.pk])
+        self.assertEqual([l.pk for l in index.get_all(self.admin)], [self.aids.pk, self.pregnancy.pk])
+        self.assertEqual([l.pk for l in index.get_all(self.user1)], [self.aids.pk, self.pregnancy.pk])  # MOH user
+        self.assertEqual([l.pk for l in index.get_all(self.user3)], [self.aids.pk])  # WHO user
+
+        # index is re-used from memory without hitting the database
+        with self.assertNumQueries(0):
+            self.assertIs(LabelIndex.get(self.unicef), index)
+
+        # index is shared with other processes via Redis
+        with patch('casepro.cases.models._label_indexes', {}):
+            with self.assertNumQueries(0):
+                index2 = LabelIndex.get(self.unicef)
+                self.assertEqual(index2.version, index.version)
+                self.assertEqual([l.name for l in index2.labels], ["AIDS", "Pregnancy"])
+
+        # releasing a label invalidates the index
+        self.pregnancy.release()
+
+        index = LabelIndex.get(self.unicef)
+        self.assertEqual([l.name for l in index.labels], ["AIDS"])
+
+        # indexes are per-org
+        self.assertEqual([l.name for l in LabelIndex.get(self.nyaruka).labels], ["Code"])
+
+
 class LabelCRUDLTest(BaseCasesTest):
     @patch('dash.orgs.models.TembaClient.get_labels')
     def test_create(self, mock_get_labels):
@@ -755,6 +1356,9 @@ class LabelCRUDLTest(BaseCasesTest):
 
         mock_update_label.assert_called_once_with(uuid='L-002', name="Maternity")
 
+        # label index should have been rebuilt
+        self.assertEqual(set(LabelIndex.get(self.unicef).by_name.keys()), {"AIDS", "Maternity"})
+
     def test_list(self):
         url = reverse('cases.label_list')
 
@@ -796,6 +1400,245 @@ class MessageTest(BaseCasesTest):
 
         mock_archive_messages.assert_called_once_with([123, 234, 345])
 
+    @patch('dash.orgs.models.TembaClient.label_messages')
+    @patch('dash.orgs.models.TembaClient.archive_messages')
+    def test_write_buffer(self, mock_archive_messages, mock_label_messages):
+        d1 = datetime(2014, 1, 2, 6, 0, tzinfo=timezone.utc)
+        d2 = datetime(2014, 1, 2, 7, 0, tzinfo=timezone.utc)
+        msg1 = TembaMessage.create(id=101, contact='C-001', created_on=d1, text="Hello")
+        msg2 = TembaMessage.create(id=102, contact='C-002', created_on=d2, text="Hello")
+        msg3 = TembaMessage.create(id=103, contact='C-003', created_on=d1, text="Hello")
+
+        buffer = MessageWriteBuffer(self.unicef, batch_size=2)
+
+        # first page doesn't fill a batch so nothing is written
+        buffer.add({self.aids: [msg1]}, [msg3], [msg1], [])
+        self.assertEqual(mock_label_messages.call_count, 0)
+        self.assertEqual(mock_archive_messages.call_count, 0)
+
+        # second page fills a batch for the AIDS label which is written immediately
+        buffer.add({self.aids: [msg2], self.pregnancy: [msg2]}, [], [msg2], [])
+        mock_label_messages.assert_called_once_with(messages=[101, 102], label_uuid='L-001')
+        mock_label_messages.reset_mock()
+
+        # flushing writes everything else
+        buffer.flush()
+        mock_label_messages.assert_called_once_with(messages=[102], label_uuid='L-002')
+        mock_archive_messages.assert_called_once_with(messages=[103])
+
+        self.assertEqual(buffer.num_calls, 3)
+        self.assertEqual(buffer.num_unbuffered_calls, 4)
+
+        # message times are only recorded when asked
+        self.assertIsNone(self.unicef.get_last_message_time(labelled=True))
+        buffer.record_message_times()
+        self.assertEqual(self.unicef.get_last_message_time(labelled=True), d2)
+
+        # checkpointing writes and records everything, leaving the buffer empty so it doesn't grow across pages
+        pool = BoundedThreadPool(2, 2)
+        buffer = MessageWriteBuffer(self.unicef, pool, batch_size=2)
+        buffer.add({self.aids: [msg1]}, [msg3], [msg1], [])
+        buffer.add_processed([msg1, msg3], {101: ['AIDS']}, [])
+        buffer.checkpoint()
+
+        self.assertEqual(Message.objects.get(pk=101).labels, ['AIDS'])
+        self.assertEqual(buffer.processed, [])
+        self.assertEqual(buffer.processed_ids, set())
+        self.assertFalse(buffer.label_ids)
+        self.assertEqual(buffer.archive_ids, [])
+        self.assertEqual(buffer.new_label_ids, set())
+        self.assertIsNone(buffer.last_labelled_time)
+        pool.join()
+
+        # buffer older than its max age is flushed on next add
+        buffer = MessageWriteBuffer(self.unicef, batch_size=2, max_age=0)
+        buffer.add({self.aids: [msg3]}, [], [msg3], [])
+        mock_label_messages.assert_called_with(messages=[103], label_uuid='L-001')
+
+    @patch('dash.orgs.models.TembaClient.label_messages')
+    @patch('dash.orgs.models.TembaClient.archive_messages')
+    def test_process_unsolicited(self, mock_archive_messages, mock_label_messages):
+        d1 = datetime(2014, 1, 1, 7, 0, tzinfo=timezone.utc)
+        msg1 = TembaMessage.create(id=101, contact='C-001', text="What is aids?", created_on=d1, labels=[])
+        msg2 = TembaMessage.create(id=102, contact='C-002', text="Pregnant with HIV", created_on=d1, labels=[])
+        msg3 = TembaMessage.create(id=103, contact='C-003', text="Hello", created_on=d1, labels=['Flagged'])
+
+        self.assertEqual(Message.process_unsolicited(self.unicef, [msg1, msg2, msg3]), 2)
+
+        # check local copies of messages were created with the labels we added
+        self.assertEqual(Message.objects.get(pk=101).labels, ['AIDS'])
+        self.assertEqual(Message.objects.get(pk=102).labels, ['AIDS', 'Pregnancy'])
+        self.assertEqual(Message.objects.get(pk=103).labels, ['Flagged'])
+        self.assertFalse(Message.objects.get(pk=103).archived)
+
+        mock_label_messages.reset_mock()
+
+        # processing the same messages again does nothing
+        self.assertEqual(Message.process_unsolicited(self.unicef, [msg1, msg2, msg3]), 0)
+        self.assertFalse(mock_label_messages.called)
+
+    @patch('dash.orgs.models.TembaClient.label_messages')
+    @patch('dash.orgs.models.TembaClient.archive_messages')
+    def test_process_unsolicited_write_failure(self, mock_archive_messages, mock_label_messages):
+        d0 = datetime(2014, 1, 1, 6, 0, tzinfo=timezone.utc)
+        d1 = datetime(2014, 1, 1, 7, 0, tzinfo=timezone.utc)
+        msg1 = TembaMessage.create(id=101, contact='C-001', text="What is aids?", created_on=d1, labels=[])
+        msg2 = TembaMessage.create(id=102, contact='C-002', text="Thanks", created_on=d1, labels=[])
+
+        with patch.object(timezone, 'now', return_value=d0):
+            case = Case.get_or_open(self.unicef, self.user1, [self.aids],
+                                    TembaMessage.create(id=100, contact='C-002', created_on=d0, text="Hi"),
+                                    "Summary", self.moh, update_contact=False)
+
+        # labelling fails so nothing is recorded as processed
+        mock_label_messages.side_effect = TembaConnectionError()
+        self.assertRaises(TembaConnectionError, Message.process_unsolicited, self.unicef, [msg1, msg2])
+
+        self.assertFalse(Message.objects.filter(pk__in=[101, 102]).exists())
+        self.assertEqual(case.events.count(), 0)
+
+        # so the next run labels and archives the same messages
+        mock_label_messages.side_effect = None
+        mock_label_messages.reset_mock()
+        mock_archive_messages.reset_mock()
+
+        self.assertEqual(Message.process_unsolicited(self.unicef, [msg1, msg2]), 1)
+
+        mock_label_messages.assert_called_once_with(messages=[101], label_uuid='L-001')
+        mock_archive_messages.assert_called_once_with(messages=[102])
+        self.assertEqual(Message.objects.get(pk=101).labels, ['AIDS'])
+        self.assertTrue(Message.objects.get(pk=102).archived)
+        self.assertEqual(case.events.count(), 1)
+
+    @patch('casepro.cases.models.UNSOLICITED_CHECKPOINT_PAGES', 1)
+    @patch('dash.orgs.models.TembaClient.get_messages')
+    @patch('dash.orgs.models.TembaClient.label_messages')
+    @patch('dash.orgs.models.TembaClient.archive_messages')
+    def test_process_all_unsolicited(self, mock_archive_messages, mock_label_messages, mock_get_messages):
+        msgs = [TembaMessage.create(id=100 + m, contact='C-00%d' % m, text="What is aids?", labels=[],
+                                    created_on=datetime(2014, 1, 1, 7, m, tzinfo=timezone.utc)) for m in range(1, 6)]
+
+        # RapidPro returns pages of messages newest first
+        pages = [[msgs[4], msgs[3]], [msgs[2], msgs[1]], [msgs[0]]]
+
+        def get_messages(pager, **kwargs):
+            pager.update({'count': 5, 'next': 'page=%d' % (pager.start_page + 1) if pager.start_page < 3 else None})
+            return pages[pager.start_page - 1]
+
+        mock_get_messages.side_effect = get_messages
+
+        cursor = MessageSyncCursor.get_for_org(self.unicef)
+        checkpoints = []
+        checkpoint = MessageWriteBuffer.checkpoint
+
+        def checkpoint_and_check(buffer):
+            cursor_id = MessageSyncCursor.objects.get(pk=cursor.pk).last_msg_id
+            checkpoint(buffer)
+
+            # the buffer is left empty with everything written and recorded
+            self.assertEqual(buffer.processed, [])
+            self.assertEqual(buffer.processed_ids, set())
+            self.assertFalse(buffer.label_ids)
+            self.assertEqual(buffer.archive_ids, [])
+
+            checkpoints.append((cursor_id, Message.objects.filter(org=self.unicef).count()))
+
+        with patch.object(MessageWriteBuffer, 'checkpoint', autospec=True, side_effect=checkpoint_and_check):
+            counts = Message.process_all_unsolicited(self.unicef, cursor)
+
+        # pages are fetched oldest first after the first page tells us how many there are
+        self.assertEqual([c[1]['pager'].start_page for c in mock_get_messages.call_args_list], [1, 3, 2, 1])
+
+        # cursor is advanced and local copies are recorded at each checkpoint rather than at the end
+        self.assertEqual(checkpoints, [(None, 1), (101, 3), (103, 5), (105, 5)])
+        self.assertEqual(counts['messages'], 5)
+        self.assertEqual(counts['labelled'], 5)
+
+        cursor.refresh_from_db()
+        self.assertEqual(cursor.last_msg_id, 105)
+
+    @override_settings(LOCAL_MESSAGE_SEARCH=True)
+    @patch('dash.orgs.models.TembaClient.get_messages')
+    @patch('dash.orgs.models.TembaClient.label_messages')
+    @patch('dash.orgs.models.TembaClient.archive_messages')
+    def test_search_local(self, mock_archive_messages, mock_label_messages, mock_get_messages):
+        d1 = datetime(2014, 1, 2, 6, 0, tzinfo=timezone.utc)
+        d2 = datetime(2014, 1, 2, 7, 0, tzinfo=timezone.utc)
+        d3 = datetime(2014, 1, 2, 8, 0, tzinfo=timezone.utc)
+        msg1 = TembaMessage.create(id=101, contact='C-001', text="What is AIDS?", created_on=d1, labels=['AIDS'],
+                                   direction='I', type='I', archived=False)
+        msg2 = TembaMessage.create(id=102, contact='C-002', text="I'm pregnant", created_on=d2, labels=[],
+                                   direction='I', type='I', archived=False)
+        msg3 = TembaMessage.create(id=103, contact='C-003', text="Hello", created_on=d3, labels=[],
+                                   direction='I', type='I', archived=False)
+        Message.mirror(self.unicef, [msg1, msg2, msg3], {102: ['Pregnancy']})
+
+        def search(**kwargs):
+            params = {'labels': ['AIDS', 'Pregnancy'], 'contacts': None, 'groups': None, 'after': None,
+                      'before': None, 'text': None, 'types': None, 'archived': False}
+            params.update(kwargs)
+            return [m.pk for m in Message.search(self.unicef, params, None)]
+
+        self.assertEqual(search(), [102, 101])
+        self.assertEqual(search(labels=['AIDS']), [101])
+        self.assertEqual(search(labels=['-AIDS', '-Pregnancy'], types=['I']), [103])
+        self.assertEqual(search(text="aids"), [101])
+        self.assertEqual(search(contacts=['C-002']), [102])
+        self.assertEqual(search(before=d2), [101])
+
+        # flag and archive messages which should update local copies
+        Message.bulk_flag(self.unicef, self.user1, [101])
+        Message.bulk_archive(self.unicef, self.user1, [102])
+
+        self.assertEqual(search(labels=['AIDS', 'Pregnancy', '+Flagged']), [101])
+        self.assertEqual(search(), [101])
+        self.assertEqual(search(archived=True), [102])
+
+        # none of which needed the RapidPro API
+        self.assertEqual(mock_get_messages.call_count, 0)
+
+        # searches on contact groups still hit the RapidPro API
+        mock_get_messages.return_value = [msg1]
+        self.assertEqual(search(groups=['G-001']), [101])
+
+        # local searches can be paged
+        pager = TembaPager(start_page=1)
+        with patch('casepro.cases.models.LOCAL_MESSAGE_PAGE_SIZE', 1):
+            messages = Message.search(self.unicef, {'labels': ['AIDS', 'Pregnancy'], 'contacts': None,
+                                                    'groups': None, 'after': None, 'before': None, 'text': None,
+                                                    'types': None, 'archived': None}, pager)
+        self.assertEqual([m.pk for m in messages], [102])
+        self.assertTrue(pager.has_more())
+        self.assertEqual(pager.total, 2)
+
+    @patch('dash.orgs.models.TembaClient.get_messages')
+    @patch('dash.orgs.models.TembaClient.label_messages')
+    def test_mirror_all(self, mock_label_messages, mock_get_messages):
+        d1 = datetime(2014, 1, 2, 6, 0, tzinfo=timezone.utc)
+        d2 = datetime(2014, 1, 2, 7, 0, tzinfo=timezone.utc)
+        d3 = datetime(2014, 1, 2, 8, 0, tzinfo=timezone.utc)
+        msg1 = TembaMessage.create(id=101, contact='C-001', text="What is AIDS?", created_on=d1, labels=['AIDS'],
+                                   direction='I', archived=True)
+        msg2 = TembaMessage.create(id=102, contact='C-002', text="I'm pregnant", created_on=d3, labels=[],
+                                   direction='I', archived=False)
+        mock_get_messages.return_value = [msg1, msg2]
+
+        # nothing to mirror until the labelling task has processed some messages
+        self.assertEqual(Message.mirror_all(self.unicef), 0)
+        self.assertEqual(mock_get_messages.call_count, 0)
+
+        MessageSyncCursor.objects.filter(org=self.unicef).update(last_msg_id=101, last_msg_on=d2)
+
+        self.assertEqual(Message.mirror_all(self.unicef, after=d1), 1)
+        mock_get_messages.assert_called_once_with(pager=ANY, direction='I', before=d2, after=d1)
+
+        # message is copied with its labels and archived state, and isn't labelled again
+        msg = Message.objects.get(pk=101)
+        self.assertEqual(msg.labels, ['AIDS'])
+        self.assertTrue(msg.archived)
+        self.assertFalse(Message.objects.filter(pk=102).exists())
+        self.assertEqual(mock_label_messages.call_count, 0)
+
     def test_annotate_with_sender(self):
         d1 = datetime(2014, 1, 2, 6, 0, tzinfo=timezone.utc)
         Outgoing.objects.create(org=self.unicef, activity='C', broadcast_id=201, recipient_count=1,
@@ -833,24 +1676,201 @@ class MessageExportCRUDLTest(BaseCasesTest):
 
         mock_get_messages.assert_called_once_with(archived=False, labels=['AIDS', 'Pregnancy'],
                                                   contacts=None, groups=None, text='', _types=None, direction='I',
-                                                  after=None, before=None, pager=None)
+                                                  after=None, before=ANY, pager=ANY)
 
         mock_get_contacts.assert_called_once_with(uuids=['C-001', 'C-002'])
 
         export = MessageExport.objects.get()
         self.assertEqual(export.created_by, self.user1)
+        self.assertEqual(export.status, MessageExport.STATUS_COMPLETE)
+        self.assertEqual((export.pages_done, export.rows_done), (1, 2))
+        self.assertTrue(export.filename.endswith('.csv'))
 
         read_url = reverse('cases.messageexport_read', args=[export.pk])
 
         response = self.url_get('unicef', read_url)
         self.assertEqual(response.status_code, 200)
 
+        response = self.url_get('unicef', read_url, {'download': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename=message_export.csv')
+
+        rows = b''.join(response.streaming_content)[len(codecs.BOM_UTF8):].decode('utf-8').splitlines()
+        self.assertEqual(rows[0], "Time,Message ID,Flagged,Labels,Text,Contact,age,gender")
+        self.assertTrue(rows[1].endswith(",101,No,AIDS,What is HIV?,C-001,28,M"))
+        self.assertTrue(rows[2].endswith(",102,No,,I ♡ RapidPro,C-002,32,F"))
+
         # user from another org can't access this download
         self.login(self.norbert)
 
         response = self.url_get('unicef', read_url)
         self.assertEqual(response.status_code, 302)
 
+    @patch('casepro.cases.models.MESSAGE_EXPORT_CHUNK_PAGES', 1)
+    @patch('dash.orgs.models.TembaClient.get_messages')
+    @patch('dash.orgs.models.TembaClient.get_contacts')
+    def test_export_chunks(self, mock_get_contacts, mock_get_messages):
+        d1 = datetime(2015, 1, 2, 13, 0, tzinfo=pytz.utc)
+        pages = [
+            [TembaMessage.create(id=101, contact='C-001', text="Hello", created_on=d1, labels=['AIDS', 'Flagged']),
+             TembaMessage.create(id=102, contact='C-002', text="Hi", created_on=d1, labels=[])],
+            [TembaMessage.create(id=103, contact='C-001', text="Bye", created_on=d1, labels=[]),
+             TembaMessage.create(id=104, contact='C-003', text="Ciao", created_on=d1, labels=[])]
+        ]
+
+        def get_messages(pager, **kwargs):
+            pager.update({'count': 4, 'next': 'page=2' if pager.start_page == 1 else None})
+            return pages[pager.start_page - 1]
+
+        def get_contacts(uuids):
+            # contact C-002 no longer exists in RapidPro
+            return [TembaContact.create(uuid=uuid, urns=[], groups=[], fields={'age': 30})
+                    for uuid in uuids if uuid != 'C-002']
+
+        mock_get_messages.side_effect = get_messages
+        mock_get_contacts.side_effect = get_contacts
+
+        self.unicef.set_contact_fields(['age'])
+
+        export = MessageExport.create(self.unicef, self.user1, {'labels': ['AIDS'], 'contacts': None, 'groups': None,
+                                                                'text': None, 'types': None, 'archived': False,
+                                                                'after': None, 'before': None})
+        self.assertEqual(export.status, MessageExport.STATUS_PENDING)
+
+        # end of search is fixed when export is created
+        before = export.get_search()['before']
+        self.assertIsNotNone(before)
+
+        export.export_chunk()
+
+        export = MessageExport.objects.get(pk=export.pk)
+        self.assertEqual(export.status, MessageExport.STATUS_EXPORTING)
+        self.assertEqual((export.pages_done, export.rows_done, export.total_rows, export.num_parts), (1, 2, 4, 1))
+        self.assertFalse(export.pages_complete)
+        self.assertEqual(export.filename, '')
+        self.assertEqual(mock_get_messages.call_args[1]['before'], before)
+
+        # next chunk fails when fetching contacts, leaving the export to be resumed
+        mock_get_contacts.side_effect = TembaAPIError(HTTPError(response=Mock(status_code=404)))
+        self.assertRaises(TembaAPIError, export.export_chunk)
+
+        export = MessageExport.objects.get(pk=export.pk)
+        self.assertEqual(export.status, MessageExport.STATUS_EXPORTING)
+        self.assertEqual((export.pages_done, export.rows_done, export.num_parts), (1, 2, 1))
+
+        # progress is available as JSON
+        self.login(self.user1)
+        response = self.url_get('unicef', reverse('cases.messageexport_read', args=[export.pk]), {'progress': 1})
+        self.assertEqual(response.json, {'id': export.pk, 'status': "Exporting", 'complete': False, 'failed': False,
+                                         'pages_done': 1, 'rows_done': 2, 'total_rows': 4})
+
+        # and can't be downloaded yet
+        response = self.url_get('unicef', reverse('cases.messageexport_read', args=[export.pk]), {'download': 1})
+        self.assertEqual(response.status_code, 404)
+
+        # export resumes from the second page
+        mock_get_contacts.side_effect = get_contacts
+        mock_get_messages.reset_mock()
+        export.export_chunk()
+
+        self.assertEqual(mock_get_messages.call_count, 1)
+        self.assertEqual(mock_get_messages.call_args[1]['pager'].start_page, 2)
+
+        export = MessageExport.objects.get(pk=export.pk)
+        self.assertEqual(export.status, MessageExport.STATUS_COMPLETE)
+        self.assertEqual((export.pages_done, export.rows_done, export.num_parts), (2, 4, 2))
+        self.assertTrue(export.pages_complete)
+
+        with default_storage.open(export.filename, 'rb') as export_file:
+            content = export_file.read()
+
+        self.assertTrue(content.startswith(codecs.BOM_UTF8))
+        self.assertEqual(content[len(codecs.BOM_UTF8):].decode('utf-8').splitlines(), [
+            "Time,Message ID,Flagged,Labels,Text,Contact,age",
+            "02-01-2015 13:00:00,101,Yes,AIDS,Hello,C-001,30",
+            "02-01-2015 13:00:00,102,No,,Hi,C-002,",
+            "02-01-2015 13:00:00,103,No,,Bye,C-001,30",
+            "02-01-2015 13:00:00,104,No,,Ciao,C-003,30"
+        ])
+
+        # part files have been removed
+        self.assertFalse(default_storage.exists(export._get_part_filename(1)))
+        self.assertFalse(default_storage.exists(export._get_part_filename(2)))
+
+    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory')
+    @patch('casepro.cases.tasks.MESSAGE_EXPORT_RETRY_DELAY', 0)
+    @patch('casepro.cases.models.MESSAGE_EXPORT_CHUNK_PAGES', 1)
+    @patch('casepro.cases.models.send_email')
+    @patch('dash.orgs.models.TembaClient.get_messages')
+    @patch('dash.orgs.models.TembaClient.get_contacts')
+    def test_export_task(self, mock_get_contacts, mock_get_messages, mock_send_email):
+        d1 = datetime(2015, 1, 2, 13, 0, tzinfo=pytz.utc)
+        pages = [[TembaMessage.create(id=101, contact='C-001', text="Hello", created_on=d1, labels=[])],
+                 [TembaMessage.create(id=102, contact='C-002', text="Hi", created_on=d1, labels=[])]]
+
+        failures = [TembaConnectionError()]
+
+        def get_messages(pager, **kwargs):
+            # second page can't be fetched the first time
+            if pager.start_page == 2 and failures:
+                raise failures.pop()
+
+            pager.update({'count': 2, 'next': 'page=2' if pager.start_page == 1 else None})
+            return pages[pager.start_page - 1]
+
+        def get_contacts(uuids):
+            return [TembaContact.create(uuid=uuid, urns=[], groups=[], fields={}) for uuid in uuids]
+
+        mock_get_messages.side_effect = get_messages
+        mock_get_contacts.side_effect = get_contacts
+
+        search = {'labels': ['AIDS'], 'contacts': None, 'groups': None, 'text': None, 'types': None,
+                  'archived': False, 'after': None, 'before': None}
+
+        # second chunk is retried from where the export got to
+        export = MessageExport.create(self.unicef, self.user1, search)
+        message_export.delay(export.pk)
+
+        export = MessageExport.objects.get(pk=export.pk)
+        self.assertEqual(export.status, MessageExport.STATUS_COMPLETE)
+        self.assertEqual((export.pages_done, export.rows_done, export.num_parts), (2, 2, 2))
+        self.assertEqual([c[1]['pager'].start_page for c in mock_get_messages.call_args_list], [1, 2, 2])
+        self.assertEqual(mock_send_email.call_args[0][2], 'cases/email/message_export')
+
+        # errors which won't go away fail the export and notify the user
+        mock_get_contacts.side_effect = TembaAPIError(HTTPError(response=Mock(status_code=404)))
+
+        export = MessageExport.create(self.unicef, self.user1, search)
+        self.assertRaises(TembaAPIError, message_export.delay, export.pk)
+
+        export = MessageExport.objects.get(pk=export.pk)
+        self.assertEqual(export.status, MessageExport.STATUS_FAILED)
+        self.assertEqual(mock_send_email.call_args[0][2], 'cases/email/message_export_failed')
+
+        # an export which another task is already exporting is skipped
+        export = MessageExport.create(self.unicef, self.user1, search)
+        mock_get_messages.reset_mock()
+
+        with get_redis_connection().lock('message_export:%d:lock' % export.pk, timeout=60):
+            message_export.delay(export.pk)
+
+        self.assertEqual(mock_get_messages.call_count, 0)
+        self.assertEqual(MessageExport.objects.get(pk=export.pk).status, MessageExport.STATUS_PENDING)
+
+        # a chunk which outlasts its lock isn't treated as failed
+        def get_messages_expiring_lock(pager, **kwargs):
+            get_redis_connection().delete('message_export:%d:lock' % export.pk)
+            return get_messages(pager, **kwargs)
+
+        mock_get_messages.side_effect = get_messages_expiring_lock
+        mock_get_contacts.side_effect = get_contacts
+
+        message_export.delay(export.pk)
+
+        export = MessageExport.objects.get(pk=export.pk)
+        self.assertEqual(export.status, MessageExport.STATUS_COMPLETE)
+        self.assertEqual((export.pages_done, export.rows_done), (2, 2))
+
 
 class MessageViewsTest(BaseCasesTest):
     @patch('dash.orgs.models.TembaClient.label_messages')
@@ -921,6 +1941,7 @@ class MessageViewsTest(BaseCasesTest):
         mock_label_messages.assert_called_once_with([101], label_uuid='L-002')
         mock_unlabel_messages.assert_called_once_with([101], label_uuid='L-001')
 
+    @override_settings(MESSAGE_SEARCH_CACHE_WINDOW=0)
     @patch('dash.orgs.models.TembaClient.get_messages')
     @patch('dash.orgs.models.TembaClient.pager')
     def test_search(self, mock_pager, mock_get_messages):
@@ -990,6 +2011,94 @@ class MessageViewsTest(BaseCasesTest):
                                                   contacts=None, groups=None, text='', _types=None, direction='I',
                                                   after=t1, before=t2, pager=None)
 
+    @patch('casepro.cases.push.EventWaiter.wait')
+    @patch('dash.orgs.models.TembaClient.get_messages')
+    def test_search_wait(self, mock_get_messages, mock_wait):
+        url = reverse('cases.message_search')
+
+        d1 = datetime(2015, 1, 2, 13, 0, 0, tzinfo=pytz.utc)
+        d2 = datetime(2015, 1, 2, 13, 0, 10, tzinfo=pytz.utc)
+        msg1 = TembaMessage.create(id=101, contact='C-001', text="Hello", created_on=d2, labels=['AIDS'])
+
+        # labelling task invalidates cached searches before the event is received
+        def wait(timeout):
+            MessageSearchCache.invalidate(self.unicef)
+            return True
+
+        mock_get_messages.side_effect = [[], [msg1]]
+        mock_wait.side_effect = wait
+
+        self.login(self.user1)
+
+        # no new messages so request waits for an event and then searches again
+        response = self.url_get('unicef', url, {'view': 'inbox', 'text': '', 'label': '',
+                                                'after': format_iso8601(d1), 'wait': 5})
+        self.assertEqual([m['id'] for m in response.json['results']], [101])
+        mock_wait.assert_called_once_with(5)
+        self.assertEqual(mock_get_messages.call_count, 2)
+
+        # wait is ignored for searches without an after time
+        mock_wait.reset_mock()
+        mock_get_messages.side_effect = [[]]
+        self.url_get('unicef', url, {'view': 'inbox', 'text': '', 'label': '', 'page': 1, 'wait': 5})
+        self.assertFalse(mock_wait.called)
+
+    @patch('dash.orgs.models.TembaClient.label_messages')
+    @patch('dash.orgs.models.TembaClient.get_messages')
+    def test_search_cache(self, mock_get_messages, mock_label_messages):
+        url = reverse('cases.message_search')
+
+        d1 = datetime(2015, 1, 2, 13, 0, 1, tzinfo=pytz.utc)
+        d2 = datetime(2015, 1, 2, 13, 0, 4, tzinfo=pytz.utc)
+        d3 = datetime(2015, 1, 2, 13, 0, 6, tzinfo=pytz.utc)
+        msg1 = TembaMessage.create(id=101, contact='C-001', text="Hello", created_on=d2, labels=['AIDS'])
+        msg2 = TembaMessage.create(id=102, contact='C-002', text="Hi", created_on=d3, labels=['AIDS'])
+
+        mock_get_messages.return_value = [msg2, msg1]
+        self.unicef.record_message_time(d3, labelled=True)
+
+        def search(user, before):
+            self.login(user)
+            return self.url_get('unicef', url, {'view': 'inbox', 'text': '', 'label': '',
+                                                'after': format_iso8601(d1), 'before': format_iso8601(before)})
+
+        # first search fetches messages using time bounds widened to window boundaries
+        response = search(self.user1, d3)
+        self.assertEqual([m['id'] for m in response.json['results']], [102, 101])
+        self.assertEqual(response.json['total'], 2)
+
+        mock_get_messages.assert_called_once_with(archived=False, labels=['AIDS', 'Pregnancy'],
+                                                  contacts=None, groups=None, text='', _types=None, direction='I',
+                                                  after=datetime(2015, 1, 2, 13, 0, 0, tzinfo=pytz.utc),
+                                                  before=datetime(2015, 1, 2, 13, 0, 10, tzinfo=pytz.utc), pager=None)
+
+        # an identical search from another user within the same window is served from the cache, filtered to its
+        # own time bounds
+        response = search(self.user2, d2)
+        self.assertEqual([m['id'] for m in response.json['results']], [101])
+        self.assertEqual(response.json['total'], 1)
+        self.assertEqual(mock_get_messages.call_count, 1)
+
+        # modifying messages invalidates the cache
+        self.login(self.user1)
+        response = self.url_post('unicef', reverse('cases.message_action', kwargs={'action': 'label'}),
+                                 {'messages': [101], 'label': self.aids.pk})
+        self.assertEqual(response.status_code, 204)
+
+        search(self.user1, d3)
+        self.assertEqual(mock_get_messages.call_count, 2)
+
+        search(self.user1, d3)
+        self.assertEqual(mock_get_messages.call_count, 2)
+
+        # as does the labelling task recording new messages
+        buffer = MessageWriteBuffer(self.unicef)
+        buffer.add({}, [], [msg2], [])
+        buffer.record_message_times()
+
+        search(self.user1, d3)
+        self.assertEqual(mock_get_messages.call_count, 3)
+
     @patch('dash.orgs.models.TembaClient.create_broadcast')
     def test_send(self, mock_create_broadcast):
         url = reverse('cases.message_send')
@@ -1142,6 +2251,7 @@ class PartnerCRUDLTest(BaseCasesTest):
 
 
 class TasksTest(BaseCasesTest):
+    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory')
     @patch('dash.orgs.models.TembaClient.get_messages')
     @patch('dash.orgs.models.TembaClient.label_messages')
     @patch('dash.orgs.models.TembaClient.archive_messages')
@@ -1167,11 +2277,11 @@ class TasksTest(BaseCasesTest):
 
         process_new_unsolicited()  # will process messages for both orgs
 
-        mock_label_messages.assert_has_calls([call(messages=[msg1, msg2], label_uuid='L-001'),
-                                              call(messages=[msg3], label_uuid='L-002')],
+        mock_label_messages.assert_has_calls([call(messages=[101, 102], label_uuid='L-001'),
+                                              call(messages=[103], label_uuid='L-002')],
                                              any_order=True)
 
-        mock_archive_messages.assert_called_once_with(messages=[msg5])  # because contact has open case
+        mock_archive_messages.assert_called_once_with(messages=[105])  # because contact has open case
 
         # check reply event was created for message 5
         events = case1.events.all()
@@ -1183,6 +2293,66 @@ class TasksTest(BaseCasesTest):
         result = self.unicef.get_task_result(TaskType.label_messages)
         self.assertEqual(result['counts']['messages'], 5)
         self.assertEqual(result['counts']['labelled'], 3)
+        self.assertEqual(result['counts']['api_calls'], 3)
+        self.assertEqual(result['counts']['api_calls_saved'], 0)
+        self.assertIn('duration', result)
+
+        # each org gets its own result
+        result = self.nyaruka.get_task_result(TaskType.label_messages)
+        self.assertEqual(result['counts']['messages'], 5)
+        self.assertEqual(result['counts']['labelled'], 0)
+
+        # check sync cursor was advanced to the newest message
+        cursor = MessageSyncCursor.objects.get(org=self.unicef)
+        self.assertEqual(cursor.last_msg_id, 105)
+        self.assertEqual(cursor.last_msg_on, d5)
+
+        mock_label_messages.reset_mock()
+        mock_archive_messages.reset_mock()
+
+        # simulate losing the cache, and then fetching the same messages again
+        cache.clear()
+        process_new_unsolicited()
+
+        # fetch was from the cursor rather than from 3 hours ago
+        self.assertEqual(mock_get_messages.call_args[1]['after'], d5)
+
+        # and nothing was processed twice
+        self.assertFalse(mock_label_messages.called)
+        self.assertFalse(mock_archive_messages.called)
+        self.assertEqual(case1.events.count(), 1)
+
+        result = self.unicef.get_task_result(TaskType.label_messages)
+        self.assertEqual(result['counts']['messages'], 0)
+        self.assertEqual(result['counts']['skipped'], 5)
+
+
+class PushTest(BaseCasesTest):
+    def test_event_waiter(self):
+        with EventWaiter(self.unicef, self.user1, EventType.case) as waiter:
+            # no events
+            self.assertFalse(waiter.wait(0.1))
+
+            # events for other partners or of other types are ignored
+            send_event(self.unicef.pk, 'case', {'id': 123}, [self.who.pk])
+            send_event(self.unicef.pk, 'messages', {'labels': []}, [self.moh.pk])
+            self.assertFalse(waiter.wait(0.1))
+
+            # event published whilst waiting
+            timer = threading.Timer(0.1, send_event, [self.unicef.pk, 'case', {'id': 123}, [self.moh.pk]])
+            timer.start()
+            self.assertTrue(waiter.wait(5))
+            timer.join()
+
+        # users without a partner don't receive events so don't wait
+        user = User.create(None, None, None, "Xavier", "xavier@unicef.org", password="xavier@unicef.org")
+        with EventWaiter(self.unicef, user, EventType.case) as waiter:
+            self.assertFalse(waiter.wait(5))
+
+    def test_long_poll_views_non_atomic(self):
+        # views which wait for events don't run in a transaction so they can release their database connection
+        for url_name in ('cases.events', 'cases.case_search', 'cases.message_search'):
+            self.assertEqual(resolve(reverse(url_name)).func._non_atomic_requests, {'default'})
 
 
 class ContextProcessorsTest(BaseCasesTest):
@@ -1206,3 +2376,76 @@ class UtilsTest(BaseCasesTest):
         ms = datetime_to_microseconds(d1)
         d2 = microseconds_to_datetime(ms)
         self.assertEqual(d2, datetime(2015, 10, 9, 14, 48, 30, 123456, tzinfo=pytz.utc))
+
+    def test_prefetch(self):
+        self.assertEqual(list(prefetch(iter([1, 2, 3, 4, 5]), 2)), [1, 2, 3, 4, 5])
+        self.assertEqual(list(prefetch(iter([]), 2)), [])
+
+        def failing():
+            yield 1
+            raise ValueError("Boom")
+
+        items = prefetch(failing(), 2)
+        self.assertEqual(next(items), 1)
+        self.assertRaises(ValueError, next, items)
+
+    def test_lru_cache(self):
+        lru = LRUCache(2)
+        lru.put('a', 1)
+        lru.put('b', 2)
+        self.assertEqual(lru.get('a'), 1)  # a is now most recently used
+
+        lru.put('c', 3)
+        self.assertEqual(len(lru), 2)
+        self.assertNotIn('b', lru)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('c'), 3)
+
+        lru.put('c', 4)
+        lru.put('d', 5)
+        self.assertNotIn('a', lru)
+        self.assertEqual(lru.get('c'), 4)
+
+    @patch('casepro.cases.utils.time.sleep')
+    @patch('casepro.cases.utils.time.time')
+    def test_rate_limiter(self, mock_time, mock_sleep):
+        mock_time.return_value = 1000.0
+
+        limiter = RateLimiter(4)
+        limiter.wait()
+        limiter.wait()
+        limiter.wait()
+
+        # first call is immediate and the others are spaced out
+        mock_sleep.assert_has_calls([call(0.25), call(0.5)])
+
+    def test_bounded_thread_pool(self):
+        results = []
+
+        pool = BoundedThreadPool(2, 3)
+        for i in range(10):
+            pool.submit(results.append, i)
+        pool.join()
+
+        self.assertEqual(sorted(results), range(10))
+
+        def fail():
+            raise ValueError("Boom")
+
+        pool = BoundedThreadPool(2, 3)
+        pool.submit(fail)
+        pool.submit(results.append, 10)
+        self.assertRaises(ValueError, pool.join)
+        self.assertIn(10, results)
+
+        # draining waits for pending calls but leaves the pool usable
+        pool = BoundedThreadPool(2, 3)
+        for i in range(5):
+            pool.submit(results.append, 20 + i)
+        pool.drain()
+        self.assertEqual(sorted(results[-5:]), range(20, 25))
+
+        pool.submit(results.append, 30)
+        pool.join()
+        self.assertIn(30, results)
@@ -4,6 +4,7 @@ from django.conf.urls import patterns, url
 from .views import CaseCRUDL, GroupCRUDL, LabelCRUDL, MessageExportCRUDL, PartnerCRUDL
 from .views import InboxView, FlaggedView, OpenCasesView, ClosedCasesView, ArchivedView, UnlabelledView
 from .views import MessageSearchView, MessageActionView, MessageHistoryView, MessageSendView, MessageLabelView
+from .views import EventsView
 
 
 urlpatterns = CaseCRUDL().as_urlpatterns()
@@ -19,6 +20,7 @@ urlpatterns += patterns('',
                         url(r'^unlabelled/$', UnlabelledView.as_view(), name='cases.unlabelled'),
                         url(r'^open/$', OpenCasesView.as_view(), name='cases.open'),
                         url(r'^closed/$', ClosedCasesView.as_view(), name='cases.closed'),
+                        url(r'^events/$', EventsView.as_view(), name='cases.events'),
                         url(r'^message/$', MessageSearchView.as_view(), name='cases.message_search'),
                         url(r'^message/label/(?P<id>\d+)/$', MessageLabelView.as_view(), name='cases.message_label'),
                         url(r'^message/action/(?P<action>\w+)/$', MessageActionView.as_view(), name='cases.message_action'),
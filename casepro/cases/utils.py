@@ -2,7 +2,17 @@ from __future__ import absolute_import, unicode_literals
 
 import calendar
 import datetime
+import logging
 import pytz
+import Queue
+import threading
+import time
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+
+logger = logging.getLogger(__name__)
 
 
 def datetime_to_microseconds(dt):
@@ -18,3 +28,150 @@ def microseconds_to_datetime(ms):
     Converts a microsecond accuracy timestamp to a datetime
     """
     return datetime.datetime.utcfromtimestamp(ms / 1000000.0).replace(tzinfo=pytz.utc)
+
+
+def prefetch(iterable, max_ready):
+    """
+    Iterates over the given iterable in a background thread, keeping at most max_ready items ready ahead of the
+    consumer. Any exception raised by the iterable is re-raised in the consumer.
+    """
+    ready = Queue.Queue(maxsize=max_ready)
+    stopped = threading.Event()
+    end = object()
+
+    def put(item):
+        # block until there's space on the queue, unless the consumer has gone away
+        while not stopped.is_set():
+            try:
+                ready.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((end, None))
+        except Exception as ex:
+            put((end, ex))
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+
+    try:
+        while True:
+            item, error = ready.get()
+            if item is end:
+                if error:
+                    raise error
+                return
+
+            yield item
+    finally:
+        stopped.set()
+
+
+class BoundedThreadPool(object):
+    """
+    Pool of worker threads for I/O bound calls. Callers block when too many calls are already pending so that memory
+    stays flat, and the first error raised by any call is re-raised when the pool is joined.
+    """
+    def __init__(self, num_workers, max_pending):
+        self.pool = ThreadPool(num_workers)
+        self.max_pending = max_pending
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.error = None
+
+    def submit(self, func, *args, **kwargs):
+        self.pending.acquire()
+
+        def run():
+            try:
+                func(*args, **kwargs)
+            except Exception as ex:
+                logger.exception("Error in pooled call to %s" % func.__name__)
+                if not self.error:
+                    self.error = ex
+            finally:
+                self.pending.release()
+
+        self.pool.apply_async(run)
+
+    def drain(self):
+        """
+        Waits for all pending calls to complete, leaving the pool open for further calls
+        """
+        for p in range(self.max_pending):
+            self.pending.acquire()
+        for p in range(self.max_pending):
+            self.pending.release()
+
+        if self.error:
+            raise self.error
+
+    def join(self):
+        """
+        Waits for all pending calls to complete
+        """
+        self.pool.close()
+        self.pool.join()
+
+        if self.error:
+            raise self.error
+
+
+class LRUCache(object):
+    """
+    Dict-like cache which holds at most max_size items, discarding the least recently used item when it's full
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            return default
+
+        value = self.items.pop(key)
+        self.items[key] = value
+        return value
+
+    def put(self, key, value):
+        if key in self.items:
+            del self.items[key]
+        elif len(self.items) >= self.max_size:
+            self.items.popitem(last=False)
+
+        self.items[key] = value
+
+
+class RateLimiter(object):
+    """
+    Limits calls made by any number of threads to at most max_per_second calls per second, by spacing them out evenly
+    """
+    def __init__(self, max_per_second):
+        self.interval = 1.0 / max_per_second if max_per_second else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """
+        Blocks until the caller is allowed to make its call
+        """
+        with self.lock:
+            now = time.time()
+            wait_until = max(now, self.next_time)
+            self.next_time = wait_until + self.interval
+
+        if wait_until > now:
+            time.sleep(wait_until - now)
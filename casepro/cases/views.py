@@ -1,22 +1,30 @@
 from __future__ import absolute_import, unicode_literals
 
+import base64
+
 from dash.orgs.views import OrgPermsMixin, OrgObjPermsMixin
 from dash.utils import get_obj_cacheable
 from django import forms
+from django.core.exceptions import SuspiciousOperation
 from django.core.files.storage import default_storage
+from django.core.servers.basehttp import FileWrapper
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse, HttpResponseRedirect, HttpResponseBadRequest, JsonResponse
-from django.utils import timezone
+from django.db import transaction
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseBadRequest, Http404
+from django.http import JsonResponse, StreamingHttpResponse
 from django.utils.translation import ugettext_lazy as _
 from django.views.generic import View
 from enum import Enum
 from smartmin.users.views import SmartCRUDL, SmartListView, SmartCreateView, SmartReadView, SmartFormView
 from smartmin.users.views import SmartUpdateView, SmartDeleteView, SmartTemplateView
-from temba_client.utils import parse_iso8601
-from . import parse_csv, json_encode, normalize, safe_max, str_to_bool, MAX_MESSAGE_CHARS, SYSTEM_LABEL_FLAGGED
-from .models import AccessLevel, Case, Group, Label, Message, MessageAction, MessageExport, Partner, Outgoing
+from temba_client.utils import format_iso8601, parse_iso8601
+from . import parse_csv, json_encode, normalize, str_to_bool, PrimitivesJsonResponse, MAX_MESSAGE_CHARS
+from . import SYSTEM_LABEL_FLAGGED
+from .models import AccessLevel, Case, CaseAccess, CaseCount, CaseTimeline, Group, HomeData, Label, LabelIndex
+from .models import Message, MessageAction, MessageExport, MessageSearchCache, Outgoing, Partner
+from .push import get_events_channel, get_wait, stream_events, EventType, EventWaiter
 from .tasks import message_export
-from .utils import datetime_to_microseconds, microseconds_to_datetime
 
 
 class ItemView(Enum):
@@ -28,6 +36,16 @@ class ItemView(Enum):
     closed = 6
 
 
+class NonAtomicMixin(object):
+    """
+    Mixin for views which aren't run in a transaction, e.g. so that views held open waiting for events can release
+    their database connection whilst waiting, or so that changes made under a lock are committed before it's released.
+    """
+    @classmethod
+    def as_view(cls, **initkwargs):
+        return transaction.non_atomic_requests(super(NonAtomicMixin, cls).as_view(**initkwargs))
+
+
 class CaseCRUDL(SmartCRUDL):
     model = Case
     actions = ('read', 'open', 'update_summary', 'fetch', 'search', 'timeline',
@@ -38,7 +56,12 @@ class CaseCRUDL(SmartCRUDL):
 
         def has_permission(self, request, *args, **kwargs):
             has_perm = super(CaseCRUDL.Read, self).has_permission(request, *args, **kwargs)
-            return has_perm and self.get_object().access_level(self.request.user) >= AccessLevel.read
+            return has_perm and self.get_access_level() >= AccessLevel.read
+
+        def get_access_level(self):
+            if not hasattr(self, 'access_level'):
+                self.access_level = CaseAccess.for_request(self.request).get_level(self.get_object())
+            return self.access_level
 
         def derive_queryset(self, **kwargs):
             return Case.get_all(self.request.org).select_related('org', 'assignee')
@@ -47,10 +70,10 @@ class CaseCRUDL(SmartCRUDL):
             context = super(CaseCRUDL.Read, self).get_context_data(**kwargs)
             org = self.request.org
 
-            labels = Label.get_all(self.request.org).order_by('name')
+            labels = LabelIndex.get(org).labels
             partners = Partner.get_all(org).order_by('name')
 
-            can_update = self.get_object().access_level(self.request.user) == AccessLevel.update
+            can_update = self.get_access_level() == AccessLevel.update
 
             # angular app requires context data in JSON format
             context['context_data_json'] = json_encode({
@@ -64,7 +87,7 @@ class CaseCRUDL(SmartCRUDL):
             context['alert'] = self.request.GET.get('alert', None)
             return context
 
-    class Open(OrgPermsMixin, SmartCreateView):
+    class Open(NonAtomicMixin, OrgPermsMixin, SmartCreateView):
         """
         JSON endpoint for opening a new case
         """
@@ -98,7 +121,7 @@ class CaseCRUDL(SmartCRUDL):
             case = self.get_object()
             note = request.POST['note']
 
-            case.add_note(request.user, note)
+            case.add_note(request.user, note, access=CaseAccess.for_request(request))
             return HttpResponse(status=204)
 
     class Reassign(OrgObjPermsMixin, SmartUpdateView):
@@ -110,7 +133,7 @@ class CaseCRUDL(SmartCRUDL):
         def post(self, request, *args, **kwargs):
             assignee = Partner.get_all(request.org).get(pk=request.POST['assignee_id'])
             case = self.get_object()
-            case.reassign(request.user, assignee)
+            case.reassign(request.user, assignee, access=CaseAccess.for_request(request))
             return HttpResponse(status=204)
 
     class Close(OrgPermsMixin, SmartUpdateView):
@@ -122,7 +145,7 @@ class CaseCRUDL(SmartCRUDL):
         def post(self, request, *args, **kwargs):
             case = self.get_object()
             note = request.POST.get('note', None)
-            case.close(request.user, note)
+            case.close(request.user, note, access=CaseAccess.for_request(request))
 
             return HttpResponse(status=204)
 
@@ -136,7 +159,7 @@ class CaseCRUDL(SmartCRUDL):
             case = self.get_object()
             note = request.POST.get('note', None)
 
-            case.reopen(request.user, note)
+            case.reopen(request.user, note, access=CaseAccess.for_request(request))
             return HttpResponse(status=204)
 
     class Label(OrgObjPermsMixin, SmartUpdateView):
@@ -150,7 +173,7 @@ class CaseCRUDL(SmartCRUDL):
             label_ids = parse_csv(request.POST.get('labels', ''), as_ints=True)
             labels = Label.get_all(request.org).filter(pk__in=label_ids)
 
-            case.update_labels(request.user, labels)
+            case.update_labels(request.user, labels, access=CaseAccess.for_request(request))
             return HttpResponse(status=204)
 
     class UpdateSummary(OrgObjPermsMixin, SmartUpdateView):
@@ -162,7 +185,7 @@ class CaseCRUDL(SmartCRUDL):
         def post(self, request, *args, **kwargs):
             case = self.get_object()
             summary = request.POST['summary']
-            case.update_summary(request.user, summary)
+            case.update_summary(request.user, summary, access=CaseAccess.for_request(request))
             return HttpResponse(status=204)
 
     class Fetch(OrgPermsMixin, SmartReadView):
@@ -174,13 +197,31 @@ class CaseCRUDL(SmartCRUDL):
         def render_to_response(self, context, **response_kwargs):
             return JsonResponse(self.object.as_json())
 
-    class Search(OrgPermsMixin, SmartListView):
+    class Search(NonAtomicMixin, OrgPermsMixin, SmartListView):
         """
-        JSON endpoint for searching for cases
+        JSON endpoint for searching for cases. If a cursor param is provided (empty for the first page) then cases are
+        paged by their opened on and id values rather than by page number, which avoids counting all matching cases.
+        If an after param is provided with a wait param, then the request is held open for up to that many seconds
+        until there are new cases.
         """
         permission = 'cases.case_list'
         paginate_by = 25
 
+        def get(self, request, *args, **kwargs):
+            wait = get_wait(request)
+            if wait and request.GET.get('after'):
+                with EventWaiter(request.org, request.user, EventType.case) as waiter:
+                    if not self.derive_queryset().exists():
+                        waiter.wait(wait)
+
+            return super(CaseCRUDL.Search, self).get(request, *args, **kwargs)
+
+        def get_paginate_by(self, queryset):
+            return None if self.is_cursor_paged() else self.paginate_by
+
+        def is_cursor_paged(self):
+            return 'cursor' in self.request.GET
+
         def derive_queryset(self, **kwargs):
             label_id = self.request.GET.get('label', None)
             view = ItemView[self.request.GET['view']]
@@ -208,14 +249,65 @@ class CaseCRUDL(SmartCRUDL):
             if after:
                 qs = qs.filter(opened_on__gt=parse_iso8601(after))
 
-            return qs.prefetch_related('labels').select_related('assignee').order_by('-pk')
+            # can use maintained case counts if this is just all open or closed cases visible to this user
+            self.countable_view = None if (label or assignee or before or after) else view
+
+            qs = Case.prefetch_for_json(qs)
+
+            if self.is_cursor_paged():
+                cursor = self.request.GET['cursor']
+                if cursor:
+                    opened_on, case_id = self.decode_cursor(cursor)
+                    qs = qs.filter(Q(opened_on__lt=opened_on) | Q(opened_on=opened_on, pk__lt=case_id))
+
+                return qs.order_by('-opened_on', '-pk')
+            else:
+                return qs.order_by('-pk')
+
+        def get_total(self, queryset):
+            if self.countable_view == ItemView.open:
+                return CaseCount.get_open_count(self.request.org, self.request.user)
+            elif self.countable_view == ItemView.closed:
+                return CaseCount.get_closed_count(self.request.org, self.request.user)
+            elif str_to_bool(self.request.GET.get('total', '')):
+                return queryset.count()
+            else:
+                return None
+
+        @staticmethod
+        def encode_cursor(case):
+            return base64.urlsafe_b64encode('%s/%d' % (format_iso8601(case.opened_on), case.pk))
+
+        @staticmethod
+        def decode_cursor(cursor):
+            try:
+                opened_on, case_id = base64.urlsafe_b64decode(cursor.encode('ascii')).split('/')
+                return parse_iso8601(opened_on), int(case_id)
+            except (TypeError, ValueError):
+                raise SuspiciousOperation("Invalid case search cursor")
 
         def render_to_response(self, context, **response_kwargs):
+            if self.is_cursor_paged():
+                # fetch one more case than we need to know if there are more
+                cases = list(context['object_list'][:self.paginate_by + 1])
+                has_more = len(cases) > self.paginate_by
+                cases = cases[:self.paginate_by]
+
+                results = [obj.as_json() for obj in CaseAccess.for_request(self.request).annotate(cases)]
+                next_cursor = self.encode_cursor(cases[-1]) if has_more else None
+                total = self.get_total(context['object_list'])
+
+                return PrimitivesJsonResponse({'results': results,
+                                               'has_more': has_more,
+                                               'cursor': next_cursor,
+                                               'total': total})
+
             count = context['paginator'].count
             has_more = context['page_obj'].has_next()
-            results = [obj.as_json() for obj in list(context['object_list'])]
+            cases = CaseAccess.for_request(self.request).annotate(context['object_list'])
+            results = [obj.as_json() for obj in cases]
 
-            return JsonResponse({'results': results, 'has_more': has_more, 'total': count})
+            return PrimitivesJsonResponse({'results': results, 'has_more': has_more, 'total': count})
 
     class Timeline(OrgPermsMixin, SmartReadView):
         """
@@ -225,67 +317,19 @@ class CaseCRUDL(SmartCRUDL):
 
         def get_context_data(self, **kwargs):
             context = super(CaseCRUDL.Timeline, self).get_context_data(**kwargs)
-            org = self.request.org
-
-            after = self.request.GET.get('after', None)
-            if after:
-                after = microseconds_to_datetime(int(after))
-            else:
-                after = self.object.message_on
-
-            before = self.object.closed_on if self.object.closed_on else timezone.now()
-
-            label_map = {l.name: l for l in Label.get_all(self.request.org)}
-
-            # if this isn't a first request for the existing items, we check on our side to see if there will be new
-            # items before hitting the RapidPro API
-            do_api_fetch = True
-            if after != self.object.message_on:
-                last_event = self.object.events.order_by('-pk').first()
-                last_outgoing = self.object.outgoing_messages.order_by('-pk').first()
-                last_event_time = last_event.created_on if last_event else None
-                last_outgoing_time = last_outgoing.created_on if last_outgoing else None
-                last_message_time = safe_max(last_event_time, last_outgoing_time)
-                do_api_fetch = last_message_time and after <= last_message_time
-
-            if do_api_fetch:
-                # fetch messages
-                remote = org.get_temba_client().get_messages(contacts=[self.object.contact.uuid],
-                                                             after=after, before=before)
-
-                local_outgoing = Outgoing.objects.filter(case=self.object,
-                                                         created_on__gte=after, created_on__lte=before)
-                local_by_broadcast = {o.broadcast_id: o for o in local_outgoing}
-
-                # merge remotely fetched and local outgoing messages
-                messages = []
-                for m in remote:
-                    local = local_by_broadcast.pop(m.broadcast, None)
-                    if local:
-                        m.sender = local.created_by
-                    messages.append({'time': m.created_on, 'type': 'M', 'item': Message.as_json(m, label_map)})
-
-                for m in local_by_broadcast.values():
-                    messages.append({'time': m.created_on, 'type': 'M', 'item': m.as_json()})
 
-            else:
-                messages = []
-
-            # fetch actions in chronological order
-            actions = self.object.actions.filter(created_on__gte=after, created_on__lte=before)
-            actions = actions.select_related('assignee', 'created_by').order_by('pk')
+            cursor = self.request.GET.get('cursor', None)
 
-            # merge actions and messages and JSON-ify both
-            timeline = messages
-            timeline += [{'time': a.created_on, 'type': 'A', 'item': a.as_json()} for a in actions]
-            timeline = sorted(timeline, key=lambda event: event['time'])
+            timeline = CaseTimeline.get(self.object)
 
-            context['timeline'] = timeline
-            context['max_time'] = datetime_to_microseconds(before)
+            context['timeline'], context['reset'] = timeline.get_items(cursor)
+            context['cursor'] = timeline.get_cursor()
             return context
 
         def render_to_response(self, context, **response_kwargs):
-            return JsonResponse({'results': context['timeline'], 'max_time': context['max_time']})
+            return PrimitivesJsonResponse({'results': context['timeline'],
+                                           'cursor': context['cursor'],
+                                           'reset': context['reset']})
 
 
 class GroupCRUDL(SmartCRUDL):
@@ -414,8 +458,22 @@ class LabelCRUDL(SmartCRUDL):
             initial['keywords'] = ', '.join(self.object.get_keywords())
             return initial
 
+        def pre_save(self, obj):
+            obj = super(LabelCRUDL.Update, self).pre_save(obj)
+
+            # partners haven't been saved yet so these are the partners before this update
+            self.old_partner_ids = set(obj.partners.values_list('pk', flat=True))
+            return obj
+
         def post_save(self, obj):
             obj.update_name(obj.name)
+
+            LabelIndex.invalidate(obj.org)
+            HomeData.invalidate(obj.org)
+
+            # partners who can see cases through this label may have changed
+            if set(obj.partners.values_list('pk', flat=True)) != self.old_partner_ids:
+                CaseCount.rebuild_in_background(obj.org)
             return obj
 
     class Delete(OrgObjPermsMixin, SmartDeleteView):
@@ -449,7 +507,7 @@ class MessageSearchMixin(object):
         after = parse_iso8601(request.GET.get('after', None))
         before = parse_iso8601(request.GET.get('before', None))
 
-        label_objs = Label.get_all(request.org, request.user)
+        label_objs = LabelIndex.get(request.org).get_all(request.user)
 
         if view == ItemView.unlabelled:
             labels = [('-%s' % l.name) for l in label_objs]
@@ -457,7 +515,7 @@ class MessageSearchMixin(object):
         else:
             label_id = request.GET.get('label', None)
             if label_id:
-                label_objs = label_objs.filter(pk=label_id)
+                label_objs = [l for l in label_objs if l.pk == int(label_id)]
             labels = [l.name for l in label_objs]
             msg_types = None
 
@@ -487,41 +545,42 @@ class MessageSearchMixin(object):
                 'archived': archived}
 
 
-class MessageSearchView(OrgPermsMixin, MessageSearchMixin, SmartTemplateView):
+class MessageSearchView(NonAtomicMixin, OrgPermsMixin, MessageSearchMixin, SmartTemplateView):
     """
-    JSON endpoint for fetching messages
+    JSON endpoint for fetching messages. If an after param is provided with a wait param, then the request is held open
+    for up to that many seconds until there are new messages.
     """
     permission = 'orgs.org_inbox'
 
     def get_context_data(self, **kwargs):
         context = super(MessageSearchView, self).get_context_data(**kwargs)
+        org = self.request.org
 
         search = self.derive_search()
         page = int(self.request.GET.get('page', 0))
+        wait = get_wait(self.request) if search['after'] else 0
 
-        client = self.request.org.get_temba_client()
-        pager = client.pager(start_page=page) if page else None
-        messages = Message.search(self.request.org, search, pager)
-
-        context['messages'] = messages
-
-        if page:
-            context['page'] = page
-            context['has_more'] = pager.has_more()
-            context['total'] = pager.total
+        if wait:
+            with EventWaiter(org, self.request.user, EventType.messages) as waiter:
+                result = MessageSearchCache.search(org, search, page)
+                if not result['messages'] and waiter.wait(wait):
+                    result = MessageSearchCache.search(org, search, page)
         else:
-            context['page'] = None
-            context['has_more'] = None
-            context['total'] = len(messages)
+            result = MessageSearchCache.search(org, search, page)
+
+        context['messages'] = result['messages']
+        context['page'] = page or None
+        context['has_more'] = result['has_more']
+        context['total'] = result['total']
 
         return context
 
     def render_to_response(self, context, **response_kwargs):
-        label_map = {l.name: l for l in Label.get_all(self.request.org)}
+        label_map = LabelIndex.get(self.request.org).by_name
 
         results = [Message.as_json(m, label_map) for m in context['messages']]
 
-        return JsonResponse({'results': results, 'has_more': context['has_more'], 'total': context['total']})
+        return PrimitivesJsonResponse({'results': results, 'has_more': context['has_more'], 'total': context['total']})
 
 
 class MessageActionView(OrgPermsMixin, View):
@@ -554,6 +613,8 @@ class MessageActionView(OrgPermsMixin, View):
         else:
             return HttpResponseBadRequest("Invalid action: %s", action)
 
+        MessageSearchCache.invalidate(org)
+
         return HttpResponse(status=204)
 
 
@@ -571,6 +632,8 @@ class MessageLabelView(OrgPermsMixin, View):
         labels = Label.get_all(org, user).filter(pk__in=label_ids)
 
         Message.update_labels(message, org, user, labels)
+        MessageSearchCache.invalidate(org)
+
         return HttpResponse(status=204)
 
 
@@ -602,7 +665,7 @@ class MessageHistoryView(OrgPermsMixin, View):
     def get(self, request, *args, **kwargs):
         actions = MessageAction.get_by_message(self.request.org, int(kwargs['id'])).order_by('-pk')
         actions = [a.as_json() for a in actions]
-        return JsonResponse({'actions': actions})
+        return PrimitivesJsonResponse({'actions': actions})
 
 
 class MessageExportCRUDL(SmartCRUDL):
@@ -629,13 +692,22 @@ class MessageExportCRUDL(SmartCRUDL):
             return r'%s/download/(?P<pk>\d+)/' % path
 
         def get(self, request, *args, **kwargs):
-            if 'download' in request.GET:
+            if 'progress' in request.GET:
+                return JsonResponse(self.get_object().as_json())
+            elif 'download' in request.GET:
                 export = self.get_object()
+                if not export.is_finished():
+                    raise Http404("Export is not complete")
 
                 export_file = default_storage.open(export.filename, 'rb')
-                user_filename = 'message_export.xls'
 
-                response = HttpResponse(export_file, content_type='application/vnd.ms-excel')
+                # older exports were generated as Excel files
+                if export.filename.endswith('.xls'):
+                    user_filename, content_type = 'message_export.xls', 'application/vnd.ms-excel'
+                else:
+                    user_filename, content_type = 'message_export.csv', 'text/csv; charset=utf-8'
+
+                response = StreamingHttpResponse(FileWrapper(export_file), content_type=content_type)
                 response['Content-Disposition'] = 'attachment; filename=%s' % user_filename
 
                 return response
@@ -644,7 +716,9 @@ class MessageExportCRUDL(SmartCRUDL):
 
         def get_context_data(self, **kwargs):
             context = super(MessageExportCRUDL.Read, self).get_context_data(**kwargs)
-            context['download_url'] = '%s?download=1' % reverse('cases.messageexport_read', args=[self.object.pk])
+            read_url = reverse('cases.messageexport_read', args=[self.object.pk])
+            context['download_url'] = '%s?download=1' % read_url
+            context['progress_url'] = '%s?progress=1' % read_url
             return context
 
 
@@ -684,6 +758,10 @@ class PartnerCRUDL(SmartCRUDL):
         def has_permission(self, request, *args, **kwargs):
             return request.user.can_manage(self.get_object())
 
+        def post_save(self, obj):
+            HomeData.invalidate(obj.org)
+            return obj
+
     class Read(OrgObjPermsMixin, SmartReadView):
         def get_queryset(self):
             return Partner.get_all(self.request.org)
@@ -727,28 +805,36 @@ class BaseHomeView(OrgPermsMixin, SmartTemplateView):
         context = super(BaseHomeView, self).get_context_data(**kwargs)
         org = self.request.org
         user = self.request.user
-        partner = user.get_partner()
-
-        labels = Label.get_all(org, user).order_by('name')
-        partners = Partner.get_all(org).order_by('name')
-        groups = Group.get_all(org).order_by('name')
 
         # angular app requires context data in JSON format
-        context['context_data_json'] = json_encode({
-            'user': {'id': user.pk, 'partner': partner.as_json() if partner else None},
-            'partners': [p.as_json() for p in partners],
-            'labels': [l.as_json() for l in labels],
-            'groups': [g.as_json() for g in groups],
-        })
+        context['context_data_json'] = HomeData.get_json(org, user)
 
         context['banner_text'] = org.get_banner_text()
         context['folder_icon'] = self.folder_icon
         context['item_view'] = self.item_view.name
-        context['open_case_count'] = Case.get_open(org, user).count()
-        context['closed_case_count'] = Case.get_closed(org, user).count()
+        context['open_case_count'] = CaseCount.get_open_count(org, user)
+        context['closed_case_count'] = CaseCount.get_closed_count(org, user)
         return context
 
 
+class EventsView(NonAtomicMixin, OrgPermsMixin, View):
+    """
+    Stream of server-sent events which notify clients of changes to cases and messages, so that they only need to
+    fetch when something has changed
+    """
+    permission = 'orgs.org_inbox'
+
+    def get(self, request, *args, **kwargs):
+        channel = get_events_channel(request.org, request.user)
+        if not channel:
+            return HttpResponse(status=204)  # tells the client not to reconnect
+
+        response = StreamingHttpResponse(stream_events(channel), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # stops nginx from buffering the stream
+        return response
+
+
 class InboxView(BaseHomeView):
     """
     Inbox view
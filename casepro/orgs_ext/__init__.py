@@ -6,6 +6,7 @@ from dash.orgs.models import Org
 from django.core.cache import cache
 from enum import Enum
 from temba_client.utils import format_iso8601, parse_iso8601
+from .clients import get_client
 
 
 class TaskType(Enum):
@@ -22,6 +23,10 @@ LAST_LABELLED_TIME_CACHE_KEY = 'org:%d:last_labelled_time'
 LAST_UNLABELLED_TIME_CACHE_KEY = 'org:%d:last_unlabelled_time'
 
 
+def _org_get_temba_client(org):
+    return get_client(org)
+
+
 def _org_get_banner_text(org):
     return org.get_config(ORG_CONFIG_BANNER_TEXT)
 
@@ -70,6 +75,7 @@ def _org_record_message_time(org, time, labelled):
         cache.set(key % org.pk, format_iso8601(time), ORG_CACHE_TTL)
 
 
+Org.get_temba_client = _org_get_temba_client
 Org.get_banner_text = _org_get_banner_text
 Org.set_banner_text = _org_set_banner_text
 Org.get_contact_fields = _org_get_contact_fields
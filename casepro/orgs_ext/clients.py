@@ -0,0 +1,155 @@
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import requests
+import threading
+import time
+
+from django.conf import settings
+from redis_cache import get_redis_connection
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from temba_client.base import TembaAPIError, TembaConnectionError
+from temba_client.client import TembaClient
+from urlparse import urlparse
+
+
+logger = logging.getLogger(__name__)
+
+# default (connect, read) timeouts in seconds for calls to RapidPro, and how many times calls which fail to connect or
+# get a gateway error are retried. These can be overridden with the RAPIDPRO_API_TIMEOUT and RAPIDPRO_API_RETRIES
+# settings.
+DEFAULT_API_TIMEOUT = (5, 60)
+DEFAULT_API_RETRIES = 2
+DEFAULT_API_POOL_SIZE = 10
+
+API_STATS_KEY = 'org:%d:api_stats'
+API_STATS_TTL = 60 * 60 * 24 * 7  # 1 week
+
+# upper bounds in milliseconds of the buckets of the latency histogram for each endpoint
+API_LATENCY_BUCKETS = (100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class PooledTembaClient(TembaClient):
+    """
+    RapidPro client which makes its calls through a session, so that connections are kept alive and reused, with
+    timeouts and retries. The latency of every call and whether it errored are recorded for the org.
+    """
+    def __init__(self, org, host, token, user_agent=None):
+        super(PooledTembaClient, self).__init__(host, token, user_agent=user_agent)
+
+        self.org_id = org.pk
+        self.timeout = getattr(settings, 'RAPIDPRO_API_TIMEOUT', DEFAULT_API_TIMEOUT)
+
+        pool_size = getattr(settings, 'RAPIDPRO_API_POOL_SIZE', DEFAULT_API_POOL_SIZE)
+        retries = Retry(total=getattr(settings, 'RAPIDPRO_API_RETRIES', DEFAULT_API_RETRIES),
+                        backoff_factor=0.5, status_forcelist=(502, 503, 504), method_whitelist=('GET',))
+
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retries))
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retries))
+
+    def _request(self, method, url, body=None, params=None):
+        """
+        Makes a GET, POST or DELETE request to the given URL and returns the parsed JSON
+        """
+        started = time.time()
+        error = True
+
+        try:
+            kwargs = {'headers': self.headers, 'timeout': self.timeout}
+            if body:
+                kwargs['data'] = body
+            if params:
+                kwargs['params'] = params
+
+            response = self.session.request(method, url, **kwargs)
+            response.raise_for_status()
+
+            error = False
+            return response.json() if response.content else None
+        except requests.HTTPError as ex:
+            raise TembaAPIError(ex)
+        except requests.RequestException:  # e.g. couldn't connect, timed out or ran out of retries
+            raise TembaConnectionError()
+        finally:
+            record_api_call(self.org_id, method, url, time.time() - started, error)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(org):
+    """
+    Gets the shared client for the given org in this process, creating it if necessary
+    """
+    host = getattr(settings, 'SITE_API_HOST', None)
+    agent = getattr(settings, 'SITE_API_USER_AGENT', None)
+    key = (org.pk, host, org.api_token)
+
+    with _clients_lock:
+        client = _clients.get(key)
+        if not client:
+            # discard any client for this org with an old API token
+            for old_key in [k for k in _clients.keys() if k[0] == org.pk]:
+                del _clients[old_key]
+
+            client = _clients[key] = PooledTembaClient(org, host, org.api_token, user_agent=agent)
+
+    return client
+
+
+def get_endpoint(method, url):
+    """
+    Gets the name of the endpoint for stats, e.g. "GET messages"
+    """
+    name = urlparse(url).path.rstrip('/').rsplit('/', 1)[-1]
+    if name.endswith('.json'):
+        name = name[:-5]
+    return '%s %s' % (method.upper(), name)
+
+
+def record_api_call(org_id, method, url, duration, error):
+    endpoint = get_endpoint(method, url)
+    millis = int(duration * 1000)
+    bucket = next((b for b in API_LATENCY_BUCKETS if millis <= b), None)
+    key = API_STATS_KEY % org_id
+
+    try:
+        pipe = get_redis_connection().pipeline()
+        pipe.hincrby(key, '%s|calls' % endpoint, 1)
+        pipe.hincrby(key, '%s|time' % endpoint, millis)
+        pipe.hincrby(key, '%s|le_%s' % (endpoint, bucket or 'inf'), 1)
+        if error:
+            pipe.hincrby(key, '%s|errors' % endpoint, 1)
+        pipe.expire(key, API_STATS_TTL)
+        pipe.execute()
+    except Exception:  # stats are never worth failing a call for
+        logger.exception("Unable to record stats for call to %s" % endpoint)
+
+    logger.debug("%s for org #%d took %d ms%s" % (endpoint, org_id, millis, " (error)" if error else ""))
+
+
+def get_api_stats(org):
+    """
+    Gets the numbers of calls and errors, the average latency, and the latency histogram for each endpoint called
+    for the given org
+    """
+    values = get_redis_connection().hgetall(API_STATS_KEY % org.pk)
+
+    stats = {}
+    for field, value in values.iteritems():
+        endpoint, stat = field.decode('utf-8').rsplit('|', 1)
+        endpoint_stats = stats.setdefault(endpoint, {'calls': 0, 'errors': 0, 'time': 0, 'latency': {}})
+
+        if stat.startswith('le_'):
+            endpoint_stats['latency'][stat[3:]] = int(value)
+        else:
+            endpoint_stats[stat] = int(value)
+
+    for endpoint_stats in stats.itervalues():
+        total_time = endpoint_stats.pop('time')
+        endpoint_stats['average_ms'] = (total_time // endpoint_stats['calls']) if endpoint_stats['calls'] else 0
+
+    return stats
@@ -1,7 +1,11 @@
 from __future__ import absolute_import, unicode_literals
 
 from django.core.urlresolvers import reverse
+from mock import patch, Mock
+from requests import ConnectionError
+from temba_client.base import TembaConnectionError
 from casepro.test import BaseCasesTest
+from .clients import get_api_stats, get_endpoint, record_api_call, PooledTembaClient
 
 
 class OrgExtCRUDLTest(BaseCasesTest):
@@ -12,3 +16,52 @@ class OrgExtCRUDLTest(BaseCasesTest):
 
         response = self.url_get('unicef', url)
         self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "hit rate")
+
+    def test_api_stats(self):
+        url = reverse('orgs_ext.org_api_stats')
+
+        record_api_call(self.unicef.pk, 'get', 'http://localhost/api/v1/messages.json', 0.05, False)
+        record_api_call(self.unicef.pk, 'get', 'http://localhost/api/v1/messages.json?page=2', 0.3, True)
+        record_api_call(self.nyaruka.pk, 'get', 'http://localhost/api/v1/contacts.json', 0.1, False)
+
+        self.login(self.admin)
+
+        response = self.url_get('unicef', url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {'endpoints': {
+            'GET messages': {'calls': 2, 'errors': 1, 'average_ms': 175, 'latency': {'100': 1, '500': 1}}
+        }})
+
+
+class ClientsTest(BaseCasesTest):
+    def test_get_endpoint(self):
+        self.assertEqual(get_endpoint('get', 'http://localhost/api/v1/messages.json?page=2'), "GET messages")
+        self.assertEqual(get_endpoint('post', 'http://localhost/api/v1/message_actions.json'), "POST message_actions")
+
+    @patch('requests.Session.request')
+    def test_get_temba_client(self, mock_request):
+        client = self.unicef.get_temba_client()
+        self.assertIsInstance(client, PooledTembaClient)
+
+        # same client is reused until the org's API token changes
+        self.assertIs(self.unicef.get_temba_client(), client)
+        self.assertIsNot(self.nyaruka.get_temba_client(), client)
+
+        self.unicef.api_token = "1234567890"
+        client2 = self.unicef.get_temba_client()
+        self.assertIsNot(client2, client)
+
+        mock_request.return_value = Mock(status_code=200, content='{}')
+        mock_request.return_value.json.return_value = {'count': 0, 'next': None, 'previous': None, 'results': []}
+
+        self.assertEqual(client2.get_groups(), [])
+        self.assertEqual(mock_request.call_args[1]['timeout'], (5, 60))
+
+        # connection errors are raised as client errors
+        mock_request.side_effect = ConnectionError()
+        self.assertRaises(TembaConnectionError, client2.get_groups)
+
+        stats = get_api_stats(self.unicef)
+        self.assertEqual(stats['GET groups']['calls'], 2)
+        self.assertEqual(stats['GET groups']['errors'], 1)
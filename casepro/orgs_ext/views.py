@@ -1,18 +1,21 @@
 from __future__ import absolute_import, unicode_literals
 
 from dash.orgs.models import Org
-from dash.orgs.views import OrgCRUDL, InferOrgMixin, OrgPermsMixin, SmartUpdateView
+from dash.orgs.views import OrgCRUDL, InferOrgMixin, OrgPermsMixin, SmartUpdateView, SmartReadView
 from dash.utils import ms_to_datetime
 from django import forms
+from django.http import JsonResponse
 from django.utils.translation import ugettext_lazy as _
 from smartmin.templatetags.smartmin import format_datetime
 from smartmin.users.views import SmartCRUDL
 from timezones.forms import TimeZoneField
+from casepro.cases.models import ContactCache
 from . import TaskType
+from .clients import get_api_stats
 
 
 class OrgExtCRUDL(SmartCRUDL):
-    actions = ('create', 'update', 'list', 'home', 'edit', 'chooser', 'choose')
+    actions = ('create', 'update', 'list', 'home', 'edit', 'chooser', 'choose', 'api_stats')
     model = Org
 
     class Create(OrgCRUDL.Create):
@@ -25,7 +28,7 @@ class OrgExtCRUDL(SmartCRUDL):
         pass
 
     class Home(OrgCRUDL.Home):
-        fields = ('name', 'timezone', 'api_token', 'contact_fields', 'last_label_task')
+        fields = ('name', 'timezone', 'api_token', 'contact_fields', 'last_label_task', 'contact_cache')
         field_config = {'api_token': {'label': _("RapidPro API Token")}}
         permission = 'orgs.org_home'
 
@@ -41,10 +44,29 @@ class OrgExtCRUDL(SmartCRUDL):
                 when = format_datetime(ms_to_datetime(result['time']))
                 num_messages = int(result['counts'].get('messages', 0))
                 num_labelled = int(result['counts'].get('labelled', 0))
+                duration = result.get('duration', None)
+                if duration is not None:
+                    return "%s (%d new messages, %d labelled, took %.1f secs)" % (when, num_messages, num_labelled,
+                                                                                  duration)
                 return "%s (%d new messages, %d labelled)" % (when, num_messages, num_labelled)
             else:
                 return None
 
+        def get_contact_cache(self, obj):
+            stats = ContactCache.get_stats(obj)
+            total = stats['hits'] + stats['misses']
+            hit_rate = (100.0 * stats['hits'] / total) if total else 0.0
+            return "%d hits, %d misses (%.1f%% hit rate)" % (stats['hits'], stats['misses'], hit_rate)
+
+    class ApiStats(InferOrgMixin, OrgPermsMixin, SmartReadView):
+        """
+        JSON endpoint for stats on this org's calls to RapidPro
+        """
+        permission = 'orgs.org_home'
+
+        def get(self, request, *args, **kwargs):
+            return JsonResponse({'endpoints': get_api_stats(self.get_object())})
+
     class Edit(InferOrgMixin, OrgPermsMixin, SmartUpdateView):
         class OrgExtForm(forms.ModelForm):
             name = forms.CharField(label=_("Organization"),
@@ -12,6 +12,35 @@ ROLE_MANAGER = 'M'
 ROLE_CHOICES = ((ROLE_ANALYST, _("Data Analyst")), (ROLE_MANAGER, _("Manager")))
 
 
+class PermsCache(object):
+    """
+    Request scoped cache of a user's permission checks, attached to the request user by UserPermsCacheMiddleware.
+    Tracks how many checks it has answered without hitting the database.
+    """
+    def __init__(self):
+        self.values = {}
+        self.num_hits = 0
+
+    def get(self, key, calculate):
+        if key in self.values:
+            self.num_hits += 1
+        else:
+            self.values[key] = calculate()
+
+        return self.values[key]
+
+    def clear(self):
+        self.values = {}
+
+
+def _memoize(user, key, calculate):
+    """
+    Memoizes a permission check if the given user has a permissions cache
+    """
+    perms_cache = getattr(user, '_perms_cache', None)
+    return perms_cache.get(key, calculate) if perms_cache else calculate()
+
+
 # ================================== Monkey patching for the User class ====================================
 
 def _user_create(cls, org, partner, role, full_name, email, password, change_password=False):
@@ -48,6 +77,11 @@ def _user_update_role(user, org, role):
     else:  # pragma: no cover
         raise ValueError("Invalid user role: %s" % role)
 
+    # role (and possibly partner) has changed so any cached permissions are no longer valid
+    perms_cache = getattr(user, '_perms_cache', None)
+    if perms_cache:
+        perms_cache.clear()
+
 
 def _user_clean(user):
     # we use email for login
@@ -60,10 +94,13 @@ def _user_clean(user):
 
 
 def _user_has_profile(user):
-    try:
-        return bool(user.profile)
-    except Profile.DoesNotExist:
-        return False
+    def calculate():
+        try:
+            return bool(user.profile)
+        except Profile.DoesNotExist:
+            return False
+
+    return _memoize(user, ('has_profile',), calculate)
 
 
 def _user_get_full_name(user):
@@ -74,24 +111,30 @@ def _user_get_full_name(user):
 
 
 def _user_get_partner(user):
-    return user.profile.partner if user.has_profile() else None
+    return _memoize(user, ('partner',), lambda: user.profile.partner if user.has_profile() else None)
 
 
 def _user_can_administer(user, org):
     """
     Whether this user can administer the given org
     """
-    return user.is_superuser or org.administrators.filter(pk=user.pk).exists()
+    def calculate():
+        return user.is_superuser or org.administrators.filter(pk=user.pk).exists()
+
+    return _memoize(user, ('can_administer', org.pk), calculate)
 
 
 def _user_can_manage(user, partner):
     """
     Whether this user can manage the given partner org
     """
-    if user.can_administer(partner.org):
-        return True
+    def calculate():
+        if user.can_administer(partner.org):
+            return True
+
+        return user.get_partner() == partner and partner.org.editors.filter(pk=user.pk).exists()
 
-    return user.get_partner() == partner and partner.org.editors.filter(pk=user.pk).exists()
+    return _memoize(user, ('can_manage', partner.pk), calculate)
 
 
 def _user_can_edit(user, org, other):
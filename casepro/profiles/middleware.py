@@ -1,10 +1,15 @@
 from __future__ import absolute_import, unicode_literals
 
+import logging
+
+from django.conf import settings
 from django.http import HttpResponseRedirect
 from django.contrib import messages
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext_lazy as _
+from . import PermsCache
 
+logger = logging.getLogger(__name__)
 
 ALLOW_NO_CHANGE = {'profiles.user_self',
                    'users.user_logout'}
@@ -24,3 +29,24 @@ class ForcePasswordChangeMiddleware(object):
             if url_name not in ALLOW_NO_CHANGE:
                 messages.info(request, _("You are required to change your password"))
                 return HttpResponseRedirect(reverse('profiles.user_self'))
+
+
+class UserPermsCacheMiddleware(object):
+    """
+    Middleware to memoize the permission checks of the logged in user for the duration of each request
+    """
+    def process_request(self, request):
+        if request.user.is_authenticated():
+            request.user._perms_cache = PermsCache()
+
+    def process_response(self, request, response):
+        user = getattr(request, 'user', None)
+        perms_cache = getattr(user, '_perms_cache', None) if user else None
+
+        if perms_cache:
+            logger.debug("Avoided %d permission queries for %s" % (perms_cache.num_hits, request.path))
+
+            if settings.DEBUG:
+                response['X-Perms-Cache-Hits'] = str(perms_cache.num_hits)
+
+        return response
@@ -4,7 +4,7 @@ from django.contrib.auth.models import User, Group
 from django.core.urlresolvers import reverse
 from django.test.utils import override_settings
 from mock import patch
-from casepro.profiles import ROLE_ANALYST, ROLE_MANAGER
+from casepro.profiles import ROLE_ANALYST, ROLE_MANAGER, PermsCache
 from casepro.test import BaseCasesTest
 
 
@@ -79,6 +79,26 @@ class UserPatchTest(BaseCasesTest):
         self.assertFalse(self.user2.can_manage(self.who))
         self.assertFalse(self.user2.can_manage(self.klab))
 
+    def test_perms_cache(self):
+        self.user1._perms_cache = PermsCache()
+
+        # only the first check hits the database
+        with self.assertNumQueries(1):
+            self.assertFalse(self.user1.can_administer(self.unicef))
+            self.assertFalse(self.user1.can_administer(self.unicef))
+
+        self.assertEqual(self.user1._perms_cache.num_hits, 1)
+
+        self.assertTrue(self.user1.can_manage(self.moh))
+        with self.assertNumQueries(0):
+            self.assertTrue(self.user1.can_manage(self.moh))
+            self.assertEqual(self.user1.get_partner(), self.moh)
+            self.assertTrue(self.user1.has_profile())
+
+        # changing role clears the cache
+        self.user1.update_role(self.unicef, ROLE_ANALYST)
+        self.assertFalse(self.user1.can_manage(self.moh))
+
     def test_can_edit(self):
         # superusers can edit anyone
         self.assertTrue(self.superuser.can_edit(self.unicef, self.admin))
@@ -482,3 +502,13 @@ class ForcePasswordChangeMiddlewareTest(BaseCasesTest):
 
         response = self.url_get('unicef', reverse('cases.inbox'))
         self.assertEqual(response.status_code, 200)
+
+
+class UserPermsCacheMiddlewareTest(BaseCasesTest):
+    @override_settings(DEBUG=True)
+    def test_process_response(self):
+        self.login(self.user1)
+
+        response = self.url_get('unicef', reverse('cases.partner_read', args=[self.moh.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('X-Perms-Cache-Hits', response)
@@ -143,6 +143,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'casepro.profiles.middleware.UserPermsCacheMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'dash.orgs.middleware.SetOrgMiddleware',
     'casepro.profiles.middleware.ForcePasswordChangeMiddleware',
@@ -378,6 +379,14 @@ SOUTH_TESTS_MIGRATE = False
 
 INTERNAL_IPS = ('127.0.0.1',)
 
+#-----------------------------------------------------------------------------------
+# Message search
+#-----------------------------------------------------------------------------------
+
+# whether to serve message searches from local copies of messages rather than RapidPro. Should only be enabled once
+# existing messages have been mirrored using the mirrormsgs command.
+LOCAL_MESSAGE_SEARCH = False
+
 #-----------------------------------------------------------------------------------
 # Django-celery
 #-----------------------------------------------------------------------------------
@@ -389,7 +398,7 @@ CELERY_RESULT_BACKEND = BROKER_URL
 CELERYBEAT_SCHEDULE = {
     'process-new-unsolicited': {
         'task': 'casepro.cases.tasks.process_new_unsolicited',
-        'schedule': datetime.timedelta(minutes=10),  # TODO reduce this when we've made the messages endpoint faster
+        'schedule': datetime.timedelta(minutes=1),
         'args': ()
     },
 }
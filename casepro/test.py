@@ -5,6 +5,7 @@ import pytz
 
 from dash.test import DashTest
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from casepro.cases.models import Group, Label, Partner
 from casepro.profiles import ROLE_ANALYST, ROLE_MANAGER
 
@@ -14,6 +15,9 @@ class BaseCasesTest(DashTest):
     Base class for all test cases
     """
     def setUp(self):
+        # cached org data is keyed by ids which are reused by later test runs
+        cache.clear()
+
         # some orgs
         self.unicef = self.create_org("UNICEF", timezone="Africa/Kampala", subdomain="unicef")
         self.nyaruka = self.create_org("Nyaruka", timezone="Africa/Kigali", subdomain="nyaruka")
@@ -0,0 +1,8 @@
+# Gunicorn settings for running with gevent workers, e.g. gunicorn casepro.wsgi:application -c config/gunicorn.py
+
+
+def post_fork(server, worker):
+    # psycopg2 blocks in C code, so make it yield to other greenlets while waiting on the database, otherwise one slow
+    # query stalls every request on the worker
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()